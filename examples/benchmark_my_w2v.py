@@ -0,0 +1,128 @@
+"""
+Measure the training throughput of my Word2Vec model on a synthetic corpus, and the memory and
+quality of the half-precision storages against float32.
+"""
+import logging
+import argparse
+import itertools
+import time
+import numpy as np
+from gensim.corpora import Dictionary
+
+from mltools.utils import set_seed, set_logger
+from mltools.model.word2vec import MyWord2Vec
+from mltools.model.word2vec_impl.word2vec_impl_cython import active_kernel # pylint: disable=import-error,no-name-in-module
+
+logger = logging.getLogger(__name__)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--vocab_count", type=int, default=10000, help="vocabulary size")
+    parser.add_argument("--text_count", type=int, default=20000, help="the number of texts")
+    parser.add_argument("--text_length", type=int, default=50, help="the number of words per text")
+    parser.add_argument(
+        "--zipf_exponent", type=float, default=1.1, help="The exponent of the Zipf distribution")
+
+    parser.add_argument(
+        "--sg", type=int, nargs='+', default=[1, 0], choices=[0, 1],
+        help="training modes to measure: 1 for skip-gram, 0 for CBOW")
+    parser.add_argument("--window", type=int, default=5, help="The window size of skip-gram")
+    parser.add_argument("--size", type=int, default=100, help="The dimension of word representation")
+    parser.add_argument(
+        "--negative", type=int, default=5, help="The number per word of negative samples to use")
+    parser.add_argument(
+        "--sample", type=float, default=1e-3,
+        help="The threshold for downsampling higher-frequency words (0 to disable)")
+
+    parser.add_argument(
+        "--storage", type=str, nargs='+', default=['float32'],
+        choices=['float32', 'float16', 'bfloat16'], help="embedding storages to measure")
+    parser.add_argument(
+        "--queries", type=int, default=100,
+        help="the number of frequent words whose top-10 neighbours are compared with float32")
+
+    parser.add_argument("--mb_size", type=int, default=512, help="minibatch size per thread")
+    parser.add_argument(
+        "--workers", type=int, nargs='+', default=[1, 2, 4], help="thread counts to measure")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for initialization")
+
+    args = parser.parse_args()
+
+    return args
+
+def make_zipf_corpus(vocab_count: int, text_count: int, text_length: int, exponent: float):
+    ranks = np.arange(1, vocab_count + 1)
+    prob = 1.0 / ranks ** exponent
+    prob /= np.sum(prob)
+    tokens = np.random.choice(vocab_count, size=(text_count, text_length), p=prob)
+
+    dictionary = Dictionary([['w{}'.format(i) for i in range(vocab_count)]])
+    dictionary.dfs = {
+        dictionary.token2id['w{}'.format(i)]: int(count)
+        for i, count in enumerate(np.bincount(tokens.ravel(), minlength=vocab_count) + 1)
+    }
+    id_map = np.array([dictionary.token2id['w{}'.format(i)] for i in range(vocab_count)])
+    texts = id_map[tokens].tolist()
+
+    return dictionary, texts
+
+def run():
+    set_logger()
+    args = get_args()
+    set_seed(args.seed)
+
+    logger.info('Generate a synthetic Zipfian corpus.')
+    dictionary, texts = make_zipf_corpus(
+        args.vocab_count, args.text_count, args.text_length, args.zipf_exponent)
+
+    # The Zipfian ranks are the token ids, so the first ids are the most frequent words.
+    queries = [dictionary[index] for index in range(args.queries)]
+    # float32 runs first and gives the reference neighbours.
+    storages = sorted(args.storage, key=lambda storage: storage != 'float32')
+
+    logger.info('Kernel: %s', active_kernel())
+    for sg, workers in itertools.product(args.sg, args.workers):
+        reference = None
+        for storage in storages:
+            set_seed(args.seed)
+            w2v_model = MyWord2Vec(
+                dictionary=dictionary,
+                sg=sg,
+                window=args.window,
+                size=args.size,
+                negative=args.negative,
+                sample=args.sample,
+                workers=workers,
+                storage=storage)
+
+            mb_size = args.mb_size * workers
+            losses = []
+            start = time.perf_counter()
+            for i in range(0, len(texts), mb_size):
+                losses.append(w2v_model.train(texts[i: i + mb_size]))
+            elapsed = time.perf_counter() - start
+
+            throughput = w2v_model.throughput()
+            logger.info(
+                '%s, workers: %d, %s: %.0f words/sec in wall-clock time, %s words/sec per thread',
+                'skip-gram' if sg else 'CBOW', workers, storage,
+                args.text_count * args.text_length / elapsed,
+                ', '.join('{:.0f}'.format(value) for value in throughput))
+
+            neighbours = w2v_model.most_similar_batch(queries, topn=11)
+            if storage == 'float32':
+                reference = neighbours
+            overlap = np.mean([
+                len(set(result[1:]) & set(expected[1:])) / 10
+                for result, expected in zip(neighbours, reference)
+            ]) if reference is not None else float('nan')
+            logger.info(
+                '    loss of the last 10 minibatches: %.4f, matrices: %.1f MB, '
+                'top-10 overlap with float32: %.3f',
+                np.mean(losses[-10:]),
+                (w2v_model._w_in.nbytes + w2v_model._w_out.nbytes) / 2 ** 20, # pylint: disable=protected-access
+                overlap)
+
+if __name__ == '__main__':
+    run()
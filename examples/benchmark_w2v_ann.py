@@ -0,0 +1,96 @@
+"""
+Compare the recall and the latency of the approximate nearest neighbour search of my Word2Vec
+model with the exact search, one query at a time and batched.
+"""
+import logging
+import argparse
+import time
+import numpy as np
+from gensim.corpora import Dictionary
+
+from mltools.utils import set_seed, set_logger
+from mltools.model.word2vec import MyWord2Vec
+
+logger = logging.getLogger(__name__)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--model_dir", type=str,
+        help="directory of a saved model; synthetic clustered embeddings are used if omitted")
+    parser.add_argument("--vocab_count", type=int, default=100000, help="synthetic vocabulary size")
+    parser.add_argument("--size", type=int, default=100, help="synthetic embedding dimension")
+    parser.add_argument("--clusters", type=int, default=1000, help="synthetic cluster count")
+
+    parser.add_argument("--n_tables", type=int, default=8, help="the number of hash tables")
+    parser.add_argument("--n_bits", type=int, help="the number of hash bits per table")
+    parser.add_argument(
+        "--probes", type=int, nargs='+', default=[0, 2, 4, 8], help="probe counts to measure")
+
+    parser.add_argument("--queries", type=int, default=200, help="the number of queries")
+    parser.add_argument("--topn", type=int, default=10, help="the number of neighbours")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for initialization")
+
+    args = parser.parse_args()
+
+    return args
+
+def make_clustered_model(vocab_count: int, size: int, clusters: int) -> MyWord2Vec:
+    dictionary = Dictionary([['w{}'.format(i) for i in range(vocab_count)]])
+    w2v_model = MyWord2Vec(dictionary, size=size)
+
+    centers = np.random.randn(clusters, size).astype(np.float32)
+    assignments = np.random.randint(0, clusters, vocab_count)
+    vectors = centers[assignments] + 0.5 * np.random.randn(vocab_count, size).astype(np.float32)
+    w2v_model._w_in = vectors # pylint: disable=protected-access
+
+    return w2v_model
+
+def run():
+    set_logger()
+    args = get_args()
+    set_seed(args.seed)
+
+    if args.model_dir:
+        w2v_model = MyWord2Vec.load(args.model_dir)
+    else:
+        logger.info('Generate synthetic clustered embeddings.')
+        w2v_model = make_clustered_model(args.vocab_count, args.size, args.clusters)
+
+    start = time.perf_counter()
+    w2v_model.build_ann_index(args.n_tables, args.n_bits, args.seed)
+    logger.info(
+        'Built an index of %d tables x %d bits in %.2f sec.',
+        w2v_model.ann_index.n_tables, w2v_model.ann_index.n_bits, time.perf_counter() - start)
+
+    dictionary = w2v_model._dictionary # pylint: disable=protected-access
+    words = [dictionary[index] for index in np.random.randint(0, len(dictionary), args.queries)]
+
+    start = time.perf_counter()
+    exact_results = [w2v_model.most_similar(word, topn=args.topn) for word in words]
+    exact_latency = (time.perf_counter() - start) / args.queries
+    logger.info('Exact search: %.2f ms/query', exact_latency * 1e3)
+
+    start = time.perf_counter()
+    w2v_model.most_similar_batch(words, topn=args.topn)
+    logger.info(
+        'Exact batch search: %.2f ms/query', (time.perf_counter() - start) / args.queries * 1e3)
+
+    for probes in args.probes:
+        start = time.perf_counter()
+        results = [
+            w2v_model.most_similar(word, topn=args.topn, approximate=True, probes=probes)
+            for word in words
+        ]
+        latency = (time.perf_counter() - start) / args.queries
+        recall = np.mean([
+            len(set(result) & set(exact_result)) / len(exact_result)
+            for result, exact_result in zip(results, exact_results)
+        ])
+        logger.info(
+            'Approximate search with %d probes: recall@%d %.3f, %.2f ms/query (%.1fx faster)',
+            probes, args.topn, recall, latency * 1e3, exact_latency / latency)
+
+if __name__ == '__main__':
+    run()
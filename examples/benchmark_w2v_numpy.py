@@ -0,0 +1,88 @@
+"""
+Compare the NumPy fallback engine of my Word2Vec model with the native one on a synthetic corpus:
+the pair update kernels on the same pairs, then the whole skip-gram training step.
+"""
+import logging
+import argparse
+import time
+import numpy as np
+
+from mltools.utils import set_seed, set_logger
+from mltools.model.word2vec_impl import word2vec_impl_numpy
+from mltools.model.word2vec_impl import word2vec_impl_cython # pylint: disable=import-error,no-name-in-module
+
+from benchmark_my_w2v import make_zipf_corpus # pylint: disable=import-error
+
+logger = logging.getLogger(__name__)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--vocab_count", type=int, default=10000, help="vocabulary size")
+    parser.add_argument("--text_count", type=int, default=2000, help="the number of texts")
+    parser.add_argument("--text_length", type=int, default=50, help="the number of words per text")
+    parser.add_argument(
+        "--zipf_exponent", type=float, default=1.1, help="The exponent of the Zipf distribution")
+
+    parser.add_argument("--window", type=int, default=5, help="The window size of skip-gram")
+    parser.add_argument("--size", type=int, default=100, help="The dimension of word representation")
+    parser.add_argument(
+        "--negative", type=int, default=5, help="The number per word of negative samples to use")
+    parser.add_argument("--alpha", type=float, default=0.025, help="learning rate")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for initialization")
+
+    args = parser.parse_args()
+
+    return args
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def run():
+    set_logger()
+    args = get_args()
+    set_seed(args.seed)
+
+    logger.info('Generate a synthetic Zipfian corpus.')
+    dictionary, texts = make_zipf_corpus(
+        args.vocab_count, args.text_count, args.text_length, args.zipf_exponent)
+    freq = np.array([dictionary.dfs[i] for i in range(len(dictionary))], dtype=np.float64)
+    vocab_ns_prob = freq ** 0.75 / np.sum(freq ** 0.75)
+    word_count = args.text_count * args.text_length
+
+    negative_sampler = word2vec_impl_cython.NegativeSampler(vocab_ns_prob)
+    indices_in, indices_out, labels = word2vec_impl_cython.get_sg_ns_pairs(
+        texts, args.window, args.negative, negative_sampler, args.seed)
+    logger.info('Pair update kernels on %d pairs:', len(labels))
+
+    kernels = [
+        ('numpy', word2vec_impl_numpy.update_w_numpy),
+        ('cython', word2vec_impl_cython.update_w_cython),
+        ('eigen', word2vec_impl_cython.update_w_eigen),
+        ('simd ({})'.format(word2vec_impl_cython.active_kernel()), word2vec_impl_cython.update_w_simd),
+    ]
+    for name, update_w in kernels:
+        w_in = (np.random.randn(len(dictionary), args.size) * 0.1).astype(np.float32)
+        w_out = np.zeros((len(dictionary), args.size), dtype=np.float32)
+        loss, elapsed = measure(
+            update_w, w_in, w_out, indices_in.tolist(), indices_out.tolist(), labels.tolist(),
+            np.float32(args.alpha))
+        logger.info(
+            '  %-14s %10.0f pairs/sec, mean loss %.4f', name, len(labels) / elapsed, loss)
+
+    logger.info('Skip-gram training on %d words:', word_count)
+    for name, engine in [('numpy', word2vec_impl_numpy), ('native', word2vec_impl_cython)]:
+        w_in = (np.random.randn(len(dictionary), args.size) * 0.1).astype(np.float32)
+        w_out = np.zeros((len(dictionary), args.size), dtype=np.float32)
+        stats, elapsed = measure(
+            engine.get_sg_ns_grad, texts, args.window, args.negative,
+            engine.NegativeSampler(vocab_ns_prob), w_in, w_out, np.float32(args.alpha), 1, None,
+            args.seed)
+        logger.info(
+            '  %-14s %10.0f words/sec, mean loss %.4f', name, word_count / elapsed,
+            sum(stat['loss'] for stat in stats) / sum(stat['pairs'] for stat in stats))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,131 @@
+"""
+Compare the speed and the quality of skip-gram with negatives shared by blocks of center words
+(MyWord2Vec(shared_negatives=...)) with per-pair negative sampling.
+
+The synthetic corpus plants topics: every text belongs to one topic and draws most of its words
+from the words of that topic, so the quality is the share of the 10 nearest neighbours of frequent
+words which belong to their topic (1 / topic_count by chance). For the Wikipedia pipeline, run
+train_my_w2v.py with and without --shared_negatives and compare its throughput and neighbours.
+"""
+import logging
+import argparse
+import itertools
+import time
+import numpy as np
+from gensim.corpora import Dictionary
+
+from mltools.utils import set_seed, set_logger
+from mltools.model.word2vec import MyWord2Vec, NATIVE_ENGINE
+
+logger = logging.getLogger(__name__)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--vocab_count", type=int, default=10000, help="vocabulary size")
+    parser.add_argument("--topic_count", type=int, default=50, help="the number of planted topics")
+    parser.add_argument(
+        "--topic_ratio", type=float, default=0.5,
+        help="The probability that a word is drawn from the topic of its text")
+    parser.add_argument("--text_count", type=int, default=20000, help="the number of texts")
+    parser.add_argument("--text_length", type=int, default=50, help="the number of words per text")
+    parser.add_argument(
+        "--zipf_exponent", type=float, default=1.1, help="The exponent of the Zipf distribution")
+
+    parser.add_argument(
+        "--shared_negatives", type=int, nargs='+', default=[0, 4, 16, 64],
+        help="block sizes to measure; 0 samples negatives per pair")
+    parser.add_argument(
+        "--sizes", type=int, nargs='+', default=[100, 300], help="embedding dimensions to measure")
+    parser.add_argument("--window", type=int, default=5, help="The window size of skip-gram")
+    parser.add_argument(
+        "--negative", type=int, default=5, help="The number per word of negative samples to use")
+    parser.add_argument(
+        "--sample", type=float, default=1e-3,
+        help="The threshold for downsampling higher-frequency words (0 to disable)")
+    parser.add_argument("--epochs", type=int, default=3, help="epoch count")
+
+    parser.add_argument(
+        "--queries", type=int, default=500,
+        help="the number of frequent words whose neighbours are checked")
+    parser.add_argument("--mb_size", type=int, default=512, help="minibatch size per thread")
+    parser.add_argument("--workers", type=int, default=1, help="the number of threads")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for initialization")
+
+    args = parser.parse_args()
+
+    return args
+
+def make_topic_corpus(
+        vocab_count: int, topic_count: int, topic_ratio: float, text_count: int, text_length: int,
+        exponent: float):
+    """
+    Word i belongs to topic i % topic_count, so every topic has frequent and rare words. A text
+    draws its words from its topic with probability topic_ratio and from the whole vocabulary
+    otherwise, both with Zipfian frequencies.
+    """
+    prob = 1.0 / np.arange(1, vocab_count + 1) ** exponent
+    topics = np.random.randint(0, topic_count, text_count)
+    from_topic = np.random.rand(text_count, text_length) < topic_ratio
+    tokens = np.random.choice(vocab_count, size=(text_count, text_length), p=prob / np.sum(prob))
+    for topic in range(topic_count):
+        words = np.arange(topic, vocab_count, topic_count)
+        mask = from_topic & (topics == topic)[:, None]
+        tokens[mask] = np.random.choice(words, size=np.sum(mask), p=prob[words] / np.sum(prob[words]))
+
+    dictionary = Dictionary([['w{}'.format(i) for i in range(vocab_count)]])
+    id_map = np.array([dictionary.token2id['w{}'.format(i)] for i in range(vocab_count)])
+    dictionary.dfs = {
+        id_map[i]: int(count)
+        for i, count in enumerate(np.bincount(tokens.ravel(), minlength=vocab_count) + 1)
+    }
+
+    return dictionary, id_map[tokens].tolist()
+
+def run():
+    set_logger()
+    args = get_args()
+    set_seed(args.seed)
+
+    logger.info('Generate a synthetic corpus with %d planted topics.', args.topic_count)
+    dictionary, texts = make_topic_corpus(
+        args.vocab_count, args.topic_count, args.topic_ratio, args.text_count, args.text_length,
+        args.zipf_exponent)
+    queries = ['w{}'.format(i) for i in range(args.queries)]
+    if not NATIVE_ENGINE:
+        logger.warning('The NumPy engine trains every block in one step whatever shared_negatives.')
+
+    for size, shared_negatives in itertools.product(args.sizes, args.shared_negatives):
+        set_seed(args.seed)
+        w2v_model = MyWord2Vec(
+            dictionary=dictionary,
+            window=args.window,
+            size=size,
+            negative=args.negative,
+            sample=args.sample,
+            workers=args.workers,
+            shared_negatives=shared_negatives)
+        w2v_model.schedule_alpha(args.text_count * args.text_length * args.epochs)
+
+        mb_size = args.mb_size * args.workers
+        losses = []
+        start = time.perf_counter()
+        for _ in range(args.epochs):
+            for i in range(0, len(texts), mb_size):
+                losses.append(w2v_model.train(texts[i: i + mb_size]))
+        elapsed = time.perf_counter() - start
+
+        neighbours = w2v_model.most_similar_batch(queries, topn=11)
+        precision = np.mean([
+            np.mean([int(word[1:]) % args.topic_count == int(query[1:]) % args.topic_count
+                     for word in result[1:]])
+            for query, result in zip(queries, neighbours)
+        ])
+        logger.info(
+            'size: %d, shared_negatives: %d: %.0f words/sec, loss of the last 10 minibatches: '
+            '%.4f, topic precision@10: %.3f',
+            size, shared_negatives, args.text_count * args.text_length * args.epochs / elapsed,
+            np.mean(losses[-10:]), precision)
+
+if __name__ == '__main__':
+    run()
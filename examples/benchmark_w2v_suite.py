@@ -0,0 +1,294 @@
+"""
+Benchmark the word2vec engines of my Word2Vec model against gensim Word2Vec on a synthetic
+Zipfian corpus generated offline, and write a JSON report to track over releases.
+
+The report holds the pairs/sec of every pair update kernel, the words/sec and pairs/sec of the
+training engine for every SIMD kernel and training mode, its thread scaling, and gensim at the
+same hyperparameters. Every case runs in a forked process, so kernel selection does not leak into
+the next case. A forked process inherits the resident set of the benchmark, so the memory of a
+case is reported as case_rss_mb, its peak RSS minus its RSS at start. The corpus and the initial
+weights are seeded, but Hogwild threads make multi-threaded losses vary from run to run.
+"""
+import logging
+import argparse
+import json
+import os
+import platform
+import resource
+import multiprocessing
+import time
+import numpy as np
+import gensim
+from gensim.models.word2vec import Word2Vec
+
+from mltools.utils import set_seed, set_logger
+from mltools.model.word2vec import MyWord2Vec, NATIVE_ENGINE
+from mltools.model.word2vec_impl import word2vec_impl_numpy
+from mltools.model.word2vec_impl import word2vec_impl_cython # pylint: disable=import-error,no-name-in-module
+
+from benchmark_my_w2v import make_zipf_corpus # pylint: disable=import-error
+
+logger = logging.getLogger(__name__)
+
+MODES = {
+    'sg_ns': (1, 0),
+    'cbow_ns': (0, 0),
+    'sg_hs': (1, 1),
+    'cbow_hs': (0, 1),
+}
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--vocab_count", type=int, default=10000, help="vocabulary size")
+    parser.add_argument("--text_count", type=int, default=20000, help="the number of texts")
+    parser.add_argument("--text_length", type=int, default=50, help="the number of words per text")
+    parser.add_argument(
+        "--zipf_exponent", type=float, default=1.1, help="The exponent of the Zipf distribution")
+
+    parser.add_argument(
+        "--modes", type=str, nargs='+', default=['sg_ns', 'cbow_ns'], choices=list(MODES),
+        help="training modes to measure: skip-gram or CBOW with negative sampling or hierarchical softmax")
+    parser.add_argument("--window", type=int, default=5, help="The window size of skip-gram")
+    parser.add_argument("--size", type=int, default=100, help="The dimension of word representation")
+    parser.add_argument(
+        "--negative", type=int, default=5, help="The number per word of negative samples to use")
+    parser.add_argument(
+        "--sample", type=float, default=1e-3,
+        help="The threshold for downsampling higher-frequency words (0 to disable)")
+    parser.add_argument("--alpha", type=float, default=0.025, help="initial learning rate")
+    parser.add_argument("--min_alpha", type=float, default=0.0001, help="final learning rate")
+
+    parser.add_argument("--mb_size", type=int, default=512, help="minibatch size per thread")
+    parser.add_argument(
+        "--workers", type=int, nargs='+', default=[1, 2, 4], help="thread counts to measure")
+    parser.add_argument(
+        "--kernel_texts", type=int, default=2000,
+        help="the number of texts whose pairs the pair update kernels are measured on")
+    parser.add_argument(
+        "--numpy_texts", type=int, default=2000,
+        help="the number of texts the NumPy engine is measured on")
+    parser.add_argument("--skip_gensim", action='store_true', help="do not measure gensim")
+
+    parser.add_argument(
+        "--output", type=str, default='benchmark_w2v.json', help="path of the JSON report")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for initialization")
+
+    args = parser.parse_args()
+
+    return args
+
+def current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as _:
+            return int(_.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return float('nan')
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes.
+    return peak / 2 ** 20 if platform.system() == 'Darwin' else peak / 2 ** 10
+
+def run_case(func, *args) -> dict:
+    """
+    Run func(*args), which returns a dict of measurements, in a forked process and add the RSS
+    at its start, its peak RSS and their difference, the RSS the case adds, to the result. On
+    Linux the peak RSS of a forked process starts from the RSS it inherits. Without fork the case
+    runs in this process and the peak RSS covers everything measured so far, so the difference
+    only counts what the case adds beyond that peak.
+    """
+    def measure(connection=None):
+        rss_start = current_rss_mb()
+        result = func(*args)
+        peak_rss = peak_rss_mb()
+        result.update({
+            'rss_start_mb': rss_start, 'peak_rss_mb': peak_rss,
+            'case_rss_mb': max(peak_rss - rss_start, 0.0)})
+        if connection is None:
+            return result
+        connection.send(result)
+        connection.close()
+        return None
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return measure()
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=measure, args=(sender,))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    return result
+
+def measure_kernel(update_w, kernel, vocab_count, size, pairs, alpha, seed) -> dict:
+    if kernel is not None:
+        word2vec_impl_cython.set_kernel(kernel)
+    random_state = np.random.RandomState(seed)
+    w_in = (random_state.randn(vocab_count, size) * 0.1).astype(np.float32)
+    w_out = np.zeros((vocab_count, size), dtype=np.float32)
+    indices_in, indices_out, labels = pairs
+
+    start = time.perf_counter()
+    loss = update_w(w_in, w_out, indices_in, indices_out, labels, np.float32(alpha))
+    elapsed = time.perf_counter() - start
+
+    return {'pairs': len(labels), 'seconds': elapsed, 'pairs_per_sec': len(labels) / elapsed, 'loss': loss}
+
+def measure_engine(engine, kernel, mode, workers, dictionary, texts, args) -> dict:
+    """
+    Train one epoch of texts in minibatches like MyWord2Vec.train, with the learning rate decayed
+    over the epoch, through the given engine module.
+    """
+    if kernel is not None:
+        word2vec_impl_cython.set_kernel(kernel)
+    sg, hs = MODES[mode]
+    set_seed(args.seed)
+    w2v_model = MyWord2Vec(
+        dictionary, window=args.window, size=args.size, negative=args.negative, sample=args.sample,
+        sg=sg, hs=hs, alpha=args.alpha, min_alpha=args.min_alpha, workers=workers)
+    word_count = sum(len(text) for text in texts)
+    progress = engine.TrainingProgress(args.alpha, args.min_alpha, word_count)
+    if hs:
+        huffman_tree = engine.HuffmanTree([dictionary.dfs.get(i, 0) for i in range(len(dictionary))])
+        get_grad = engine.get_sg_hs_grad if sg else engine.get_cbow_hs_grad
+        sampling_args = (huffman_tree,)
+    else:
+        negative_sampler = engine.NegativeSampler(w2v_model.vocab_ns_prob)
+        get_grad = engine.get_sg_ns_grad if sg else engine.get_cbow_ns_grad
+        sampling_args = (args.negative, negative_sampler)
+
+    mb_size = args.mb_size * workers
+    pair_count, loss = 0, 0.0
+    start = time.perf_counter()
+    for i in range(0, len(texts), mb_size):
+        stats = get_grad(
+            texts[i: i + mb_size], args.window, *sampling_args,
+            w2v_model._w_in, w2v_model._w_out, np.float32(args.alpha), workers, # pylint: disable=protected-access
+            w2v_model.vocab_keep_prob, np.random.randint(1 << 31), progress)
+        pair_count += sum(stat['pairs'] for stat in stats)
+        loss += sum(stat['loss'] for stat in stats)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'words': word_count, 'pairs': pair_count, 'seconds': elapsed,
+        'words_per_sec': word_count / elapsed, 'pairs_per_sec': pair_count / elapsed,
+        'loss': loss / max(pair_count, 1),
+    }
+
+def measure_gensim(mode, workers, sentences, args) -> dict:
+    sg, hs = MODES[mode]
+    # gensim 4 renamed size to vector_size and iter to epochs.
+    if int(gensim.__version__.split('.')[0]) >= 4:
+        shape_args = {'vector_size': args.size, 'epochs': 1}
+    else:
+        shape_args = {'size': args.size, 'iter': 1}
+    w2v_model = Word2Vec(
+        sg=sg, hs=hs, window=args.window, negative=0 if hs else args.negative, sample=args.sample,
+        min_count=1, alpha=args.alpha, min_alpha=args.min_alpha, workers=workers, seed=args.seed,
+        **shape_args)
+    w2v_model.build_vocab(sentences)
+
+    word_count = sum(len(sentence) for sentence in sentences)
+    start = time.perf_counter()
+    w2v_model.train(sentences, total_examples=len(sentences), epochs=1)
+    elapsed = time.perf_counter() - start
+
+    return {'words': word_count, 'seconds': elapsed, 'words_per_sec': word_count / elapsed}
+
+def run():
+    set_logger()
+    args = get_args()
+    set_seed(args.seed)
+
+    logger.info('Generate a synthetic Zipfian corpus.')
+    dictionary, texts = make_zipf_corpus(
+        args.vocab_count, args.text_count, args.text_length, args.zipf_exponent)
+    kernels = word2vec_impl_cython.supported_kernels()
+    report = {
+        'config': vars(args),
+        'environment': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'gensim': gensim.__version__,
+            'native_engine': NATIVE_ENGINE,
+            'supported_kernels': kernels,
+        },
+        'kernels': [],
+        'engines': [],
+        'thread_scaling': [],
+        'gensim': [],
+    }
+
+    pairs = tuple(
+        values.tolist() for values in word2vec_impl_cython.get_sg_ns_pairs(
+            texts[:args.kernel_texts], args.window, args.negative,
+            word2vec_impl_cython.NegativeSampler(MyWord2Vec(dictionary, size=1).vocab_ns_prob), args.seed))
+    logger.info('Pair update kernels on %d pairs:', len(pairs[2]))
+    update_ws = [
+        ('numpy', word2vec_impl_numpy.update_w_numpy, None),
+        ('cython', word2vec_impl_cython.update_w_cython, None),
+        ('naive', word2vec_impl_cython.update_w_naive, None),
+        ('eigen', word2vec_impl_cython.update_w_eigen, None),
+    ]
+    if 'avx2' in kernels:
+        update_ws.append(('avx', word2vec_impl_cython.update_w_avx, None))
+    update_ws.extend(('simd_' + kernel, word2vec_impl_cython.update_w_simd, kernel) for kernel in kernels)
+    for name, update_w, kernel in update_ws:
+        result = run_case(
+            measure_kernel, update_w, kernel, len(dictionary), args.size, pairs, args.alpha, args.seed)
+        result['name'] = name
+        report['kernels'].append(result)
+        logger.info('  %-12s %12.0f pairs/sec', name, result['pairs_per_sec'])
+
+    logger.info('Training engines with 1 thread:')
+    engines = [('numpy', word2vec_impl_numpy, None, texts[:args.numpy_texts])]
+    engines.extend((kernel, word2vec_impl_cython, kernel, texts) for kernel in kernels)
+    for mode in args.modes:
+        for name, engine, kernel, engine_texts in engines:
+            result = run_case(measure_engine, engine, kernel, mode, 1, dictionary, engine_texts, args)
+            result.update({'engine': name, 'mode': mode})
+            report['engines'].append(result)
+            logger.info(
+                '  %-8s %-8s %10.0f words/sec %12.0f pairs/sec, loss %.4f, case RSS %.0f MB',
+                mode, name, result['words_per_sec'], result['pairs_per_sec'], result['loss'],
+                result['case_rss_mb'])
+
+    logger.info('Thread scaling with the %s kernel:', kernels[-1])
+    for mode in args.modes:
+        for workers in args.workers:
+            result = run_case(
+                measure_engine, word2vec_impl_cython, kernels[-1], mode, workers, dictionary, texts, args)
+            result.update({'engine': kernels[-1], 'mode': mode, 'workers': workers})
+            report['thread_scaling'].append(result)
+
+    if not args.skip_gensim:
+        logger.info('gensim %s:', gensim.__version__)
+        sentences = [[dictionary[index] for index in text] for text in texts]
+        for mode in args.modes:
+            for workers in args.workers:
+                result = run_case(measure_gensim, mode, workers, sentences, args)
+                result.update({'mode': mode, 'workers': workers})
+                report['gensim'].append(result)
+
+    for mode in args.modes:
+        for name in ['thread_scaling', 'gensim']:
+            results = [result for result in report[name] if result['mode'] == mode]
+            for result in results:
+                result['speedup'] = result['words_per_sec'] / results[0]['words_per_sec']
+                logger.info(
+                    '  %-8s %-14s workers: %2d, %10.0f words/sec (%.2fx), case RSS %.0f MB',
+                    mode, name, result['workers'], result['words_per_sec'], result['speedup'],
+                    result['case_rss_mb'])
+
+    with open(args.output, 'w') as _:
+        json.dump(report, _, indent=4)
+    logger.info('Wrote the report to %s.', args.output)
+
+if __name__ == '__main__':
+    run()
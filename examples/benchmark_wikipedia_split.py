@@ -0,0 +1,121 @@
+"""
+Measure the splitting of WikiExtractor shards into articles by WikipediaDataSet.load_file.
+
+A synthetic bz2 shard of --shard_mb MB is split by the streaming splitter
+(WikipediaDataSet.iter_articles), and smaller shards are split by the previous splitter, which read
+the whole shard and searched and sliced the remaining text once per article, so its time grows
+quadratically with the size of a shard. Tokenization is not measured.
+"""
+import logging
+import argparse
+import bz2
+import os
+import re
+import tempfile
+import time
+import numpy as np
+
+from mltools.utils import set_seed, set_logger
+from mltools.dataset.wikipedia_ja import WikipediaDataSet
+
+from benchmark_w2v_suite import run_case # pylint: disable=import-error
+
+logger = logging.getLogger(__name__)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--shard_mb", type=int, default=300,
+        help="the size in MB of the uncompressed shard to split with the streaming splitter")
+    parser.add_argument(
+        "--regex_shard_mb", type=int, nargs='+', default=[8, 16, 32],
+        help="the sizes in MB of the uncompressed shards to split with the previous splitter")
+    parser.add_argument(
+        "--article_kb", type=int, default=4, help="the mean size in KB of an article")
+    parser.add_argument(
+        "--work_dir", type=str, default=None,
+        help="the directory to write shards to (a temporary directory by default)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for initialization")
+
+    args = parser.parse_args()
+
+    return args
+
+def make_shard(file_path: str, size_mb: int, article_kb: int):
+    """
+    Write a bz2 shard in the format of WikiExtractor whose articles are paragraphs of random
+    hiragana, with exponentially distributed sizes.
+    """
+    chars = np.array([chr(code) for code in range(0x3041, 0x3094)] + ['。'])
+    with bz2.open(file_path, 'wt', encoding='utf-8') as _:
+        written = 0
+        doc_id = 0
+        while written < size_mb * 2 ** 20:
+            # A hiragana takes 3 bytes in UTF-8.
+            length = max(int(np.random.exponential(article_kb * 1024 / 3)), 1)
+            text = ''.join(np.random.choice(chars, length))
+            paragraphs = '\n\n'.join(text[i: i + 200] for i in range(0, length, 200))
+            article = '<doc id="{0}" url="https://ja.wikipedia.org/wiki?curid={0}" ' \
+                'title="title{0}">\ntitle{0}\n\n{1}\n</doc>\n'.format(doc_id, paragraphs)
+            _.write(article)
+            written += len(article.encode('utf-8'))
+            doc_id += 1
+
+def split_with_regex(file_path: str) -> dict:
+    with bz2.open(file_path, 'r') as _:
+        raw_articles = _.read().decode('utf-8')
+
+    article_count = 0
+    match = re.search(r'\<doc(.|\s)*?\</doc>\n', raw_articles)
+    while match:
+        start, end = match.span()
+        _article = raw_articles[start: end]
+        article_count += 1
+        raw_articles = raw_articles[end:]
+        match = re.search(r'\<doc(.|\s)*?\</doc>\n', raw_articles)
+
+    return {'articles': article_count}
+
+def split_with_stream(file_path: str) -> dict:
+    article_count = 0
+    with bz2.open(file_path, 'rt', encoding='utf-8') as _:
+        for _article in WikipediaDataSet.iter_articles(_):
+            article_count += 1
+
+    return {'articles': article_count}
+
+def measure(splitter, file_path: str, size_mb: int) -> dict:
+    def split():
+        start = time.perf_counter()
+        result = splitter(file_path)
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    result = run_case(split)
+    logger.info(
+        '%s, %d MB: %d articles in %.2f sec (%.1f MB/sec), case RSS: %.0f MB',
+        splitter.__name__, size_mb, result['articles'], result['seconds'],
+        size_mb / result['seconds'], result['case_rss_mb'])
+
+    return result
+
+def run():
+    set_logger()
+    args = get_args()
+    set_seed(args.seed)
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for size_mb in args.regex_shard_mb:
+            file_path = os.path.join(work_dir, 'wiki_regex_{}.bz2'.format(size_mb))
+            make_shard(file_path, size_mb, args.article_kb)
+            measure(split_with_stream, file_path, size_mb)
+            measure(split_with_regex, file_path, size_mb)
+
+        logger.info('Write a shard of %d MB.', args.shard_mb)
+        file_path = os.path.join(work_dir, 'wiki_stream.bz2')
+        make_shard(file_path, args.shard_mb, args.article_kb)
+        measure(split_with_stream, file_path, args.shard_mb)
+
+if __name__ == '__main__':
+    run()
@@ -18,16 +18,28 @@ def get_args():
         "--input_dir", type=str, help="input directory path", required=True)
     parser.add_argument(
         "--cache_dir", type=str, help="directory to cache data set", required=True)
+    parser.add_argument(
+        "--shuffle_buffer_size", type=int, default=100000,
+        help="the number of texts buffered to shuffle consecutive cached shards together")
     parser.add_argument("--model_name_to_save", type=str, help="model path to save")
 
+    parser.add_argument(
+        "--sg", type=int, default=1, choices=[0, 1], help="1 for skip-gram, 0 for CBOW")
     parser.add_argument("--window", type=int, default=5, help="The window size of skip-gram")
     parser.add_argument("--size", type=int, default=100, help="The dimension of word representation")
     parser.add_argument(
         "--negative", type=int, default=5, help="The number per word of negative samples to use")
+    parser.add_argument(
+        "--hs", type=int, default=0, choices=[0, 1],
+        help="1 for hierarchical softmax instead of negative sampling")
     parser.add_argument(
         "--ns_exponent", type=float, default=0.75,
         help="The exponent used to shape the negative sampling distribution.")
 
+    parser.add_argument(
+        "--sample", type=float, default=1e-3,
+        help="The threshold for downsampling higher-frequency words (0 to disable)")
+
     parser.add_argument(
         "--min_count", type=int, default=5,
         help="Ignores all words with total frequency lower than this")
@@ -52,22 +64,30 @@ def run():
 
     logger.info('Load Wikipedia articles in Japanese.')
 
-    data_set = WikipediaDataSet(args.input_dir, args.cache_dir)
+    data_set = WikipediaDataSet(
+        args.input_dir, args.cache_dir, workers=args.workers,
+        shuffle_buffer_size=args.shuffle_buffer_size)
 
     logger.info('Train gensim Word2Vec model.')
     w2v_model = Word2Vec(
+        sg=args.sg,
         window=args.window,
         size=args.size,
-        negative=args.negative,
+        negative=0 if args.hs else args.negative,
+        hs=args.hs,
         ns_exponent=args.ns_exponent,
+        sample=args.sample,
         min_count=args.min_count,
         alpha=args.alpha,
         min_alpha=args.min_alpha,
         iter=args.epochs,
         workers=args.workers,
         seed=args.seed)
-    w2v_model.build_vocab(list(data_set.get_text()))
-    w2v_model.train(list(data_set.get_text()), total_examples=len(data_set), epochs=args.epochs)
+    # The data set keeps the word counts of its cache and iterates over it once per epoch.
+    w2v_model.build_vocab_from_freq(
+        {word: data_set.dictionary.cfs[i] for word, i in data_set.dictionary.token2id.items()},
+        corpus_count=len(data_set))
+    w2v_model.train(data_set, total_examples=len(data_set), epochs=args.epochs)
 
     if args.model_name_to_save:
         logger.info('Save gensim Word2Vec model.')
@@ -3,7 +3,7 @@ Run my Word2Vec model.
 """
 import logging
 import argparse
-import dill
+import numpy as np
 from gensim.corpora import Dictionary
 from tqdm import tqdm
 
@@ -20,26 +20,53 @@ def get_args():
         "--input_dir", type=str, help="input directory path", required=True)
     parser.add_argument(
         "--cache_dir", type=str, help="directory to cache data set", required=True)
-    parser.add_argument("--model_name_to_save", type=str, help="model path to save")
+    parser.add_argument(
+        "--shuffle_buffer_size", type=int, default=100000,
+        help="the number of texts buffered to shuffle consecutive cached shards together")
+    parser.add_argument("--model_dir_to_save", type=str, help="model directory to save")
+    parser.add_argument(
+        "--model_dir_to_load", type=str,
+        help="model directory to continue training on the input articles with its vocabulary "
+        "grown by their words; the model options below are then taken from the saved model")
 
+    parser.add_argument(
+        "--sg", type=int, default=1, choices=[0, 1], help="1 for skip-gram, 0 for CBOW")
     parser.add_argument("--window", type=int, default=5, help="The window size of skip-gram")
     parser.add_argument("--size", type=int, default=100, help="The dimension of word representation")
     parser.add_argument(
         "--negative", type=int, default=5, help="The number per word of negative samples to use")
+    parser.add_argument(
+        "--hs", type=int, default=0, choices=[0, 1],
+        help="1 for hierarchical softmax instead of negative sampling")
     parser.add_argument(
         "--ns_exponent", type=float, default=0.75,
         help="The exponent used to shape the negative sampling distribution.")
 
+    parser.add_argument(
+        "--shared_negatives", type=int, default=0,
+        help="The number of consecutive center words sharing negative samples in skip-gram, "
+        "trained with matrix products (0 to sample them per pair)")
+
+    parser.add_argument(
+        "--sample", type=float, default=1e-3,
+        help="The threshold for downsampling higher-frequency words (0 to disable)")
+
     parser.add_argument(
         "--min_count", type=int, default=5,
         help="Ignores all words with total frequency lower than this")
+    parser.add_argument(
+        "--storage", type=str, default='float32', choices=['float32', 'float16', 'bfloat16'],
+        help="The element type of the embeddings; half precision halves their memory")
 
     parser.add_argument(
-        "--alpha", type=float, default=0.025, help="learning rate in the final epoch")
+        "--alpha", type=float, default=0.025, help="initial learning rate")
     parser.add_argument(
         "--min_alpha", type=float, default=0.0001, help="learning rate in the final epoch")
 
     parser.add_argument("--epochs", type=int, default=20, help="epoch count")
+    parser.add_argument(
+        "--id_cache", action='store_true',
+        help="cache the articles as memory-mapped token ids and train on them")
     parser.add_argument("--mb_size", type=int, default=512, help="minibatch size")
     parser.add_argument("--workers", type=int, default=1, help="the number of core to use")
     parser.add_argument("--seed", type=int, help="random seed for initialization")
@@ -55,38 +82,59 @@ def run():
 
     logger.info('Load Wikipedia articles in Japanese.')
 
-    data_set = WikipediaDataSet(args.input_dir, args.cache_dir)
+    data_set = WikipediaDataSet(
+        args.input_dir, args.cache_dir, workers=args.workers, id_cache=args.id_cache,
+        shuffle_buffer_size=args.shuffle_buffer_size)
     data_loader = WikipediaDataLoader(data_set, args.mb_size * args.workers)
 
     dictionary: Dictionary = data_set.dictionary
     dictionary.filter_extremes(no_below=args.min_count, no_above=0.999)
-    w2v_model = MyWord2Vec(
-        dictionary=dictionary,
-        window=args.window,
-        size=args.size,
-        negative=args.negative,
-        ns_exponent=args.ns_exponent,
-        alpha=args.alpha,
-        workers=args.workers)
+    if args.model_dir_to_load:
+        logger.info('Load my Word2Vec model and add the new words to its vocabulary.')
+        w2v_model = MyWord2Vec.load(args.model_dir_to_load, mmap=False)
+        w2v_model.update_vocab(dictionary)
+    else:
+        w2v_model = MyWord2Vec(
+            dictionary=dictionary,
+            sg=args.sg,
+            window=args.window,
+            size=args.size,
+            negative=args.negative,
+            hs=args.hs,
+            ns_exponent=args.ns_exponent,
+            sample=args.sample,
+            alpha=args.alpha,
+            min_alpha=args.min_alpha,
+            workers=args.workers,
+            storage=args.storage,
+            shared_negatives=args.shared_negatives)
+
+    w2v_model.schedule_alpha(sum(dictionary.cfs.values()) * args.epochs)
+    dictionary = w2v_model.dictionary
 
     logger.info('Train my Word2Vec model.')
     for epoch in range(args.epochs):
         logger.info('Epoch: %d', epoch + 1)
 
-        w2v_model.wc = 0
+        w2v_model.reset_throughput()
+        losses = []
         with tqdm(total=len(data_set), desc="Train Word2Vec") as pbar:
-            for mb_texts in data_loader.get_iter():
-                mb_indexed_texts = [dictionary.doc2idx(text) for text in mb_texts]
-                w2v_model.train(mb_indexed_texts)
-
-                w2v_model.lr = \
-                    args.alpha - ((args.alpha - args.min_alpha) * (epoch + 1) / args.epochs)
-                pbar.update(len(mb_indexed_texts))
-
-        if args.model_name_to_save:
+            for mb_tokens, mb_offsets in data_loader.get_csr_iter(dictionary):
+                losses.append(w2v_model.train((mb_tokens, mb_offsets)))
+                pbar.set_postfix(
+                    loss=losses[-1], alpha=w2v_model.alpha,
+                    words_per_sec=w2v_model.progress.words_per_sec)
+                pbar.update(len(mb_offsets) - 1)
+
+        logger.info('Loss: %f', np.mean(losses))
+        throughput = w2v_model.throughput()
+        logger.info(
+            'Throughput: %.0f words/sec in total, %s words/sec per thread',
+            sum(throughput), ', '.join('{:.0f}'.format(value) for value in throughput))
+
+        if args.model_dir_to_save:
             logger.info('Save my Word2Vec model.')
-            with open(args.model_name_to_save, 'wb') as _:
-                dill.dump(w2v_model, _)
+            w2v_model.save(args.model_dir_to_save)
 
 if __name__ == '__main__':
     run()
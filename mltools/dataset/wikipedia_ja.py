@@ -2,10 +2,14 @@
 Define a Data Set Class to Preprocess Japanese Wikipedia.
 """
 
+from typing import Dict, Iterable, Iterator, List, Tuple
 import os
 import bz2
+import json
 import logging
-import re
+import multiprocessing
+import queue
+import threading
 import dill
 import numpy as np
 from gensim.corpora import Dictionary
@@ -14,15 +18,64 @@ import MeCab
 
 logger = logging.getLogger(__name__)
 
+# The vocabulary size above which the dictionary keeps only its most frequent words, as the default
+# of Dictionary.add_documents.
+PRUNE_AT = 2000000
+
+# The files in the cache directory holding the dictionary of the cached shards, which also indexes
+# the token id cache, and the manifest of the shards it was built from.
+DICTIONARY_FILE_NAME = 'dictionary.pkl'
+MANIFEST_FILE_NAME = 'manifest.json'
+
+_tokenizer = None
+
+def _load_shard(paths: Tuple[str, str]) -> Dictionary:
+    global _tokenizer # pylint: disable=global-statement
+    if _tokenizer is None:
+        _tokenizer = MeCab.Tagger('-Ochasen')
+    return WikipediaDataSet.load_shard(_tokenizer, *paths)
+
+def _file_stat(file_path: str) -> List[int]:
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _save_array(file_path: str, array: np.ndarray):
+    with open(file_path + '.tmp', 'wb') as _:
+        np.save(_, array)
+    os.replace(file_path + '.tmp', file_path)
+
+def texts_to_csr(texts: List[List[str]], token2id: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Index texts by token2id in CSR layout: text i is tokens[offsets[i]: offsets[i + 1]] of an
+    int32 token array holding -1 for unknown words, and offsets is an int64 array.
+    """
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+    tokens = np.fromiter(
+        (token2id.get(word, -1) for text in texts for word in text),
+        dtype=np.int32, count=offsets[-1])
+    return tokens, offsets
+
 class WikipediaDataSet:
-    def __init__(self, src_dir_path: str, cache_dir_path: str):
+    def __init__(
+            self, src_dir_path: str, cache_dir_path: str, workers: int = 1, id_cache: bool = False,
+            shuffle_buffer_size: int = 100000):
+        if shuffle_buffer_size < 1:
+            raise ValueError('shuffle_buffer_size must be positive.')
+
         self.src_dir_path = src_dir_path
         self.cache_dir_path = cache_dir_path
+        self.shuffle_buffer_size = shuffle_buffer_size
         self.dictionary = Dictionary()
         self.cache_file_paths = []
+        self.manifest = None
+        # The words of the dictionary indexing the token id cache by their ids, if it is built.
+        self.id_tokens = None
+        self.id_cache_file_paths = []
 
-        tokenizer = MeCab.Tagger('-Ochasen')
-        self.load_file(tokenizer)
+        self.load_file(workers)
+        if id_cache:
+            self.build_id_cache()
 
     @staticmethod
     def tokenize(tokenizer: MeCab.Tagger, text):
@@ -35,57 +88,254 @@ class WikipediaDataSet:
         return words
 
     @staticmethod
-    def article_to_words(tokenizer: MeCab.Tagger, article: str):
-        match = re.search(r'\<doc(.|\s)*?\>\n', article)
-        article = article[match.end():]
-        match = re.search(r'\</doc>', article)
-        article = article[:match.start()]
+    def iter_articles(lines: Iterable[str]) -> Iterator[List[str]]:
+        """
+        Yield the lines of each article of a WikiExtractor output between its <doc ...> and </doc>
+        lines, without line breaks. The lines are consumed one by one, e.g. from a decompressing
+        stream, so only the current article is held in memory.
+        """
+        article = None
+        for line in lines:
+            if article is None:
+                if line.startswith('<doc'):
+                    article = []
+            elif line.startswith('</doc>'):
+                yield article
+                article = None
+            else:
+                article.append(line.rstrip('\n'))
 
+    @staticmethod
+    def article_to_words(tokenizer: MeCab.Tagger, article: List[str]):
         texts = []
-        for line in article.split('\n'):
+        for line in article:
             if not line:
                 continue
             texts.append(WikipediaDataSet.tokenize(tokenizer, line))
 
         return texts
 
-    def load_file(self, tokenizer: MeCab.Tagger):
+    @staticmethod
+    def load_shard(tokenizer: MeCab.Tagger, subdir_path: str, cache_file_path: str) -> Dictionary:
+        """
+        Tokenize the WikiExtractor outputs in subdir_path into the cache file unless it exists, and
+        return the Dictionary of the shard. The cache file is renamed into place once complete, so
+        an interrupted build resumes from the shards which are not cached yet.
+        """
+        if os.path.exists(cache_file_path):
+            with open(cache_file_path, 'rb') as _:
+                texts = dill.load(_)
+        else:
+            texts = []
+            for file_name in os.listdir(subdir_path):
+                file_path = os.path.join(subdir_path, file_name)
+                with bz2.open(file_path, 'rt', encoding='utf-8') as _:
+                    for article in WikipediaDataSet.iter_articles(_):
+                        texts += WikipediaDataSet.article_to_words(tokenizer, article)
+
+            with open(cache_file_path + '.tmp', 'wb') as _:
+                dill.dump(texts, _)
+            os.replace(cache_file_path + '.tmp', cache_file_path)
+            logger.info('Cached %d texts of %s.', len(texts), subdir_path)
+
+        return Dictionary(texts, prune_at=None)
+
+    def load_file(self, workers: int = 1):
+        """
+        Load the shards, one per subdirectory of src_dir_path. If the manifest in the cache
+        directory lists the same source files, by size and modification time, and cache files, the
+        saved dictionary is loaded instead. Otherwise the shards are loaded or built with a pool of
+        that many processes when workers > 1, each with its own tokenizer, their dictionaries are
+        merged in the order of the subdirectories, and the dictionary and the manifest are saved.
+        """
         os.makedirs(self.cache_dir_path, exist_ok=True)
 
-        for subdir_name in os.listdir(self.src_dir_path):
-            subdir_path = os.path.join(self.src_dir_path, subdir_name)
-            file_path_to_save = os.path.join(self.cache_dir_path, subdir_name)
-            if os.path.exists(file_path_to_save):
-                with open(file_path_to_save, 'rb') as _:
+        subdir_names = sorted(os.listdir(self.src_dir_path))
+        paths = [
+            (os.path.join(self.src_dir_path, subdir_name),
+             os.path.join(self.cache_dir_path, subdir_name))
+            for subdir_name in subdir_names
+        ]
+        sources = [
+            sorted([file_name] + _file_stat(os.path.join(subdir_path, file_name))
+                   for file_name in os.listdir(subdir_path))
+            for subdir_path, _ in paths
+        ]
+        self.cache_file_paths = [cache_file_path for _, cache_file_path in paths]
+
+        dictionary_path = os.path.join(self.cache_dir_path, DICTIONARY_FILE_NAME)
+        manifest_path = os.path.join(self.cache_dir_path, MANIFEST_FILE_NAME)
+        old_manifest = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as _:
+                old_manifest = json.load(_)
+            if self.is_cached(old_manifest, subdir_names, sources):
+                logger.info('Load the dictionary of the cached shards.')
+                self.dictionary = Dictionary.load(dictionary_path)
+                self.manifest = old_manifest
+                return
+            self.remove_stale_shards(old_manifest, subdir_names, sources)
+            # The id cache is only valid with the manifest, so drop it before the dictionary.
+            os.remove(manifest_path)
+
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                shards = self.add_shards(pool.imap(_load_shard, paths))
+        else:
+            shards = self.add_shards(map(_load_shard, paths))
+
+        id_cache = False
+        if os.path.exists(dictionary_path):
+            id_cache = bool(old_manifest and old_manifest['id_cache']) and \
+                Dictionary.load(dictionary_path).token2id == self.dictionary.token2id
+        self.dictionary.save(dictionary_path)
+        self.manifest = {
+            'shards': [
+                dict(name=subdir_name, sources=source, cache=_file_stat(cache_file_path), **shard)
+                for subdir_name, source, cache_file_path, shard
+                in zip(subdir_names, sources, self.cache_file_paths, shards)
+            ],
+            'id_cache': id_cache
+        }
+        self.save_manifest()
+
+    def is_cached(self, manifest: dict, subdir_names: List[str], sources: List[list]) -> bool:
+        shards = manifest['shards']
+        if [shard['name'] for shard in shards] != subdir_names or \
+                [shard['sources'] for shard in shards] != sources:
+            return False
+        for shard, cache_file_path in zip(shards, self.cache_file_paths):
+            if not os.path.exists(cache_file_path) or shard['cache'] != _file_stat(cache_file_path):
+                return False
+        return os.path.exists(os.path.join(self.cache_dir_path, DICTIONARY_FILE_NAME))
+
+    def remove_stale_shards(self, manifest: dict, subdir_names: List[str], sources: List[list]):
+        """
+        Remove the cache files of the shards whose source files changed since the manifest, and the
+        token id arrays of the shards whose cache file changed or which are not in the manifest.
+        """
+        shards = {shard['name']: shard for shard in manifest['shards']}
+        for subdir_name, source, cache_file_path in zip(subdir_names, sources, self.cache_file_paths):
+            shard = shards.get(subdir_name)
+            file_paths = [cache_file_path + '.tokens.npy', cache_file_path + '.offsets.npy']
+            if shard is not None and shard['sources'] != source:
+                file_paths.append(cache_file_path)
+            elif shard is not None and os.path.exists(cache_file_path) and \
+                    shard['cache'] == _file_stat(cache_file_path):
+                continue
+            for file_path in file_paths:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+    def save_manifest(self):
+        manifest_path = os.path.join(self.cache_dir_path, MANIFEST_FILE_NAME)
+        with open(manifest_path + '.tmp', 'w') as _:
+            json.dump(self.manifest, _, indent=4)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def add_shards(self, shard_dictionaries: Iterable[Dictionary]) -> List[dict]:
+        """
+        Merge the dictionaries of the shards into the dictionary and return the text and token
+        counts of the shards.
+        """
+        shards = []
+        for shard_dictionary in shard_dictionaries:
+            old2new = self.dictionary.merge_with(shard_dictionary).old2new
+            for old_id, count in shard_dictionary.cfs.items():
+                new_id = old2new[old_id]
+                self.dictionary.cfs[new_id] = self.dictionary.cfs.get(new_id, 0) + count
+            if len(self.dictionary) > PRUNE_AT:
+                self.dictionary.filter_extremes(no_below=0, no_above=1.0, keep_n=PRUNE_AT)
+            shards.append({'texts': shard_dictionary.num_docs, 'tokens': shard_dictionary.num_pos})
+        return shards
+
+    def build_id_cache(self):
+        """
+        Write the texts of each shard indexed by the dictionary in CSR layout (see texts_to_csr) to
+        <shard>.tokens.npy and <shard>.offsets.npy, so get_id_shards memory-maps them. Existing
+        arrays are kept if the manifest records that they index the saved dictionary.
+        """
+        stale = not self.manifest['id_cache']
+        for cache_file_path in self.cache_file_paths:
+            tokens_path = cache_file_path + '.tokens.npy'
+            offsets_path = cache_file_path + '.offsets.npy'
+            if stale or not os.path.exists(tokens_path) or not os.path.exists(offsets_path):
+                with open(cache_file_path, 'rb') as _:
                     texts = dill.load(_)
-            else:
-                texts = []
-                for file_name in os.listdir(subdir_path):
-                    file_path = os.path.join(subdir_path, file_name)
-                    with bz2.open(file_path, 'r') as _:
-                        raw_articles = _.read().decode('utf-8')
-
-                    match = re.search(r'\<doc(.|\s)*?\</doc>\n', raw_articles)
-                    while match:
-                        start, end = match.span()
-                        article = raw_articles[start: end]
-                        texts += WikipediaDataSet.article_to_words(tokenizer, article)
-                        raw_articles = raw_articles[end:]
-                        match = re.search(r'\<doc(.|\s)*?\</doc>\n', raw_articles)
+                tokens, offsets = texts_to_csr(texts, self.dictionary.token2id)
+                _save_array(tokens_path, tokens)
+                _save_array(offsets_path, offsets)
+            self.id_cache_file_paths.append((tokens_path, offsets_path))
 
-                file_path_to_save = os.path.join(self.cache_dir_path, subdir_name)
-                with open(file_path_to_save, 'wb') as _:
-                    dill.dump(texts, _)
+        if stale:
+            self.manifest['id_cache'] = True
+            self.save_manifest()
+        self.id_tokens = [self.dictionary[i] for i in range(len(self.dictionary))]
 
-            self.dictionary.add_documents(texts)
-            self.cache_file_paths.append(file_path_to_save)
+    def get_id_shards(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Yield the memory-mapped token ids and offsets of the shards in random order.
+        """
+        for i in np.random.permutation(len(self.id_cache_file_paths)):
+            tokens_path, offsets_path = self.id_cache_file_paths[i]
+            yield np.load(tokens_path, mmap_mode='r'), np.load(offsets_path, mmap_mode='r')
 
     def get_text(self):
-        for file_path_to_load in np.random.permutation(self.cache_file_paths):
-            with open(file_path_to_load, 'rb') as _:
-                texts = dill.load(_)
-            for text in np.random.permutation(texts):
-                yield text
+        """
+        Yield the texts of the shards in random order. A background thread loads the next shard
+        while the current one is consumed. The texts of a shard pass in random order through a
+        buffer of shuffle_buffer_size texts, which yields a random one for each new text and so
+        mixes consecutive shards.
+        """
+        file_paths_to_load = np.random.permutation(self.cache_file_paths)
+        shards = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def load_shards():
+            try:
+                for file_path_to_load in file_paths_to_load:
+                    if stop.is_set():
+                        return
+                    with open(file_path_to_load, 'rb') as _:
+                        shards.put(dill.load(_))
+            except Exception as error: # pylint: disable=broad-except
+                shards.put(error)
+                return
+            shards.put(None)
+
+        thread = threading.Thread(target=load_shards, daemon=True)
+        thread.start()
+        try:
+            buffer = []
+            texts = shards.get()
+            while texts is not None:
+                if isinstance(texts, Exception):
+                    raise texts
+                order = np.random.permutation(len(texts)).tolist()
+                draws = np.random.randint(0, self.shuffle_buffer_size, len(texts)).tolist()
+                for i, j in zip(order, draws):
+                    if len(buffer) < self.shuffle_buffer_size:
+                        buffer.append(texts[i])
+                    else:
+                        yield buffer[j]
+                        buffer[j] = texts[i]
+                # Release the shard while the next one is awaited.
+                texts = None
+                texts = shards.get()
+
+            for i in np.random.permutation(len(buffer)).tolist():
+                yield buffer[i]
+        finally:
+            # Unblock the thread if the texts are not consumed to the end.
+            stop.set()
+            while thread.is_alive():
+                try:
+                    shards.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def __iter__(self):
+        return self.get_text()
 
     def __len__(self) -> int:
         return self.dictionary.num_docs
@@ -103,3 +353,38 @@ class WikipediaDataLoader:
                 yield texts
                 texts = []
         yield texts
+
+    def get_csr_iter(self, dictionary: Dictionary):
+        """
+        Yield the minibatches of get_iter indexed by dictionary in CSR layout (see texts_to_csr),
+        which MyWord2Vec.train reads without copying. With the token id cache of the data set, the
+        minibatches are gathered from its shards instead and do not span shards.
+        """
+        if self.data_set.id_tokens is not None:
+            yield from self.get_id_cache_iter(dictionary)
+            return
+
+        for texts in self.get_iter():
+            yield texts_to_csr(texts, dictionary.token2id)
+
+    def get_id_cache_iter(self, dictionary: Dictionary):
+        token2id = dictionary.token2id
+        id_tokens = self.data_set.id_tokens
+        # The last entry maps -1, the words pruned from the dictionary of the cache, to -1.
+        id_map = np.array([token2id.get(token, -1) for token in id_tokens] + [-1], dtype=np.int32)
+        if np.array_equal(id_map[:-1], np.arange(len(id_tokens))):
+            id_map = None
+
+        for shard_tokens, shard_offsets in self.data_set.get_id_shards():
+            order = np.random.permutation(len(shard_offsets) - 1)
+            for i in range(0, len(order), self.mb_size):
+                starts = shard_offsets[order[i: i + self.mb_size]]
+                lengths = shard_offsets[order[i: i + self.mb_size] + 1] - starts
+                offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+                np.cumsum(lengths, out=offsets[1:])
+                # The position in the shard of every token of the minibatch.
+                positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+                tokens = np.asarray(shard_tokens[positions])
+                if id_map is not None:
+                    tokens = id_map[tokens]
+                yield tokens, offsets
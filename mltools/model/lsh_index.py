@@ -0,0 +1,114 @@
+"""
+Define an approximate nearest neighbour index for cosine similarity using random projections.
+"""
+from typing import Optional
+import os
+import json
+import numpy as np
+
+class LSHIndex:
+    """
+    Random-hyperplane LSH forest. Every table hashes a vector to the signs of its projections on
+    n_bits random hyperplanes and keeps the vector ids sorted by hash code, so that a bucket is a
+    contiguous slice found by binary search. A query probes its own bucket and the buckets obtained
+    by flipping its least certain bits, then the candidates are reranked exactly.
+    """
+    def __init__(self, planes: np.ndarray, sorted_codes: np.ndarray, orders: np.ndarray):
+        self.planes = planes
+        self.sorted_codes = sorted_codes
+        self.orders = orders
+
+    @property
+    def n_tables(self) -> int:
+        return self.planes.shape[0]
+
+    @property
+    def n_bits(self) -> int:
+        return self.planes.shape[1]
+
+    @classmethod
+    def build(
+            cls,
+            vectors: np.ndarray,
+            n_tables: int = 8,
+            n_bits: Optional[int] = None,
+            seed: Optional[int] = None) -> 'LSHIndex':
+        """
+        Build an index of vectors with the shape (count, dim). By default n_bits is chosen so that
+        a bucket holds about 32 vectors.
+        """
+        count, dim = vectors.shape
+        if n_bits is None:
+            n_bits = int(np.clip(np.log2(max(count / 32, 2)), 1, 30))
+
+        planes = np.random.RandomState(seed).randn(n_tables, n_bits, dim).astype(np.float32)
+        sorted_codes = np.empty((n_tables, count), dtype=np.uint32)
+        orders = np.empty((n_tables, count), dtype=np.int32)
+        for table in range(n_tables):
+            codes = cls._to_codes(np.matmul(vectors, planes[table].T))
+            orders[table] = np.argsort(codes, kind='stable')
+            sorted_codes[table] = codes[orders[table]]
+
+        return cls(planes, sorted_codes, orders)
+
+    @staticmethod
+    def _to_codes(projections: np.ndarray) -> np.ndarray:
+        weights = np.left_shift(1, np.arange(projections.shape[-1], dtype=np.uint32))
+        return np.sum((projections > 0) * weights, axis=-1, dtype=np.uint32)
+
+    def candidates(self, vector: np.ndarray, probes: int = 2) -> np.ndarray:
+        """
+        Return the ids in the buckets of vector and in the buckets at Hamming distance one along its
+        `probes` least certain bits, in every table.
+        """
+        projections = np.matmul(self.planes, vector)
+        codes = self._to_codes(projections)
+
+        probes = min(probes, self.n_bits)
+        flipped_bits = np.argsort(np.abs(projections), axis=1)[:, :probes].astype(np.uint32)
+        probe_codes = np.concatenate(
+            [codes[:, None], codes[:, None] ^ np.left_shift(np.uint32(1), flipped_bits)], axis=1)
+
+        ids = []
+        for table in range(self.n_tables):
+            lefts = np.searchsorted(self.sorted_codes[table], probe_codes[table], side='left')
+            rights = np.searchsorted(self.sorted_codes[table], probe_codes[table], side='right')
+            for left, right in zip(lefts, rights):
+                ids.append(self.orders[table, left: right])
+
+        return np.unique(np.concatenate(ids))
+
+    def search(
+            self,
+            vector: np.ndarray,
+            vectors: np.ndarray,
+            topn: int = 10,
+            probes: int = 2) -> np.ndarray:
+        """
+        Return the ids of the approximately topn most cosine-similar rows of vectors, the matrix
+        the index was built from, in descending order of similarity.
+        """
+        ids = self.candidates(vector, probes)
+        candidates = vectors[ids]
+        cos_sim = np.matmul(candidates, vector) / np.linalg.norm(vector, ord=2) / \
+            np.maximum(np.linalg.norm(candidates, ord=2, axis=1), 1e-12)
+
+        top = np.argsort(cos_sim)[::-1][:topn]
+        return ids[top]
+
+    def save(self, dir_path: str):
+        os.makedirs(dir_path, exist_ok=True)
+        np.save(os.path.join(dir_path, 'planes.npy'), self.planes)
+        np.save(os.path.join(dir_path, 'sorted_codes.npy'), self.sorted_codes)
+        np.save(os.path.join(dir_path, 'orders.npy'), self.orders)
+        with open(os.path.join(dir_path, 'config.json'), 'w') as _:
+            json.dump({'n_tables': self.n_tables, 'n_bits': self.n_bits}, _, indent=4)
+
+    @classmethod
+    def load(cls, dir_path: str, mmap: bool = True) -> 'LSHIndex':
+        mmap_mode = 'r' if mmap else None
+        return cls(
+            np.load(os.path.join(dir_path, 'planes.npy')),
+            np.load(os.path.join(dir_path, 'sorted_codes.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(dir_path, 'orders.npy'), mmap_mode=mmap_mode),
+        )
@@ -1,13 +1,40 @@
 """
-Define an original Word2Vec model using skipgram and negative sampling.
+Define an original Word2Vec model using skipgram or CBOW and negative sampling or hierarchical
+softmax.
 """
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
+import os
+import copy
+import json
+import shutil
+import logging
 import numpy as np
 from gensim.corpora import Dictionary
 
-# from mltools.model.word2vec_impl.word2vec_impl_cython import get_sg_ns_grad # pylint: disable=import-error,no-name-in-module
-# from mltools.model.word2vec_impl.word2vec_impl_cpp_naive import get_sg_ns_grad # pylint: disable=import-error,no-name-in-module
-from mltools.model.word2vec_impl.word2vec_impl_cpp_eigen import get_sg_ns_grad # pylint: disable=import-error,no-name-in-module
+from mltools.model.lsh_index import LSHIndex
+from mltools.model.word2vec_impl.word2vec_impl_numpy import STORAGE_DTYPES, from_float32
+
+logger = logging.getLogger(__name__)
+
+try:
+    from mltools.model.word2vec_impl.word2vec_impl_cython \
+        import NegativeSampler, HuffmanTree, TrainingProgress, get_sg_ns_grad, get_cbow_ns_grad, \
+        get_sg_hs_grad, get_cbow_hs_grad, to_float32 # pylint: disable=import-error,no-name-in-module
+    NATIVE_ENGINE = True
+except ImportError:
+    logger.warning(
+        'The native word2vec extension is not built; falling back to the much slower NumPy '
+        'engine. Run `python setup.py build_ext --inplace` to build it.')
+    from mltools.model.word2vec_impl.word2vec_impl_numpy \
+        import NegativeSampler, HuffmanTree, TrainingProgress, get_sg_ns_grad, get_cbow_ns_grad, \
+        get_sg_hs_grad, get_cbow_hs_grad, to_float32
+    NATIVE_ENGINE = False
+
+# Half-precision embeddings are decoded to float32 this many rows at a time for queries.
+SCORE_BLOCK_ROWS = 16384
+# update_vocab over-allocates the embedding rows by this factor, so growing the vocabulary one dump
+# at a time copies each row a constant number of times on average.
+VOCAB_GROWTH_FACTOR = 1.5
 
 class MyWord2Vec:
     def __init__(
@@ -17,19 +44,113 @@ class MyWord2Vec:
             size: int = 100,
             negative: int = 5,
             ns_exponent: float = 0.75,
+            sample: float = 1e-3,
+            sg: int = 1,
             alpha: float = 0.025,
-            workers: int = 4):
+            workers: int = 4,
+            hs: int = 0,
+            min_alpha: float = 0.0001,
+            storage: str = 'float32',
+            shared_negatives: int = 0):
+        """
+        storage is the element type of the embeddings: 'float32', or 'float16' or 'bfloat16' to
+        halve their memory. Training and queries compute in float32 either way.
+
+        shared_negatives > 0 lets every block of that many consecutive center words share one draw
+        of negative samples in skip-gram with negative sampling. The negatives of a block are then
+        scored and updated with matrix products through Eigen, reading each negative row once per
+        block instead of once per center. This pays off when the rows do not fit in the caches,
+        i.e. with large vocabularies; with small ones the vectorized pair kernels are as fast or
+        faster. Each center still meets `negative` negatives, but they are correlated within a
+        block and see the weights from before it, so large blocks change the training dynamics;
+        compare the neighbours on the target corpus, e.g. with
+        examples/benchmark_w2v_shared_negatives.py, before enabling it.
+        """
+        if storage not in STORAGE_DTYPES:
+            raise ValueError('storage must be one of {}.'.format(', '.join(STORAGE_DTYPES)))
+        if shared_negatives and (not sg or hs):
+            raise ValueError('shared_negatives applies to skip-gram with negative sampling only.')
         self.window = window
         self.negative = negative
         self.ns_exponent = ns_exponent
+        self.sample = sample
+        self.sg = sg
+        self.hs = hs
         self.lr = np.float32(alpha)
+        self.min_alpha = min_alpha
         self.workers = workers
+        self.storage = storage
+        self.shared_negatives = shared_negatives
+        self.progress = None
 
         self._dictionary = dictionary
         self._size = size
 
-        self._w_in = np.random.randn(self._size, self.vocab_count).astype(np.float32)
-        self._w_out = np.random.randn(self.vocab_count, self._size).astype(np.float32)
+        shape, dtype = (self.vocab_count, self._size), STORAGE_DTYPES[storage]
+        self._w_in = from_float32(np.random.randn(*shape).astype(np.float32), dtype)
+        self._w_out = from_float32(np.random.randn(*shape).astype(np.float32), dtype)
+
+        self.reset_throughput()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The native negative sampler and Huffman tree are rebuilt from the dictionary on demand.
+        state.pop('_negative_sampler', None)
+        state.pop('_huffman_tree', None)
+        state.pop('_normalized_w_in', None)
+        # Only the rows in use are pickled, through the _w_in and _w_out views.
+        state.pop('_w_in_buffer', None)
+        state.pop('_w_out_buffer', None)
+        # The learning-rate schedule holds native counters and is not pickled.
+        state['progress'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Models pickled by earlier versions lack the later options; their defaults reproduce the
+        # training of those versions: skip-gram with negative sampling and a constant rate.
+        self.__dict__.setdefault('sample', 0)
+        self.__dict__.setdefault('sg', 1)
+        self.__dict__.setdefault('hs', 0)
+        self.__dict__.setdefault('min_alpha', float(self.lr))
+        self.__dict__.setdefault('progress', None)
+        self.__dict__.setdefault('storage', 'float32')
+        self.__dict__.setdefault('shared_negatives', 0)
+        if '_thread_words' not in state:
+            self.reset_throughput()
+        # Models pickled before _w_in became row-major hold it as (size, vocab_count).
+        if self._w_in.shape == (self._size, self.vocab_count) and self._size != self.vocab_count:
+            self._w_in = np.ascontiguousarray(self._w_in.T)
+
+    @property
+    def normalized_w_in(self) -> np.ndarray:
+        """
+        L2-normalized embeddings with the shape (vocab_count, size) in the storage dtype, cached
+        until the next train or vocabulary growth.
+        """
+        w_in = self._w_in
+        normalized_w_in = getattr(self, '_normalized_w_in', None)
+        if normalized_w_in is None or len(normalized_w_in) != len(w_in):
+            normalized_w_in = np.empty(w_in.shape, dtype=w_in.dtype)
+            for start in range(0, len(w_in), SCORE_BLOCK_ROWS):
+                block = slice(start, start + SCORE_BLOCK_ROWS)
+                rows = np.array(to_float32(w_in[block]))
+                rows /= np.maximum(np.linalg.norm(rows, ord=2, axis=1, keepdims=True), 1e-12)
+                normalized_w_in[block] = from_float32(rows, w_in.dtype)
+            self._normalized_w_in = normalized_w_in #pylint: disable=attribute-defined-outside-init
+        return normalized_w_in
+
+    @property
+    def ann_index(self) -> Optional[LSHIndex]:
+        return getattr(self, '_ann_index', None)
+
+    @property
+    def dictionary(self) -> Dictionary:
+        """
+        The vocabulary of the model, to index the texts to train on. Do not modify it in place;
+        call update_vocab to add words.
+        """
+        return self._dictionary
 
     @property
     def vocab_count(self) -> int:
@@ -44,38 +165,349 @@ class MyWord2Vec:
             self._vocab_ns_prob = vocab_ns_prob.tolist() #pylint: disable=attribute-defined-outside-init
         return self._vocab_ns_prob
 
-    def train(self, texts: List[List[int]]):
-        get_sg_ns_grad(
-            texts, self.window, self.negative, self.vocab_ns_prob, self._w_in, self._w_out, self.lr)
+    @property
+    def negative_sampler(self) -> NegativeSampler:
+        if not hasattr(self, '_negative_sampler'):
+            self._negative_sampler = NegativeSampler(self.vocab_ns_prob) #pylint: disable=attribute-defined-outside-init
+        return self._negative_sampler
+
+    @property
+    def huffman_tree(self) -> HuffmanTree:
+        """
+        Huffman coding of the vocabulary by document frequency for hierarchical softmax. With hs,
+        row n of _w_out holds inner node n of the tree instead of the output vector of word n.
+        """
+        if not hasattr(self, '_huffman_tree'):
+            self._huffman_tree = HuffmanTree( #pylint: disable=attribute-defined-outside-init
+                [self._dictionary.dfs.get(i, 0) for i in range(self.vocab_count)])
+        return self._huffman_tree
+
+    @property
+    def vocab_keep_prob(self) -> Optional[np.ndarray]:
+        """
+        Probability of keeping each word under the frequent-word subsampling of Mikolov et al.,
+        from the share of the word among all the tokens of the corpus, i.e. its collection
+        frequency, or its document frequency for dictionaries without collection frequencies.
+        None if subsampling is disabled.
+        """
+        if self.sample <= 0:
+            return None
+        if not hasattr(self, '_vocab_keep_prob'):
+            counts = self._dictionary.cfs or self._dictionary.dfs
+            freq = np.array([counts.get(i, 0) for i in range(self.vocab_count)])
+            threshold = self.sample * np.sum(freq)
+            keep_prob = (np.sqrt(freq / threshold) + 1) * threshold / np.maximum(freq, 1)
+            self._vocab_keep_prob = np.minimum(keep_prob, 1.0).astype(np.float32) #pylint: disable=attribute-defined-outside-init
+        return self._vocab_keep_prob
+
+    def update_vocab(self, new_dictionary: Dictionary):
+        """
+        Add the words of new_dictionary, built on a new corpus, to the vocabulary so that training
+        can continue on that corpus only, indexed with self.dictionary. Known words keep their
+        indices and embeddings, new words get random ones like at construction, and the document
+        and collection frequencies of both are summed for the negative sampler, the Huffman tree
+        and subsampling.
+
+        The embeddings grow into rows over-allocated by VOCAB_GROWTH_FACTOR. The new rows are
+        written before the grown matrices and then the new dictionary replace the old ones, so
+        queries running meanwhile in other threads see the old or the new vocabulary, never a mix;
+        training must not run meanwhile. With hs, the rebuilt tree reassigns the inner nodes to the
+        rows of _w_out, which then start from the vectors of the old ones as in gensim.
+        """
+        dictionary = copy.deepcopy(self._dictionary)
+        old2new = dictionary.merge_with(new_dictionary).old2new
+        if dictionary.cfs and new_dictionary.cfs:
+            for old_id, count in new_dictionary.cfs.items():
+                new_id = old2new[old_id]
+                dictionary.cfs[new_id] = dictionary.cfs.get(new_id, 0) + count
+        else:
+            # merge_with sums only the document frequencies, which subsampling then uses for all.
+            dictionary.cfs = {}
+        old_count, new_count = self.vocab_count, len(dictionary)
+
+        if new_count > old_count:
+            self._w_in = self._grow_rows('_w_in', new_count) #pylint: disable=attribute-defined-outside-init
+            self._w_out = self._grow_rows('_w_out', new_count) #pylint: disable=attribute-defined-outside-init
+        self._dictionary = dictionary
+
+        # The sampling structures are rebuilt from the new frequencies on the next train.
+        for name in ['_vocab_ns_prob', '_negative_sampler', '_huffman_tree', '_vocab_keep_prob']:
+            self.__dict__.pop(name, None)
+        # The index does not know the new words; the normalized embeddings are rebuilt on demand.
+        self._ann_index = None #pylint: disable=attribute-defined-outside-init
+        self._normalized_w_in = None #pylint: disable=attribute-defined-outside-init
+
+    def _grow_rows(self, name: str, row_count: int) -> np.ndarray:
+        """
+        Return the first row_count rows of the over-allocated buffer of the matrix name, after
+        reallocating the buffer if it is too small and filling the new rows with random values.
+        The rows in use are left untouched.
+        """
+        matrix = getattr(self, name)
+        buffer = getattr(self, name + '_buffer', None)
+        if buffer is None or len(buffer) < row_count or matrix.base is not buffer:
+            capacity = int(row_count * VOCAB_GROWTH_FACTOR)
+            buffer = np.empty((capacity, self._size), dtype=matrix.dtype)
+            buffer[:len(matrix)] = matrix
+            setattr(self, name + '_buffer', buffer)
+        buffer[len(matrix): row_count] = from_float32(
+            np.random.randn(row_count - len(matrix), self._size).astype(np.float32), matrix.dtype)
+        return buffer[:row_count]
+
+    def schedule_alpha(self, total_words: int):
+        """
+        Decay the learning rate linearly per processed word from alpha to min_alpha over the next
+        total_words words of train, e.g. the words per epoch times the number of epochs. The
+        native threads count the words themselves, and self.progress reports the processed words,
+        words per second and the current rate while training runs.
+        """
+        self.progress = TrainingProgress(float(self.lr), self.min_alpha, total_words)
+
+    @property
+    def alpha(self) -> float:
+        """
+        The current learning rate.
+        """
+        return self.progress.alpha if self.progress is not None else float(self.lr)
+
+    def train(self, texts: Union[List[List[int]], Tuple[np.ndarray, np.ndarray]]) -> float:
+        """
+        Train on a minibatch of indexed texts and return the mean loss per pair, or per inner node
+        with hierarchical softmax. texts may also be a (tokens, offsets) pair in CSR layout, e.g.
+        from WikipediaDataLoader.get_csr_iter, which the native engine reads without copying.
+        """
+        if self.hs:
+            get_hs_grad = get_sg_hs_grad if self.sg else get_cbow_hs_grad
+            stats = get_hs_grad(
+                texts, self.window, self.huffman_tree, self._w_in, self._w_out,
+                self.lr, self.workers, self.vocab_keep_prob, np.random.randint(1 << 31), self.progress)
+        elif self.sg:
+            stats = get_sg_ns_grad(
+                texts, self.window, self.negative, self.negative_sampler, self._w_in, self._w_out,
+                self.lr, self.workers, self.vocab_keep_prob, np.random.randint(1 << 31), self.progress,
+                self.shared_negatives)
+        else:
+            stats = get_cbow_ns_grad(
+                texts, self.window, self.negative, self.negative_sampler, self._w_in, self._w_out,
+                self.lr, self.workers, self.vocab_keep_prob, np.random.randint(1 << 31), self.progress)
+        # The normalized embeddings and the approximate index no longer match the trained ones.
+        self._normalized_w_in = None #pylint: disable=attribute-defined-outside-init
+        self._ann_index = None #pylint: disable=attribute-defined-outside-init
+        if len(stats) > len(self._thread_words):
+            # workers was raised since the counters were sized.
+            grow = len(stats) - len(self._thread_words)
+            self._thread_words = np.pad(self._thread_words, (0, grow)) #pylint: disable=attribute-defined-outside-init
+            self._thread_seconds = np.pad(self._thread_seconds, (0, grow)) #pylint: disable=attribute-defined-outside-init
+        for thread_index, stat in enumerate(stats):
+            self._thread_words[thread_index] += stat['words']
+            self._thread_seconds[thread_index] += stat['seconds']
+
+        pair_count = sum(stat['pairs'] for stat in stats)
+        return sum(stat['loss'] for stat in stats) / pair_count if pair_count else 0.0
+
+    def reset_throughput(self):
+        self._thread_words = np.zeros((max(self.workers, 1),), dtype=np.int64)
+        self._thread_seconds = np.zeros((max(self.workers, 1),), dtype=np.float64)
+
+    def throughput(self) -> List[float]:
+        """
+        Return the words processed per second by each training thread since the last reset.
+        """
+        return (self._thread_words / np.maximum(self._thread_seconds, 1e-9)).tolist()
+
+    def save(self, dir_path: str):
+        """
+        Save the model as raw .npy matrices of the shape (vocab_count, size), a vocabulary file and
+        a config file in dir_path.
+        """
+        tokens = [self._dictionary[i] for i in range(self.vocab_count)]
+        if any('\n' in token for token in tokens):
+            raise ValueError('Tokens must not contain a line feed to be saved one per line.')
+        os.makedirs(dir_path, exist_ok=True)
+
+        np.save(os.path.join(dir_path, 'w_in.npy'), self._w_in)
+        np.save(os.path.join(dir_path, 'w_out.npy'), self._w_out)
+        np.save(
+            os.path.join(dir_path, 'dfs.npy'),
+            np.array([self._dictionary.dfs.get(i, 0) for i in range(self.vocab_count)], dtype=np.int64))
+        if self._dictionary.cfs:
+            np.save(
+                os.path.join(dir_path, 'cfs.npy'),
+                np.array([self._dictionary.cfs.get(i, 0) for i in range(self.vocab_count)], dtype=np.int64))
+        # Lines end with a line feed only, so tokens holding other line breaks such as '\r' survive.
+        with open(os.path.join(dir_path, 'vocab.txt'), 'w', encoding='utf-8', newline='\n') as _:
+            for token in tokens:
+                _.write(token + '\n')
+
+        config = {
+            'format_version': 2,
+            'window': self.window,
+            'size': self._size,
+            'negative': self.negative,
+            'ns_exponent': self.ns_exponent,
+            'sample': self.sample,
+            'sg': self.sg,
+            'hs': self.hs,
+            'alpha': float(self.lr),
+            'min_alpha': self.min_alpha,
+            'workers': self.workers,
+            'storage': self.storage,
+            'shared_negatives': self.shared_negatives,
+            'num_docs': self._dictionary.num_docs,
+            'has_ann_index': self.ann_index is not None,
+        }
+        with open(os.path.join(dir_path, 'config.json'), 'w') as _:
+            json.dump(config, _, indent=4)
+
+        # An index saved before the last training would rank with stale candidates.
+        ann_index_path = os.path.join(dir_path, 'ann_index')
+        if self.ann_index is not None:
+            self.ann_index.save(ann_index_path)
+        elif os.path.isdir(ann_index_path):
+            shutil.rmtree(ann_index_path)
+
+    @classmethod
+    def load(cls, dir_path: str, mmap: bool = True) -> 'MyWord2Vec':
+        """
+        Load a model saved by save. With mmap, the matrices are memory-mapped read-only, so the
+        model starts without reading them and processes share their pages through the OS page
+        cache; such a model can answer queries but must be loaded with mmap=False to be trained.
+        """
+        with open(os.path.join(dir_path, 'config.json')) as _:
+            config = json.load(_)
+        with open(os.path.join(dir_path, 'vocab.txt'), encoding='utf-8', newline='\n') as _:
+            tokens = _.read().split('\n')[:-1]
+        dfs = np.load(os.path.join(dir_path, 'dfs.npy'))
+
+        dictionary = Dictionary()
+        dictionary.token2id = {token: i for i, token in enumerate(tokens)}
+        dictionary.dfs = dict(enumerate(dfs.tolist()))
+        if os.path.exists(os.path.join(dir_path, 'cfs.npy')):
+            dictionary.cfs = dict(enumerate(np.load(os.path.join(dir_path, 'cfs.npy')).tolist()))
+        dictionary.num_docs = config['num_docs']
+
+        mmap_mode = 'r' if mmap else None
+        model = cls.__new__(cls)
+        model.window = config['window']
+        model.negative = config['negative']
+        model.ns_exponent = config['ns_exponent']
+        model.sample = config['sample']
+        model.sg = config.get('sg', 1)
+        model.hs = config.get('hs', 0)
+        model.lr = np.float32(config['alpha'])
+        model.min_alpha = config.get('min_alpha', 0.0001)
+        model.progress = None
+        model.workers = config['workers']
+        model.storage = config.get('storage', 'float32')
+        model.shared_negatives = config.get('shared_negatives', 0)
+        model._dictionary = dictionary #pylint: disable=protected-access
+        model._size = config['size'] #pylint: disable=protected-access
+        model._w_in = np.load(os.path.join(dir_path, 'w_in.npy'), mmap_mode=mmap_mode) #pylint: disable=protected-access
+        if config['format_version'] < 2:
+            # Version 1 stored w_in as (size, vocab_count).
+            model._w_in = model._w_in.T if mmap else np.ascontiguousarray(model._w_in.T) #pylint: disable=protected-access
+        model._w_out = np.load(os.path.join(dir_path, 'w_out.npy'), mmap_mode=mmap_mode) #pylint: disable=protected-access
+        model.reset_throughput()
+        ann_index_path = os.path.join(dir_path, 'ann_index')
+        if config.get('has_ann_index', os.path.isdir(ann_index_path)):
+            model._ann_index = LSHIndex.load(ann_index_path, mmap=mmap) #pylint: disable=protected-access
+
+        return model
+
+    def build_ann_index(
+            self, n_tables: int = 8, n_bits: Optional[int] = None, seed: Optional[int] = None):
+        """
+        Build the approximate nearest neighbour index used by most_similar(approximate=True).
+        It is discarded by train and saved with the model.
+        """
+        self._ann_index = LSHIndex.build(to_float32(self._w_in), n_tables, n_bits, seed) #pylint: disable=attribute-defined-outside-init
+
+    def _query_vectors(
+            self,
+            positives: List[Union[str, List[str], None]],
+            negatives: List[Union[str, List[str], None]]) -> np.ndarray:
+        query_indices, token_indices, signs = [], [], []
+        for query_index, (positive, negative) in enumerate(zip(positives, negatives)):
+            for tokens, sign in [(positive, 1.0), (negative, -1.0)]:
+                if not tokens:
+                    continue
+                if isinstance(tokens, str):
+                    tokens = [tokens]
+                for token in tokens:
+                    query_indices.append(query_index)
+                    token_indices.append(self._dictionary.token2id[token])
+                    signs.append(sign)
+
+        vectors = np.zeros((len(positives), self._size), dtype=np.float32)
+        if token_indices:
+            np.add.at(
+                vectors, np.array(query_indices),
+                to_float32(self._w_in[token_indices]) * np.array(signs, dtype=np.float32)[:, None])
+        return vectors
 
     def most_similar(
             self,
             positive: Union[str, List[str], None] = None,
             negative: Union[str, List[str], None] = None,
-            topn: int = 10):
-
-        vector = np.zeros((self._size,)).astype(np.float32)
-        if positive:
-            if isinstance(positive, str):
-                vector += self._w_in[:, self._dictionary.token2id[positive]]
-            elif isinstance(positive, list):
-                for token in positive:
-                    vector += self._w_in[:, self._dictionary.token2id[token]]
-        if negative:
-            if isinstance(negative, str):
-                vector += self._w_in[:, self._dictionary.token2id[negative]]
-            elif isinstance(negative, list):
-                for token in negative:
-                    vector -= self._w_in[:, self._dictionary.token2id[token]]
-
-        cos_sim = np.matmul(vector, self._w_in) / np.linalg.norm(vector, ord=2) / \
-            np.linalg.norm(self._w_in, ord=2, axis=0)
-
-        top_words = []
-        for index in np.argsort(cos_sim)[::-1]:
-            word = self._dictionary[index]
-            top_words.append(word)
-            if len(top_words) >= topn:
-                break
-
-        return top_words
+            topn: int = 10,
+            approximate: bool = False,
+            probes: int = 2):
+        """
+        Return the topn words most cosine-similar to the sum of positive minus the sum of negative.
+        With approximate, only the candidates found by the index of build_ann_index are ranked.
+        """
+        if not approximate:
+            return self.most_similar_batch([positive], [negative], topn)[0]
+
+        ann_index, w_in = self.ann_index, self._w_in
+        if ann_index is None:
+            raise ValueError('Call build_ann_index before an approximate query.')
+        vector = self._query_vectors([positive], [negative])[0]
+        if w_in.dtype == np.float32:
+            indices = ann_index.search(vector, w_in, topn, probes)
+        else:
+            # LSHIndex.search cannot read bfloat16 bits, so the candidates are reranked here.
+            ids = ann_index.candidates(vector, probes)
+            candidates = to_float32(w_in[ids])
+            cos_sim = np.matmul(candidates, vector) / \
+                np.maximum(np.linalg.norm(candidates, ord=2, axis=1), 1e-12)
+            indices = ids[np.argsort(cos_sim)[::-1][:topn]]
+        return [self._dictionary[index] for index in indices]
+
+    def most_similar_batch(
+            self,
+            positives: List[Union[str, List[str], None]],
+            negatives: Optional[List[Union[str, List[str], None]]] = None,
+            topn: int = 10,
+            block_size: int = 1024) -> List[List[str]]:
+        """
+        Exact most_similar for many queries at once: positives[i] and negatives[i] form the i-th
+        query. The queries are scored block by block with one matrix product against the cached
+        normalized embeddings, decoded to float32 SCORE_BLOCK_ROWS rows at a time.
+        """
+        if negatives is None:
+            negatives = [None] * len(positives)
+        if len(negatives) != len(positives):
+            raise ValueError('positives and negatives must have the same length.')
+
+        # The vocabulary is the one of the normalized embeddings even if update_vocab runs meanwhile.
+        normalized_w_in = self.normalized_w_in
+        vocab_count = len(normalized_w_in)
+        topn = min(topn, vocab_count)
+        results = []
+        for start in range(0, len(positives), block_size):
+            vectors = self._query_vectors(
+                positives[start: start + block_size], negatives[start: start + block_size])
+            cos_sim = np.empty((len(vectors), vocab_count), dtype=np.float32)
+            for vocab_start in range(0, vocab_count, SCORE_BLOCK_ROWS):
+                block = to_float32(normalized_w_in[vocab_start: vocab_start + SCORE_BLOCK_ROWS])
+                cos_sim[:, vocab_start: vocab_start + SCORE_BLOCK_ROWS] = np.matmul(vectors, block.T)
+
+            top_indices = np.argpartition(-cos_sim, topn - 1, axis=1)[:, :topn]
+            top_cos_sim = np.take_along_axis(cos_sim, top_indices, axis=1)
+            top_indices = np.take_along_axis(
+                top_indices, np.argsort(-top_cos_sim, axis=1), axis=1)
+            for indices in top_indices:
+                results.append([self._dictionary[index] for index in indices])
+
+        return results
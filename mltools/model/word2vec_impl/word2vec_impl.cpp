@@ -1,39 +1,923 @@
 #include <iostream>
 #include <vector>
 #include <random>
+#include <cstdint>
+#include <algorithm>
+#include <thread>
+#include <atomic>
+#include <queue>
+#include <chrono>
+#include <cmath>
+#include <cstring>
+#include <string>
+#include <stdexcept>
 #include <Eigen/Core>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define W2V_X86_DISPATCH
 #include <immintrin.h>
+#endif
 
 using namespace std;
 
+// Precomputed sigmoid and log-sigmoid like EXP_TABLE of the original word2vec. Inputs beyond
+// +-max_exp are clamped: the sigmoid saturates to 0 or 1 and the log-sigmoid takes its value at
+// the boundary.
+class SigmoidTable {
+public:
+    SigmoidTable(float max_exp = 6.0f, unsigned table_size = 1000)
+        : max_exp_(max_exp), scale_(table_size / (2.0f * max_exp)),
+          sigmoid_(table_size + 1), log_sigmoid_(table_size + 1) {
+        for (unsigned i = 0; i <= table_size; ++i) {
+            double x = (2.0 * i / table_size - 1.0) * max_exp;
+            sigmoid_[i] = 1.0 / (1.0 + std::exp(-x));
+            log_sigmoid_[i] = -std::log1p(std::exp(-x));
+        }
+    }
+
+    float max_exp() const { return max_exp_; }
+    size_t size() const { return sigmoid_.size() - 1; }
+
+    float sigmoid(float x) const {
+        if (x >= max_exp_) return 1.0f;
+        if (x <= -max_exp_) return 0.0f;
+        return sigmoid_[index(x)];
+    }
+
+    float log_sigmoid(float x) const {
+        if (x >= max_exp_) return log_sigmoid_.back();
+        if (x <= -max_exp_) return log_sigmoid_.front();
+        return log_sigmoid_[index(x)];
+    }
+
+    // Negative-sampling loss of one pair: -log(sigmoid(x)) for label 1, -log(sigmoid(-x)) for 0.
+    float loss(float x, int label) const {
+        return -log_sigmoid(label ? x : -x);
+    }
+
+private:
+    size_t index(float x) const { return (size_t)((x + max_exp_) * scale_ + 0.5f); }
+
+    float max_exp_;
+    float scale_;
+    vector<float> sigmoid_;
+    vector<float> log_sigmoid_;
+};
+
+// Table shared by every kernel. Replace it only while no training is running.
+SigmoidTable& sigmoid_table() {
+    static SigmoidTable table;
+    return table;
+}
+
+void set_sigmoid_table(float max_exp, unsigned table_size) {
+    sigmoid_table() = SigmoidTable(max_exp, table_size);
+}
+
+// SGD update of one (w_in_row, w_out_row, label) pair; returns the pair's loss. Every variant
+// computes the same thing and only differs in the instruction set it is compiled for, so the
+// module itself is built for the baseline ISA and the variant is picked at import time.
+typedef float (*PairKernel)(float* w_in_row, float* w_out_row, unsigned hidden_dim, int label, float lr);
+
+float update_pair_scalar(float* w_in_row, float* w_out_row, unsigned hidden_dim, int label, float lr) {
+    float output = 0.0f, tmp_w_out;
+    for (unsigned j = 0; j < hidden_dim; ++j) output += w_in_row[j] * w_out_row[j];
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    for (unsigned j = 0; j < hidden_dim; ++j) {
+        tmp_w_out = w_out_row[j];
+        w_out_row[j] += grad * w_in_row[j];
+        w_in_row[j] += grad * tmp_w_out;
+    }
+
+    return loss;
+}
+
+#ifdef W2V_X86_DISPATCH
+__attribute__((target("avx2,fma")))
+float update_pair_avx2(float* w_in_row, float* w_out_row, unsigned hidden_dim, int label, float lr) {
+    unsigned j = 0;
+    __m256 acc = _mm256_setzero_ps();
+    for (; j + 8 <= hidden_dim; j += 8) {
+        acc = _mm256_fmadd_ps(_mm256_loadu_ps(w_in_row + j), _mm256_loadu_ps(w_out_row + j), acc);
+    }
+    __m128 sum = _mm_add_ps(_mm256_castps256_ps128(acc), _mm256_extractf128_ps(acc, 1));
+    sum = _mm_hadd_ps(sum, sum);
+    sum = _mm_hadd_ps(sum, sum);
+    float output = _mm_cvtss_f32(sum), tmp_w_out;
+    for (; j < hidden_dim; ++j) output += w_in_row[j] * w_out_row[j];
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    __m256 grads = _mm256_set1_ps(grad);
+    for (j = 0; j + 8 <= hidden_dim; j += 8) {
+        __m256 ws_in = _mm256_loadu_ps(w_in_row + j);
+        __m256 ws_out = _mm256_loadu_ps(w_out_row + j);
+        _mm256_storeu_ps(w_out_row + j, _mm256_fmadd_ps(grads, ws_in, ws_out));
+        _mm256_storeu_ps(w_in_row + j, _mm256_fmadd_ps(grads, ws_out, ws_in));
+    }
+    for (; j < hidden_dim; ++j) {
+        tmp_w_out = w_out_row[j];
+        w_out_row[j] += grad * w_in_row[j];
+        w_in_row[j] += grad * tmp_w_out;
+    }
+
+    return loss;
+}
+
+__attribute__((target("avx512f")))
+float update_pair_avx512(float* w_in_row, float* w_out_row, unsigned hidden_dim, int label, float lr) {
+    unsigned j = 0;
+    __m512 acc = _mm512_setzero_ps();
+    for (; j + 16 <= hidden_dim; j += 16) {
+        acc = _mm512_fmadd_ps(_mm512_loadu_ps(w_in_row + j), _mm512_loadu_ps(w_out_row + j), acc);
+    }
+    __mmask16 tail = (__mmask16)((1u << (hidden_dim - j)) - 1);
+    acc = _mm512_fmadd_ps(
+        _mm512_maskz_loadu_ps(tail, w_in_row + j), _mm512_maskz_loadu_ps(tail, w_out_row + j), acc);
+    float output = _mm512_reduce_add_ps(acc);
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    __m512 grads = _mm512_set1_ps(grad);
+    for (j = 0; j + 16 <= hidden_dim; j += 16) {
+        __m512 ws_in = _mm512_loadu_ps(w_in_row + j);
+        __m512 ws_out = _mm512_loadu_ps(w_out_row + j);
+        _mm512_storeu_ps(w_out_row + j, _mm512_fmadd_ps(grads, ws_in, ws_out));
+        _mm512_storeu_ps(w_in_row + j, _mm512_fmadd_ps(grads, ws_out, ws_in));
+    }
+    __m512 ws_in = _mm512_maskz_loadu_ps(tail, w_in_row + j);
+    __m512 ws_out = _mm512_maskz_loadu_ps(tail, w_out_row + j);
+    _mm512_mask_storeu_ps(w_out_row + j, tail, _mm512_fmadd_ps(grads, ws_in, ws_out));
+    _mm512_mask_storeu_ps(w_in_row + j, tail, _mm512_fmadd_ps(grads, ws_out, ws_in));
+
+    return loss;
+}
+#endif
+
+// CBOW update of one (context mean, w_out_row, label) pair; returns the pair's loss. The gradient
+// for the context words is accumulated into neu1e and w_out_row is updated in place.
+typedef float (*CbowKernel)(
+    const float* context, float* neu1e, float* w_out_row, unsigned hidden_dim, int label, float lr);
+
+float update_cbow_scalar(
+    const float* context, float* neu1e, float* w_out_row, unsigned hidden_dim, int label, float lr
+) {
+    float output = 0.0f;
+    for (unsigned j = 0; j < hidden_dim; ++j) output += context[j] * w_out_row[j];
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    for (unsigned j = 0; j < hidden_dim; ++j) {
+        neu1e[j] += grad * w_out_row[j];
+        w_out_row[j] += grad * context[j];
+    }
+
+    return loss;
+}
+
+#ifdef W2V_X86_DISPATCH
+__attribute__((target("avx2,fma")))
+float update_cbow_avx2(
+    const float* context, float* neu1e, float* w_out_row, unsigned hidden_dim, int label, float lr
+) {
+    unsigned j = 0;
+    __m256 acc = _mm256_setzero_ps();
+    for (; j + 8 <= hidden_dim; j += 8) {
+        acc = _mm256_fmadd_ps(_mm256_loadu_ps(context + j), _mm256_loadu_ps(w_out_row + j), acc);
+    }
+    __m128 sum = _mm_add_ps(_mm256_castps256_ps128(acc), _mm256_extractf128_ps(acc, 1));
+    sum = _mm_hadd_ps(sum, sum);
+    sum = _mm_hadd_ps(sum, sum);
+    float output = _mm_cvtss_f32(sum);
+    for (; j < hidden_dim; ++j) output += context[j] * w_out_row[j];
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    __m256 grads = _mm256_set1_ps(grad);
+    for (j = 0; j + 8 <= hidden_dim; j += 8) {
+        __m256 ws_out = _mm256_loadu_ps(w_out_row + j);
+        _mm256_storeu_ps(neu1e + j, _mm256_fmadd_ps(grads, ws_out, _mm256_loadu_ps(neu1e + j)));
+        _mm256_storeu_ps(w_out_row + j, _mm256_fmadd_ps(grads, _mm256_loadu_ps(context + j), ws_out));
+    }
+    for (; j < hidden_dim; ++j) {
+        neu1e[j] += grad * w_out_row[j];
+        w_out_row[j] += grad * context[j];
+    }
+
+    return loss;
+}
+
+__attribute__((target("avx512f")))
+float update_cbow_avx512(
+    const float* context, float* neu1e, float* w_out_row, unsigned hidden_dim, int label, float lr
+) {
+    unsigned j = 0;
+    __m512 acc = _mm512_setzero_ps();
+    for (; j + 16 <= hidden_dim; j += 16) {
+        acc = _mm512_fmadd_ps(_mm512_loadu_ps(context + j), _mm512_loadu_ps(w_out_row + j), acc);
+    }
+    __mmask16 tail = (__mmask16)((1u << (hidden_dim - j)) - 1);
+    acc = _mm512_fmadd_ps(
+        _mm512_maskz_loadu_ps(tail, context + j), _mm512_maskz_loadu_ps(tail, w_out_row + j), acc);
+    float output = _mm512_reduce_add_ps(acc);
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    __m512 grads = _mm512_set1_ps(grad);
+    for (j = 0; j + 16 <= hidden_dim; j += 16) {
+        __m512 ws_out = _mm512_loadu_ps(w_out_row + j);
+        _mm512_storeu_ps(neu1e + j, _mm512_fmadd_ps(grads, ws_out, _mm512_loadu_ps(neu1e + j)));
+        _mm512_storeu_ps(w_out_row + j, _mm512_fmadd_ps(grads, _mm512_loadu_ps(context + j), ws_out));
+    }
+    __m512 ws_out = _mm512_maskz_loadu_ps(tail, w_out_row + j);
+    _mm512_mask_storeu_ps(
+        neu1e + j, tail, _mm512_fmadd_ps(grads, ws_out, _mm512_maskz_loadu_ps(tail, neu1e + j)));
+    _mm512_mask_storeu_ps(
+        w_out_row + j, tail, _mm512_fmadd_ps(grads, _mm512_maskz_loadu_ps(tail, context + j), ws_out));
+
+    return loss;
+}
+#endif
+
+// Element types of w_in / w_out. The half-precision kernels convert w_out rows to float32 in
+// registers and round the update back to nearest even, and w_in rows are converted into a float32
+// buffer while they are trained, so every computation is done in float32. bfloat16 has no C++
+// type and is passed around as its raw bits.
+enum Storage {
+    STORAGE_FLOAT32 = 0,
+    STORAGE_FLOAT16 = 1,
+    STORAGE_BFLOAT16 = 2,
+};
+
+inline uint32_t float_bits(float value) {
+    uint32_t bits;
+    memcpy(&bits, &value, sizeof(bits));
+    return bits;
+}
+
+inline float bits_float(uint32_t bits) {
+    float value;
+    memcpy(&value, &bits, sizeof(value));
+    return value;
+}
+
+struct Fp16 {
+    static float to_float(uint16_t half) {
+        uint32_t sign = (uint32_t)(half & 0x8000) << 16;
+        uint32_t exponent = (half >> 10) & 0x1F;
+        uint32_t mantissa = half & 0x3FF;
+        if (exponent == 0) {
+            float value = mantissa * (1.0f / 16777216.0f);
+            return sign ? -value : value;
+        }
+        // NaNs are quieted like F16C does.
+        if (exponent == 0x1F) return bits_float(sign | 0x7F800000 | mantissa << 13 | (mantissa ? 0x400000 : 0));
+        return bits_float(sign | (exponent + 112) << 23 | mantissa << 13);
+    }
+
+    // Round to nearest even like F16C, including subnormals and the overflow to infinity.
+    static uint16_t from_float(float value) {
+        uint32_t bits = float_bits(value);
+        uint16_t sign = (bits >> 16) & 0x8000;
+        bits &= 0x7FFFFFFF;
+        if (bits >= 0x7F800000) {
+            return sign | 0x7C00 | (bits > 0x7F800000 ? 0x200 | ((bits >> 13) & 0x3FF) : 0);
+        }
+        if (bits >= 0x477FF000) return sign | 0x7C00;
+        if (bits < 0x38800000) return sign | (uint16_t)lrintf(bits_float(bits) * 16777216.0f);
+        return sign | (uint16_t)((bits + 0xFFF + ((bits >> 13) & 1) - 0x38000000) >> 13);
+    }
+};
+
+struct Bf16 {
+    static float to_float(uint16_t bfloat16) { return bits_float((uint32_t)bfloat16 << 16); }
+
+    static uint16_t from_float(float value) {
+        uint32_t bits = float_bits(value);
+        return (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16;
+    }
+};
+
+#ifdef W2V_X86_DISPATCH
+// Conversions of 8 (avx2) or 16 (avx512) lanes, matching the scalar ones bit for bit.
+struct Fp16Avx2 : Fp16 {
+    __attribute__((target("avx2,f16c"), always_inline))
+    static inline __m256 load(const uint16_t* src) {
+        return _mm256_cvtph_ps(_mm_loadu_si128((const __m128i*)src));
+    }
+
+    __attribute__((target("avx2,f16c"), always_inline))
+    static inline void store(uint16_t* dst, __m256 values) {
+        _mm_storeu_si128((__m128i*)dst, _mm256_cvtps_ph(values, _MM_FROUND_TO_NEAREST_INT));
+    }
+};
+
+struct Bf16Avx2 : Bf16 {
+    __attribute__((target("avx2"), always_inline))
+    static inline __m256 load(const uint16_t* src) {
+        __m256i bits = _mm256_cvtepu16_epi32(_mm_loadu_si128((const __m128i*)src));
+        return _mm256_castsi256_ps(_mm256_slli_epi32(bits, 16));
+    }
+
+    __attribute__((target("avx2"), always_inline))
+    static inline void store(uint16_t* dst, __m256 values) {
+        __m256i bits = _mm256_castps_si256(values);
+        __m256i odd = _mm256_and_si256(_mm256_srli_epi32(bits, 16), _mm256_set1_epi32(1));
+        bits = _mm256_srli_epi32(_mm256_add_epi32(bits, _mm256_add_epi32(_mm256_set1_epi32(0x7FFF), odd)), 16);
+        // packus works within 128-bit lanes, so gather the two packed halves into the low lane.
+        bits = _mm256_permute4x64_epi64(_mm256_packus_epi32(bits, bits), 0xD8);
+        _mm_storeu_si128((__m128i*)dst, _mm256_castsi256_si128(bits));
+    }
+};
+
+struct Fp16Avx512 : Fp16 {
+    __attribute__((target("avx512f"), always_inline))
+    static inline __m512 load(const uint16_t* src) {
+        return _mm512_cvtph_ps(_mm256_loadu_si256((const __m256i*)src));
+    }
+
+    __attribute__((target("avx512f"), always_inline))
+    static inline void store(uint16_t* dst, __m512 values) {
+        _mm256_storeu_si256((__m256i*)dst, _mm512_cvtps_ph(values, _MM_FROUND_TO_NEAREST_INT));
+    }
+};
+
+struct Bf16Avx512 : Bf16 {
+    __attribute__((target("avx512f"), always_inline))
+    static inline __m512 load(const uint16_t* src) {
+        __m512i bits = _mm512_cvtepu16_epi32(_mm256_loadu_si256((const __m256i*)src));
+        return _mm512_castsi512_ps(_mm512_slli_epi32(bits, 16));
+    }
+
+    __attribute__((target("avx512f"), always_inline))
+    static inline void store(uint16_t* dst, __m512 values) {
+        __m512i bits = _mm512_castps_si512(values);
+        __m512i odd = _mm512_and_si512(_mm512_srli_epi32(bits, 16), _mm512_set1_epi32(1));
+        bits = _mm512_srli_epi32(_mm512_add_epi32(bits, _mm512_add_epi32(_mm512_set1_epi32(0x7FFF), odd)), 16);
+        _mm256_storeu_si256((__m256i*)dst, _mm512_cvtepi32_epi16(bits));
+    }
+};
+#endif
+
+// Conversion of a whole row between the storage and a float32 buffer.
+typedef void (*RowLoader)(const uint16_t* src, float* dst, unsigned hidden_dim);
+typedef void (*RowStorer)(const float* src, uint16_t* dst, unsigned hidden_dim);
+
+// The PairKernel and CbowKernel counterparts for a w_out row in half precision.
+typedef float (*HalfPairKernel)(float* w_in_row, uint16_t* w_out_row, unsigned hidden_dim, int label, float lr);
+typedef float (*HalfCbowKernel)(
+    const float* context, float* neu1e, uint16_t* w_out_row, unsigned hidden_dim, int label, float lr);
+
+template <typename Codec>
+void load_row_scalar(const uint16_t* src, float* dst, unsigned hidden_dim) {
+    for (unsigned j = 0; j < hidden_dim; ++j) dst[j] = Codec::to_float(src[j]);
+}
+
+template <typename Codec>
+void store_row_scalar(const float* src, uint16_t* dst, unsigned hidden_dim) {
+    for (unsigned j = 0; j < hidden_dim; ++j) dst[j] = Codec::from_float(src[j]);
+}
+
+template <typename Codec>
+float update_pair_half_scalar(float* w_in_row, uint16_t* w_out_row, unsigned hidden_dim, int label, float lr) {
+    float output = 0.0f, tmp_w_out;
+    for (unsigned j = 0; j < hidden_dim; ++j) output += w_in_row[j] * Codec::to_float(w_out_row[j]);
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    for (unsigned j = 0; j < hidden_dim; ++j) {
+        tmp_w_out = Codec::to_float(w_out_row[j]);
+        w_out_row[j] = Codec::from_float(tmp_w_out + grad * w_in_row[j]);
+        w_in_row[j] += grad * tmp_w_out;
+    }
+
+    return loss;
+}
+
+template <typename Codec>
+float update_cbow_half_scalar(
+    const float* context, float* neu1e, uint16_t* w_out_row, unsigned hidden_dim, int label, float lr
+) {
+    float output = 0.0f, tmp_w_out;
+    for (unsigned j = 0; j < hidden_dim; ++j) output += context[j] * Codec::to_float(w_out_row[j]);
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    for (unsigned j = 0; j < hidden_dim; ++j) {
+        tmp_w_out = Codec::to_float(w_out_row[j]);
+        neu1e[j] += grad * tmp_w_out;
+        w_out_row[j] = Codec::from_float(tmp_w_out + grad * context[j]);
+    }
+
+    return loss;
+}
+
+#ifdef W2V_X86_DISPATCH
+template <typename Codec>
+__attribute__((target("avx2,fma,f16c")))
+void load_row_avx2(const uint16_t* src, float* dst, unsigned hidden_dim) {
+    unsigned j = 0;
+    for (; j + 8 <= hidden_dim; j += 8) _mm256_storeu_ps(dst + j, Codec::load(src + j));
+    for (; j < hidden_dim; ++j) dst[j] = Codec::to_float(src[j]);
+}
+
+template <typename Codec>
+__attribute__((target("avx2,fma,f16c")))
+void store_row_avx2(const float* src, uint16_t* dst, unsigned hidden_dim) {
+    unsigned j = 0;
+    for (; j + 8 <= hidden_dim; j += 8) Codec::store(dst + j, _mm256_loadu_ps(src + j));
+    for (; j < hidden_dim; ++j) dst[j] = Codec::from_float(src[j]);
+}
+
+template <typename Codec>
+__attribute__((target("avx2,fma,f16c")))
+float update_pair_half_avx2(float* w_in_row, uint16_t* w_out_row, unsigned hidden_dim, int label, float lr) {
+    unsigned j = 0;
+    __m256 acc = _mm256_setzero_ps();
+    for (; j + 8 <= hidden_dim; j += 8) {
+        acc = _mm256_fmadd_ps(_mm256_loadu_ps(w_in_row + j), Codec::load(w_out_row + j), acc);
+    }
+    __m128 sum = _mm_add_ps(_mm256_castps256_ps128(acc), _mm256_extractf128_ps(acc, 1));
+    sum = _mm_hadd_ps(sum, sum);
+    sum = _mm_hadd_ps(sum, sum);
+    float output = _mm_cvtss_f32(sum), tmp_w_out;
+    for (; j < hidden_dim; ++j) output += w_in_row[j] * Codec::to_float(w_out_row[j]);
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    __m256 grads = _mm256_set1_ps(grad);
+    for (j = 0; j + 8 <= hidden_dim; j += 8) {
+        __m256 ws_in = _mm256_loadu_ps(w_in_row + j);
+        __m256 ws_out = Codec::load(w_out_row + j);
+        Codec::store(w_out_row + j, _mm256_fmadd_ps(grads, ws_in, ws_out));
+        _mm256_storeu_ps(w_in_row + j, _mm256_fmadd_ps(grads, ws_out, ws_in));
+    }
+    for (; j < hidden_dim; ++j) {
+        tmp_w_out = Codec::to_float(w_out_row[j]);
+        w_out_row[j] = Codec::from_float(tmp_w_out + grad * w_in_row[j]);
+        w_in_row[j] += grad * tmp_w_out;
+    }
+
+    return loss;
+}
+
+template <typename Codec>
+__attribute__((target("avx2,fma,f16c")))
+float update_cbow_half_avx2(
+    const float* context, float* neu1e, uint16_t* w_out_row, unsigned hidden_dim, int label, float lr
+) {
+    unsigned j = 0;
+    __m256 acc = _mm256_setzero_ps();
+    for (; j + 8 <= hidden_dim; j += 8) {
+        acc = _mm256_fmadd_ps(_mm256_loadu_ps(context + j), Codec::load(w_out_row + j), acc);
+    }
+    __m128 sum = _mm_add_ps(_mm256_castps256_ps128(acc), _mm256_extractf128_ps(acc, 1));
+    sum = _mm_hadd_ps(sum, sum);
+    sum = _mm_hadd_ps(sum, sum);
+    float output = _mm_cvtss_f32(sum), tmp_w_out;
+    for (; j < hidden_dim; ++j) output += context[j] * Codec::to_float(w_out_row[j]);
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    __m256 grads = _mm256_set1_ps(grad);
+    for (j = 0; j + 8 <= hidden_dim; j += 8) {
+        __m256 ws_out = Codec::load(w_out_row + j);
+        _mm256_storeu_ps(neu1e + j, _mm256_fmadd_ps(grads, ws_out, _mm256_loadu_ps(neu1e + j)));
+        Codec::store(w_out_row + j, _mm256_fmadd_ps(grads, _mm256_loadu_ps(context + j), ws_out));
+    }
+    for (; j < hidden_dim; ++j) {
+        tmp_w_out = Codec::to_float(w_out_row[j]);
+        neu1e[j] += grad * tmp_w_out;
+        w_out_row[j] = Codec::from_float(tmp_w_out + grad * context[j]);
+    }
+
+    return loss;
+}
+
+// Without AVX512BW there are no masked 16-bit loads, so the last count < 16 elements of a row go
+// through a zero-padded copy.
+template <typename Codec>
+__attribute__((target("avx512f"), always_inline))
+inline __m512 load_tail_avx512(const uint16_t* src, unsigned count) {
+    uint16_t lanes[16] = {0};
+    memcpy(lanes, src, count * sizeof(uint16_t));
+    return Codec::load(lanes);
+}
+
+template <typename Codec>
+__attribute__((target("avx512f"), always_inline))
+inline void store_tail_avx512(uint16_t* dst, __m512 values, unsigned count) {
+    uint16_t lanes[16];
+    Codec::store(lanes, values);
+    memcpy(dst, lanes, count * sizeof(uint16_t));
+}
+
+template <typename Codec>
+__attribute__((target("avx512f")))
+void load_row_avx512(const uint16_t* src, float* dst, unsigned hidden_dim) {
+    unsigned j = 0;
+    for (; j + 16 <= hidden_dim; j += 16) _mm512_storeu_ps(dst + j, Codec::load(src + j));
+    __mmask16 tail = (__mmask16)((1u << (hidden_dim - j)) - 1);
+    _mm512_mask_storeu_ps(dst + j, tail, load_tail_avx512<Codec>(src + j, hidden_dim - j));
+}
+
+template <typename Codec>
+__attribute__((target("avx512f")))
+void store_row_avx512(const float* src, uint16_t* dst, unsigned hidden_dim) {
+    unsigned j = 0;
+    for (; j + 16 <= hidden_dim; j += 16) Codec::store(dst + j, _mm512_loadu_ps(src + j));
+    __mmask16 tail = (__mmask16)((1u << (hidden_dim - j)) - 1);
+    store_tail_avx512<Codec>(dst + j, _mm512_maskz_loadu_ps(tail, src + j), hidden_dim - j);
+}
+
+template <typename Codec>
+__attribute__((target("avx512f")))
+float update_pair_half_avx512(float* w_in_row, uint16_t* w_out_row, unsigned hidden_dim, int label, float lr) {
+    unsigned j = 0;
+    __m512 acc = _mm512_setzero_ps();
+    for (; j + 16 <= hidden_dim; j += 16) {
+        acc = _mm512_fmadd_ps(_mm512_loadu_ps(w_in_row + j), Codec::load(w_out_row + j), acc);
+    }
+    unsigned rest = hidden_dim - j;
+    __mmask16 tail = (__mmask16)((1u << rest) - 1);
+    __m512 tail_out = load_tail_avx512<Codec>(w_out_row + j, rest);
+    acc = _mm512_fmadd_ps(_mm512_maskz_loadu_ps(tail, w_in_row + j), tail_out, acc);
+    float output = _mm512_reduce_add_ps(acc);
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    __m512 grads = _mm512_set1_ps(grad);
+    for (j = 0; j + 16 <= hidden_dim; j += 16) {
+        __m512 ws_in = _mm512_loadu_ps(w_in_row + j);
+        __m512 ws_out = Codec::load(w_out_row + j);
+        Codec::store(w_out_row + j, _mm512_fmadd_ps(grads, ws_in, ws_out));
+        _mm512_storeu_ps(w_in_row + j, _mm512_fmadd_ps(grads, ws_out, ws_in));
+    }
+    __m512 ws_in = _mm512_maskz_loadu_ps(tail, w_in_row + j);
+    store_tail_avx512<Codec>(w_out_row + j, _mm512_fmadd_ps(grads, ws_in, tail_out), rest);
+    _mm512_mask_storeu_ps(w_in_row + j, tail, _mm512_fmadd_ps(grads, tail_out, ws_in));
+
+    return loss;
+}
+
+template <typename Codec>
+__attribute__((target("avx512f")))
+float update_cbow_half_avx512(
+    const float* context, float* neu1e, uint16_t* w_out_row, unsigned hidden_dim, int label, float lr
+) {
+    unsigned j = 0;
+    __m512 acc = _mm512_setzero_ps();
+    for (; j + 16 <= hidden_dim; j += 16) {
+        acc = _mm512_fmadd_ps(_mm512_loadu_ps(context + j), Codec::load(w_out_row + j), acc);
+    }
+    unsigned rest = hidden_dim - j;
+    __mmask16 tail = (__mmask16)((1u << rest) - 1);
+    __m512 tail_out = load_tail_avx512<Codec>(w_out_row + j, rest);
+    acc = _mm512_fmadd_ps(_mm512_maskz_loadu_ps(tail, context + j), tail_out, acc);
+    float output = _mm512_reduce_add_ps(acc);
+
+    const SigmoidTable& table = sigmoid_table();
+    float loss = table.loss(output, label);
+    float grad = (label - table.sigmoid(output)) * lr;
+
+    __m512 grads = _mm512_set1_ps(grad);
+    for (j = 0; j + 16 <= hidden_dim; j += 16) {
+        __m512 ws_out = Codec::load(w_out_row + j);
+        _mm512_storeu_ps(neu1e + j, _mm512_fmadd_ps(grads, ws_out, _mm512_loadu_ps(neu1e + j)));
+        Codec::store(w_out_row + j, _mm512_fmadd_ps(grads, _mm512_loadu_ps(context + j), ws_out));
+    }
+    _mm512_mask_storeu_ps(
+        neu1e + j, tail, _mm512_fmadd_ps(grads, tail_out, _mm512_maskz_loadu_ps(tail, neu1e + j)));
+    store_tail_avx512<Codec>(
+        w_out_row + j, _mm512_fmadd_ps(grads, _mm512_maskz_loadu_ps(tail, context + j), tail_out), rest);
+
+    return loss;
+}
+#endif
+
+struct HalfKernels {
+    RowLoader load_row;
+    RowStorer store_row;
+    HalfPairKernel update_pair;
+    HalfCbowKernel update_cbow;
+};
+
+struct KernelEntry {
+    const char* name;
+    PairKernel update_pair;
+    CbowKernel update_cbow;
+    HalfKernels fp16;
+    HalfKernels bf16;
+};
+
+#define W2V_HALF_KERNELS(isa, codec) \
+    {load_row_##isa<codec>, store_row_##isa<codec>, update_pair_half_##isa<codec>, update_cbow_half_##isa<codec>}
+
+// Ordered from the slowest to the fastest.
+const vector<KernelEntry>& kernel_entries() {
+    static const vector<KernelEntry> entries = {
+        {"scalar", update_pair_scalar, update_cbow_scalar,
+         W2V_HALF_KERNELS(scalar, Fp16), W2V_HALF_KERNELS(scalar, Bf16)},
+#ifdef W2V_X86_DISPATCH
+        {"avx2", update_pair_avx2, update_cbow_avx2,
+         W2V_HALF_KERNELS(avx2, Fp16Avx2), W2V_HALF_KERNELS(avx2, Bf16Avx2)},
+        {"avx512", update_pair_avx512, update_cbow_avx512,
+         W2V_HALF_KERNELS(avx512, Fp16Avx512), W2V_HALF_KERNELS(avx512, Bf16Avx512)},
+#endif
+    };
+    return entries;
+}
+
+bool kernel_supported(const string& name) {
+    if (name == "scalar") return true;
+#ifdef W2V_X86_DISPATCH
+    __builtin_cpu_init();
+    if (name == "avx2") {
+        return __builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma") &&
+            __builtin_cpu_supports("f16c");
+    }
+    if (name == "avx512") return __builtin_cpu_supports("avx512f");
+#endif
+    return false;
+}
+
+const KernelEntry*& active_kernel_entry() {
+    static const KernelEntry* entry = &kernel_entries()[0];
+    return entry;
+}
+
+inline PairKernel active_pair_kernel() {
+    return active_kernel_entry()->update_pair;
+}
+
+// Switch every training path to the named kernel. Returns false if the CPU does not support it.
+bool set_kernel(const string& name) {
+    for (const KernelEntry& entry : kernel_entries()) {
+        if (name == entry.name && kernel_supported(name)) {
+            active_kernel_entry() = &entry;
+            return true;
+        }
+    }
+    return false;
+}
+
+string active_kernel_name() {
+    return active_kernel_entry()->name;
+}
+
+// Decode count float16 or bfloat16 values to float32 with the active kernel.
+void decode_half(const uint16_t* src, float* dst, size_t count, int storage) {
+    const KernelEntry& entry = *active_kernel_entry();
+    RowLoader load_row = storage == STORAGE_FLOAT16 ? entry.fp16.load_row : entry.bf16.load_row;
+    const size_t chunk = 1 << 20;
+    for (size_t begin = 0; begin < count; begin += chunk) {
+        load_row(src + begin, dst + begin, min(count - begin, chunk));
+    }
+}
+
+// Walker's alias table: O(V) construction once per vocabulary and O(1) per draw.
+class AliasSampler {
+public:
+    AliasSampler() {}
+
+    AliasSampler(const vector<float>& probs) {
+        size_t n = probs.size();
+        prob_.assign(n, 0.0f);
+        alias_.assign(n, 0);
+
+        double total = 0.0;
+        for (size_t i = 0; i < n; ++i) total += probs[i];
+
+        vector<double> scaled(n);
+        vector<int> small, large;
+        for (size_t i = 0; i < n; ++i) {
+            scaled[i] = total > 0.0 ? probs[i] * n / total : 1.0;
+            if (scaled[i] < 1.0) small.push_back(i);
+            else large.push_back(i);
+        }
+        while (!small.empty() && !large.empty()) {
+            int s = small.back(), l = large.back();
+            small.pop_back();
+            prob_[s] = scaled[s];
+            alias_[s] = l;
+            scaled[l] -= 1.0 - scaled[s];
+            if (scaled[l] < 1.0) {
+                large.pop_back();
+                small.push_back(l);
+            }
+        }
+        for (int l : large) prob_[l] = 1.0f;
+        for (int s : small) prob_[s] = 1.0f;
+    }
+
+    size_t size() const { return prob_.size(); }
+
+    int operator()(mt19937& gen) const {
+        int index = (uint64_t)gen() * prob_.size() >> 32;
+        return (gen() >> 8) * (1.0f / 16777216.0f) < prob_[index] ? index : alias_[index];
+    }
+
+    vector<int> sample(size_t count, unsigned seed) const {
+        mt19937 gen(seed);
+        vector<int> samples(count);
+        for (size_t i = 0; i < count; ++i) samples[i] = (*this)(gen);
+        return samples;
+    }
+
+private:
+    vector<float> prob_;
+    vector<int> alias_;
+};
+
+// Huffman coding of the vocabulary for hierarchical softmax. Word i is a leaf, and the V - 1 inner
+// nodes are numbered 0..V-2 so that their vectors live in the first rows of w_out. The path of a
+// word runs from the root to its leaf and is stored in CSR form: points(i)[n] is the n-th inner
+// node and codes(i)[n] the branch (0 or 1) taken at it. Frequent words get short paths, so a word
+// costs O(log V) updates instead of 1 + ns_count.
+class HuffmanTree {
+public:
+    HuffmanTree() {}
+
+    HuffmanTree(const vector<long long>& counts) {
+        size_t n = counts.size();
+        offsets_.assign(n + 1, 0);
+        if (n < 2) return;
+
+        vector<int> parent(2 * n - 1, -1);
+        vector<uint8_t> branch(2 * n - 1, 0);
+        priority_queue<pair<long long, int>, vector<pair<long long, int>>, greater<pair<long long, int>>> heap;
+        for (size_t i = 0; i < n; ++i) heap.emplace(max(counts[i], 1LL), i);
+        for (size_t node = n; node < 2 * n - 1; ++node) {
+            pair<long long, int> first = heap.top();
+            heap.pop();
+            pair<long long, int> second = heap.top();
+            heap.pop();
+            parent[first.second] = parent[second.second] = node;
+            branch[second.second] = 1;
+            heap.emplace(first.first + second.first, node);
+        }
+
+        vector<int> path_points;
+        vector<uint8_t> path_codes;
+        for (size_t i = 0; i < n; ++i) {
+            path_points.clear();
+            path_codes.clear();
+            for (int node = i; parent[node] != -1; node = parent[node]) {
+                path_points.push_back(parent[node] - n);
+                path_codes.push_back(branch[node]);
+            }
+            points_.insert(points_.end(), path_points.rbegin(), path_points.rend());
+            codes_.insert(codes_.end(), path_codes.rbegin(), path_codes.rend());
+            offsets_[i + 1] = points_.size();
+        }
+    }
+
+    size_t size() const { return offsets_.size() - 1; }
+
+    unsigned length(int word) const { return offsets_[word + 1] - offsets_[word]; }
+
+    const int* points(int word) const { return points_.data() + offsets_[word]; }
+
+    const uint8_t* codes(int word) const { return codes_.data() + offsets_[word]; }
+
+private:
+    vector<int> points_;
+    vector<uint8_t> codes_;
+    vector<size_t> offsets_;
+};
+
+// Linear learning-rate decay shared by every thread and training call: the rate falls from alpha
+// to min_alpha as the number of processed words goes from 0 to total_words, like the original
+// word2vec. The word counter is atomic so that it can be read while training runs.
+class TrainingProgress {
+public:
+    TrainingProgress(float alpha, float min_alpha, long long total_words)
+        : alpha_(alpha), min_alpha_(min_alpha), total_words_(total_words), words_(0),
+          start_(chrono::steady_clock::now()) {}
+
+    // Count words processed by a thread and return the learning rate to continue with.
+    float add_words(long long count) {
+        words_.fetch_add(count, memory_order_relaxed);
+        return alpha();
+    }
+
+    float alpha() const {
+        if (total_words_ <= 0) return alpha_;
+        double progress = min((double)words() / total_words_, 1.0);
+        return max((float)(alpha_ - (alpha_ - min_alpha_) * progress), min_alpha_);
+    }
+
+    long long words() const { return words_.load(memory_order_relaxed); }
+
+    long long total_words() const { return total_words_; }
+
+    double seconds() const {
+        return chrono::duration<double>(chrono::steady_clock::now() - start_).count();
+    }
+
+private:
+    float alpha_;
+    float min_alpha_;
+    long long total_words_;
+    atomic<long long> words_;
+    chrono::steady_clock::time_point start_;
+};
+
+struct ThreadStat {
+    long long words;
+    long long pairs;
+    double loss;
+    double seconds;
+};
+
+// A minibatch of indexed texts in CSR layout, read in place: text i is the tokens from
+// offsets[i] to offsets[i + 1], and tokens of -1 are out of the vocabulary.
+struct Texts {
+    const int* tokens;
+    const long long* offsets;
+    size_t count;
+
+    size_t size() const { return count; }
+    size_t length(size_t i) const { return offsets[i + 1] - offsets[i]; }
+    const int* begin(size_t i) const { return tokens + offsets[i]; }
+    const int* end(size_t i) const { return tokens + offsets[i + 1]; }
+};
+
+// Copy the in-vocabulary tokens of text i which survive frequent-word subsampling.
+// keep_prob may be null to keep every token.
+void subsample_text(
+    const Texts& texts,
+    size_t i,
+    const float* keep_prob,
+    mt19937& gen,
+    vector<int>& sentence,
+    long long& word_count
+) {
+    sentence.clear();
+    for (const int* token = texts.begin(i); token != texts.end(i); ++token) {
+        int index = *token;
+        if (index == -1) continue;
+        ++word_count;
+        if (keep_prob && keep_prob[index] < 1.0f &&
+            (gen() >> 8) * (1.0f / 16777216.0f) >= keep_prob[index]) continue;
+        sentence.push_back(index);
+    }
+}
+
 vector<vector<int>> get_sg_ns_pairs(
-    vector<vector<int>> texts,
+    const Texts& texts,
+    size_t text_begin,
+    size_t text_end,
     unsigned window_size,
     unsigned ns_count,
-    vector<float> vocab_ns_prob
+    const AliasSampler& negative_sampler,
+    const float* keep_prob,
+    mt19937& gen,
+    long long& word_count
 ){
     vector<int> indices_in;
     vector<int> indices_out;
     vector<int> labels;
+    vector<int> sentence;
     int text_size;
     int curr_window_size;
     int index_in;
     int index_out;
 
-    mt19937 gen = mt19937(rand());
-    discrete_distribution<int> negative_sampler(vocab_ns_prob.begin(), vocab_ns_prob.end());
-
-    for (unsigned i = 0; i < texts.size(); ++i) {
-        text_size = texts[i].size();
-        for (int j = 0; j < texts[i].size(); ++j) {
-            index_in = texts[i][j];
-            if (index_in == -1) continue;
+    for (size_t i = text_begin; i < text_end; ++i) {
+        subsample_text(texts, i, keep_prob, gen, sentence, word_count);
+        text_size = sentence.size();
+        for (int j = 0; j < text_size; ++j) {
+            index_in = sentence[j];
 
             curr_window_size = gen() % window_size + 1;
-            for (int k = -curr_window_size; k < curr_window_size; ++k) {
+            for (int k = -curr_window_size; k <= curr_window_size; ++k) {
                 if (k == 0 || j + k < 0 || j + k >= text_size) continue;
-                index_out = texts[i][j + k];
-                if (index_out == -1) continue;
+                index_out = sentence[j + k];
                 indices_in.push_back(index_in);
                 indices_out.push_back(index_out);
                 labels.push_back(1);
@@ -50,7 +934,421 @@ vector<vector<int>> get_sg_ns_pairs(
     return {indices_in, indices_out, labels};
 }
 
-void update_w_naive_impl(
+// Row access of a float32 matrix: the kernels work on its rows in place.
+struct FloatRows {
+    float* data;
+    unsigned hidden_dim;
+    PairKernel pair_kernel;
+    CbowKernel cbow_kernel;
+
+    float* load(int index, float* buffer) const { return data + (size_t)index * hidden_dim; }
+
+    void store(int index, const float* row) const {}
+
+    float update_pair(float* w_in_row, int index, int label, float lr) const {
+        return pair_kernel(w_in_row, data + (size_t)index * hidden_dim, hidden_dim, label, lr);
+    }
+
+    float update_cbow(const float* context, float* neu1e, int index, int label, float lr) const {
+        return cbow_kernel(context, neu1e, data + (size_t)index * hidden_dim, hidden_dim, label, lr);
+    }
+};
+
+// Row access of a float16 or bfloat16 matrix: load converts a row into a float32 buffer and store
+// rounds it back, while the kernels convert the rows they update in registers.
+struct HalfRows {
+    uint16_t* data;
+    unsigned hidden_dim;
+    const HalfKernels* kernels;
+
+    float* load(int index, float* buffer) const {
+        kernels->load_row(data + (size_t)index * hidden_dim, buffer, hidden_dim);
+        return buffer;
+    }
+
+    void store(int index, const float* row) const {
+        kernels->store_row(row, data + (size_t)index * hidden_dim, hidden_dim);
+    }
+
+    float update_pair(float* w_in_row, int index, int label, float lr) const {
+        return kernels->update_pair(w_in_row, data + (size_t)index * hidden_dim, hidden_dim, label, lr);
+    }
+
+    float update_cbow(const float* context, float* neu1e, int index, int label, float lr) const {
+        return kernels->update_cbow(context, neu1e, data + (size_t)index * hidden_dim, hidden_dim, label, lr);
+    }
+};
+
+// Hierarchical-softmax update of one input row towards a word: one pair per inner node on the
+// word's Huffman path, with label 1 - code as in the original word2vec. Returns the summed loss.
+template <typename Rows>
+inline float update_hs_path(
+    float* w_in_row,
+    const HuffmanTree& huffman_tree,
+    int word,
+    const Rows& w_out,
+    float lr,
+    long long& pair_count
+) {
+    const int* points = huffman_tree.points(word);
+    const uint8_t* codes = huffman_tree.codes(word);
+    unsigned length = huffman_tree.length(word);
+    float loss = 0.0f;
+    for (unsigned n = 0; n < length; ++n) {
+        loss += w_out.update_pair(w_in_row, points[n], 1 - codes[n], lr);
+    }
+    pair_count += length;
+    return loss;
+}
+
+// Fused version of get_sg_ns_pairs + update: the pairs are applied as soon as they are generated,
+// so no pair vector is materialized. Consumes gen in the same order as get_sg_ns_pairs. Both w_in
+// and w_out are stored as (vocab_count, hidden_dim) and accessed through Rows; the center row is
+// loaded once and stored back after all of its pairs.
+// If huffman_tree is given, each context word is predicted by hierarchical softmax along its
+// Huffman path instead of by negative sampling, and negative_sampler may be null. If progress is
+// given, the words of every text are counted in it and lr follows its decayed rate.
+// Adds the number of trained pairs and their loss to stat.
+template <typename Rows>
+void train_sg_texts(
+    const Texts& texts,
+    size_t text_begin,
+    size_t text_end,
+    unsigned window_size,
+    unsigned ns_count,
+    const AliasSampler* negative_sampler,
+    const HuffmanTree* huffman_tree,
+    const float* keep_prob,
+    const Rows& w_in,
+    const Rows& w_out,
+    float lr,
+    TrainingProgress* progress,
+    mt19937& gen,
+    ThreadStat& stat
+) {
+    vector<int> sentence;
+    vector<float> buffer(w_in.hidden_dim);
+    float* center;
+    long long pair_count = 0;
+    long long reported_words = stat.words;
+    double loss = 0.0;
+    int text_size;
+    int curr_window_size;
+    int index_in;
+
+    for (size_t i = text_begin; i < text_end; ++i) {
+        subsample_text(texts, i, keep_prob, gen, sentence, stat.words);
+        if (progress) {
+            lr = progress->add_words(stat.words - reported_words);
+            reported_words = stat.words;
+        }
+        text_size = sentence.size();
+        for (int j = 0; j < text_size; ++j) {
+            index_in = sentence[j];
+            center = w_in.load(index_in, buffer.data());
+
+            curr_window_size = gen() % window_size + 1;
+            for (int k = -curr_window_size; k <= curr_window_size; ++k) {
+                if (k == 0 || j + k < 0 || j + k >= text_size) continue;
+                if (huffman_tree) {
+                    loss += update_hs_path(center, *huffman_tree, sentence[j + k], w_out, lr, pair_count);
+                } else {
+                    loss += w_out.update_pair(center, sentence[j + k], 1, lr);
+                    ++pair_count;
+                }
+            }
+            for (unsigned k = 0; !huffman_tree && k < ns_count; ++k) {
+                loss += w_out.update_pair(center, (*negative_sampler)(gen), 0, lr);
+                ++pair_count;
+            }
+            w_in.store(index_in, center);
+        }
+    }
+
+    stat.pairs += pair_count;
+    stat.loss += loss;
+}
+
+// CBOW counterpart of train_sg_texts: the mean of the context rows predicts the center word and
+// its negatives (or its Huffman path), then the accumulated gradient is added to every context
+// row, as in the original word2vec. Adds the number of trained pairs and their loss to stat.
+template <typename Rows>
+void train_cbow_texts(
+    const Texts& texts,
+    size_t text_begin,
+    size_t text_end,
+    unsigned window_size,
+    unsigned ns_count,
+    const AliasSampler* negative_sampler,
+    const HuffmanTree* huffman_tree,
+    const float* keep_prob,
+    const Rows& w_in,
+    const Rows& w_out,
+    float lr,
+    TrainingProgress* progress,
+    mt19937& gen,
+    ThreadStat& stat
+) {
+    unsigned hidden_dim = w_in.hidden_dim;
+    vector<int> sentence, context_indices;
+    vector<float> context(hidden_dim), neu1e(hidden_dim), buffer(hidden_dim);
+    float* row;
+    long long pair_count = 0;
+    long long reported_words = stat.words;
+    double loss = 0.0;
+    int text_size;
+    int curr_window_size;
+    int index_in;
+
+    for (size_t i = text_begin; i < text_end; ++i) {
+        subsample_text(texts, i, keep_prob, gen, sentence, stat.words);
+        if (progress) {
+            lr = progress->add_words(stat.words - reported_words);
+            reported_words = stat.words;
+        }
+        text_size = sentence.size();
+        for (int j = 0; j < text_size; ++j) {
+            curr_window_size = gen() % window_size + 1;
+            context_indices.clear();
+            for (int k = -curr_window_size; k <= curr_window_size; ++k) {
+                if (k == 0 || j + k < 0 || j + k >= text_size) continue;
+                context_indices.push_back(sentence[j + k]);
+            }
+            if (context_indices.empty()) continue;
+
+            fill(context.begin(), context.end(), 0.0f);
+            fill(neu1e.begin(), neu1e.end(), 0.0f);
+            for (int index : context_indices) {
+                row = w_in.load(index, buffer.data());
+                for (unsigned d = 0; d < hidden_dim; ++d) context[d] += row[d];
+            }
+            for (unsigned d = 0; d < hidden_dim; ++d) context[d] /= context_indices.size();
+
+            index_in = sentence[j];
+            if (huffman_tree) {
+                const int* points = huffman_tree->points(index_in);
+                const uint8_t* codes = huffman_tree->codes(index_in);
+                for (unsigned n = 0; n < huffman_tree->length(index_in); ++n) {
+                    loss += w_out.update_cbow(context.data(), neu1e.data(), points[n], 1 - codes[n], lr);
+                }
+                pair_count += huffman_tree->length(index_in);
+            } else {
+                loss += w_out.update_cbow(context.data(), neu1e.data(), index_in, 1, lr);
+                ++pair_count;
+                for (unsigned k = 0; k < ns_count; ++k) {
+                    loss += w_out.update_cbow(context.data(), neu1e.data(), (*negative_sampler)(gen), 0, lr);
+                    ++pair_count;
+                }
+            }
+
+            for (int index : context_indices) {
+                row = w_in.load(index, buffer.data());
+                for (unsigned d = 0; d < hidden_dim; ++d) row[d] += neu1e[d];
+                w_in.store(index, row);
+            }
+        }
+    }
+
+    stat.pairs += pair_count;
+    stat.loss += loss;
+}
+
+// Skip-gram with negative sampling where every block of up to block_size consecutive center
+// words of a text shares one draw of ns_count negatives. The positive pairs are trained one by
+// one as in train_sg_texts; then the block's center rows (B x d) are scored against the shared
+// negative rows (K x d) with one matrix product, and both gradients are matrix products of the
+// same operands, so the negatives run through Eigen's GEMM and each negative row is read and
+// written once per block instead of once per center. All negative pairs of a block see the rows
+// as they were after its positive pairs, as in minibatch SGD.
+// Adds the number of trained pairs and their loss to stat.
+template <typename Rows>
+void train_sg_shared_texts(
+    const Texts& texts,
+    size_t text_begin,
+    size_t text_end,
+    unsigned window_size,
+    unsigned ns_count,
+    unsigned block_size,
+    const AliasSampler& negative_sampler,
+    const float* keep_prob,
+    const Rows& w_in,
+    const Rows& w_out,
+    float lr,
+    TrainingProgress* progress,
+    mt19937& gen,
+    ThreadStat& stat
+) {
+    typedef Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> Matrix;
+    typedef Eigen::Map<Eigen::RowVectorXf> RowMap;
+    unsigned hidden_dim = w_in.hidden_dim;
+    vector<int> sentence, negatives(ns_count);
+    vector<float> buffer(hidden_dim);
+    Matrix centers, outputs, grads, center_grads, output_grads;
+    const SigmoidTable& table = sigmoid_table();
+    float* row;
+    long long pair_count = 0;
+    long long reported_words = stat.words;
+    double loss = 0.0;
+    int text_size;
+    int curr_window_size;
+
+    for (size_t i = text_begin; i < text_end; ++i) {
+        subsample_text(texts, i, keep_prob, gen, sentence, stat.words);
+        if (progress) {
+            lr = progress->add_words(stat.words - reported_words);
+            reported_words = stat.words;
+        }
+        text_size = sentence.size();
+        for (int begin = 0; begin < text_size; begin += block_size) {
+            int end = min(begin + (int)block_size, text_size);
+            centers.resize(end - begin, hidden_dim);
+            for (int j = begin; j < end; ++j) {
+                row = w_in.load(sentence[j], buffer.data());
+                curr_window_size = gen() % window_size + 1;
+                for (int k = -curr_window_size; k <= curr_window_size; ++k) {
+                    if (k == 0 || j + k < 0 || j + k >= text_size) continue;
+                    loss += w_out.update_pair(row, sentence[j + k], 1, lr);
+                    ++pair_count;
+                }
+                centers.row(j - begin) = RowMap(row, hidden_dim);
+                w_in.store(sentence[j], row);
+            }
+
+            outputs.resize(ns_count, hidden_dim);
+            for (unsigned k = 0; k < ns_count; ++k) {
+                negatives[k] = negative_sampler(gen);
+                outputs.row(k) = RowMap(w_out.load(negatives[k], buffer.data()), hidden_dim);
+            }
+            grads.noalias() = centers * outputs.transpose();
+            for (int b = 0; b < end - begin; ++b) {
+                for (unsigned k = 0; k < ns_count; ++k) {
+                    loss += table.loss(grads(b, k), 0);
+                    grads(b, k) = -table.sigmoid(grads(b, k)) * lr;
+                }
+            }
+            pair_count += (long long)(end - begin) * ns_count;
+            center_grads.noalias() = grads * outputs;
+            output_grads.noalias() = grads.transpose() * centers;
+
+            for (int j = begin; j < end; ++j) {
+                row = w_in.load(sentence[j], buffer.data());
+                RowMap(row, hidden_dim) += center_grads.row(j - begin);
+                w_in.store(sentence[j], row);
+            }
+            for (unsigned k = 0; k < ns_count; ++k) {
+                row = w_out.load(negatives[k], buffer.data());
+                RowMap(row, hidden_dim) += output_grads.row(k);
+                w_out.store(negatives[k], row);
+            }
+        }
+    }
+
+    stat.pairs += pair_count;
+    stat.loss += loss;
+}
+
+// Split texts into `workers` contiguous ranges holding roughly the same number of tokens.
+vector<size_t> split_texts(const Texts& texts, unsigned workers) {
+    size_t total = texts.size() ? texts.offsets[texts.size()] - texts.offsets[0] : 0;
+
+    vector<size_t> bounds(workers + 1, texts.size());
+    bounds[0] = 0;
+    size_t seen = 0;
+    unsigned t = 1;
+    for (size_t i = 0; i < texts.size() && t < workers; ++i) {
+        seen += texts.length(i);
+        while (t < workers && seen * workers >= total * t) bounds[t++] = i + 1;
+    }
+
+    return bounds;
+}
+
+template <typename Rows>
+vector<ThreadStat> train_hogwild_rows(
+    const Texts& texts,
+    unsigned window_size,
+    unsigned ns_count,
+    const AliasSampler* negative_sampler,
+    const HuffmanTree* huffman_tree,
+    const float* keep_prob,
+    const Rows& w_in,
+    const Rows& w_out,
+    float lr,
+    TrainingProgress* progress,
+    unsigned workers,
+    unsigned seed,
+    bool sg,
+    unsigned shared_negatives
+) {
+    if (workers == 0) workers = 1;
+
+    vector<size_t> bounds = split_texts(texts, workers);
+    vector<ThreadStat> stats(workers, ThreadStat{0, 0, 0.0, 0.0});
+
+    auto work = [&](unsigned t) {
+        auto start = chrono::steady_clock::now();
+        mt19937 gen(seed + t);
+
+        if (sg && shared_negatives && !huffman_tree) {
+            train_sg_shared_texts<Rows>(
+                texts, bounds[t], bounds[t + 1], window_size, ns_count, shared_negatives, *negative_sampler,
+                keep_prob, w_in, w_out, lr, progress, gen, stats[t]);
+        } else {
+            (sg ? train_sg_texts<Rows> : train_cbow_texts<Rows>)(
+                texts, bounds[t], bounds[t + 1], window_size, ns_count, negative_sampler, huffman_tree,
+                keep_prob, w_in, w_out, lr, progress, gen, stats[t]);
+        }
+        stats[t].seconds = chrono::duration<double>(chrono::steady_clock::now() - start).count();
+    };
+
+    vector<thread> threads;
+    for (unsigned t = 1; t < workers; ++t) threads.emplace_back(work, t);
+    work(0);
+    for (auto& th : threads) th.join();
+
+    return stats;
+}
+
+// Hogwild training: every thread trains skip-gram (sg) or CBOW on its own share of texts and
+// updates the shared w_in / w_out buffers without any locking. Thread t draws its random numbers
+// from seed + t. Negative sampling is used unless huffman_tree is given, and the learning rate is
+// lr unless progress is given. Both buffers hold elements of the given Storage. If shared_negatives
+// is positive, skip-gram with negative sampling trains blocks of that many center words against
+// shared negatives with train_sg_shared_texts.
+vector<ThreadStat> train_hogwild(
+    const Texts& texts,
+    unsigned window_size,
+    unsigned ns_count,
+    const AliasSampler* negative_sampler,
+    const HuffmanTree* huffman_tree,
+    const float* keep_prob,
+    void* w_in,
+    void* w_out,
+    int storage,
+    unsigned hidden_dim,
+    float lr,
+    TrainingProgress* progress,
+    unsigned workers,
+    unsigned seed,
+    bool sg,
+    unsigned shared_negatives
+) {
+    const KernelEntry& entry = *active_kernel_entry();
+    if (storage == STORAGE_FLOAT32) {
+        return train_hogwild_rows(
+            texts, window_size, ns_count, negative_sampler, huffman_tree, keep_prob,
+            FloatRows{(float*)w_in, hidden_dim, entry.update_pair, entry.update_cbow},
+            FloatRows{(float*)w_out, hidden_dim, entry.update_pair, entry.update_cbow},
+            lr, progress, workers, seed, sg, shared_negatives);
+    }
+    const HalfKernels* kernels = storage == STORAGE_FLOAT16 ? &entry.fp16 : &entry.bf16;
+    return train_hogwild_rows(
+        texts, window_size, ns_count, negative_sampler, huffman_tree, keep_prob,
+        HalfRows{(uint16_t*)w_in, hidden_dim, kernels}, HalfRows{(uint16_t*)w_out, hidden_dim, kernels},
+        lr, progress, workers, seed, sg, shared_negatives);
+}
+
+float update_w_naive_impl(
     float* w_in,
     float* w_out,
     unsigned vocab_count,
@@ -63,6 +1361,8 @@ void update_w_naive_impl(
     unsigned int label_count = labels.size();
     int index_in, index_out, label;
     float output, tmp_w_out;
+    double loss = 0.0;
+    const SigmoidTable& table = sigmoid_table();
 
     for (unsigned i = 0; i < label_count; ++i) {
         index_in = indices_in[i];
@@ -72,7 +1372,8 @@ void update_w_naive_impl(
         for (unsigned j = 0; j < hidden_dim; ++j) {
             output += w_in[index_in * hidden_dim + j] * w_out[index_out * hidden_dim + j];
         }
-        output = 1.0f / (1.0f + exp(-output));
+        loss += table.loss(output, labels[i]);
+        output = table.sigmoid(output);
 
         label = labels[i];
         for (unsigned j = 0; j < hidden_dim; ++j) {
@@ -81,9 +1382,11 @@ void update_w_naive_impl(
             w_in[index_in * hidden_dim + j] += (label - output) * tmp_w_out * lr;
         }
     }
+
+    return label_count ? loss / label_count : 0.0f;
 }
 
-void update_w_eigen_impl(
+float update_w_eigen_impl(
     float* w_in,
     float* w_out,
     unsigned vocab_count,
@@ -96,6 +1399,8 @@ void update_w_eigen_impl(
     unsigned int label_count = labels.size();
     int index_in, index_out, label;
     float output, tmp_w_out;
+    double loss = 0.0;
+    const SigmoidTable& table = sigmoid_table();
 
     Eigen::Map<Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>> w_in_eigen(
         w_in, vocab_count, hidden_dim);
@@ -106,7 +1411,8 @@ void update_w_eigen_impl(
         index_out = indices_out[i];
 
         output = w_in_eigen.row(index_in).dot(w_out_eigen.row(index_out));
-        output = 1.0f / (1.0f + exp(-output));
+        loss += table.loss(output, labels[i]);
+        output = table.sigmoid(output);
 
         label = labels[i];
         for (unsigned j = 0; j < hidden_dim; ++j) {
@@ -115,9 +1421,37 @@ void update_w_eigen_impl(
             w_in_eigen(index_in, j) += (label - output) * tmp_w_out * lr;
         }
     }
+
+    return label_count ? loss / label_count : 0.0f;
+}
+
+// Same as update_w_naive_impl with the kernel selected by set_kernel.
+float update_w_simd_impl(
+    float* w_in,
+    float* w_out,
+    unsigned vocab_count,
+    unsigned hidden_dim,
+    vector<int> indices_in,
+    vector<int> indices_out,
+    vector<int> labels,
+    float lr
+) {
+    PairKernel update_pair = active_pair_kernel();
+    size_t label_count = labels.size();
+    double loss = 0.0;
+
+    for (size_t i = 0; i < label_count; ++i) {
+        loss += update_pair(
+            w_in + (size_t)indices_in[i] * hidden_dim, w_out + (size_t)indices_out[i] * hidden_dim,
+            hidden_dim, labels[i], lr);
+    }
+
+    return label_count ? loss / label_count : 0.0f;
 }
 
-void update_w_avx_impl(
+#ifdef W2V_X86_DISPATCH
+__attribute__((target("avx2")))
+float update_w_avx_impl(
     float* w_in,
     float* w_out,
     unsigned vocab_count,
@@ -132,6 +1466,8 @@ void update_w_avx_impl(
     unsigned int label_count = labels.size();
     int index_in, index_out;
     float diff, output, tmp_w_out;
+    double loss = 0.0;
+    const SigmoidTable& table = sigmoid_table();
     unsigned i, j;
 
     float* lrs = (float *)_mm_malloc(alignment * sizeof(float), 32);
@@ -158,7 +1494,8 @@ void update_w_avx_impl(
             output += w_in[index_in * hidden_dim + j] * w_out[index_out * hidden_dim + j];
         }
 
-        output = 1.0f / (1.0f + exp(-output));
+        loss += table.loss(output, labels[i]);
+        output = table.sigmoid(output);
 
         diff = float(labels[i]) - output;
         for (j = 0; j < alignment; ++j) diffs[j] = diff;
@@ -203,37 +1540,25 @@ void update_w_avx_impl(
             w_in[index_in * hidden_dim + j] += diff * tmp_w_out * lr;
         }
     }
-}
-
-#include<iostream>
-float* np_to_ptr_test(float* w1, float* w2, unsigned N) {
-    float* z = (float *)_mm_malloc(N * sizeof(float), 32);
 
-    float a = 0.0f;
-    for (unsigned i = 0; i < N; i += 8) {
-        auto z = _mm256_mul_ps(
-            _mm256_loadu_ps(w1 + i), 
-            _mm256_loadu_ps(w2 + i)
-        );
-        z = _mm256_hadd_ps(z, z);
-        z = _mm256_hadd_ps(z, z);
-        a += ((float*)&z)[0] + ((float*)&z)[4];
-        cout << "-------------------" << endl;
-        cout << a << endl;
-    }
+    _mm_free(lrs);
+    _mm_free(diffs);
+    _mm_free(bufs);
 
-    return w1;
+    return label_count ? loss / label_count : 0.0f;
 }
 
-int main() {
-    unsigned N = 32;
-    float* w1 = (float *)_mm_malloc(N * sizeof(float), 16);
-    float* w2 = (float *)_mm_malloc(N * sizeof(float), 16);
-    for (unsigned i = 0; i < N; ++i) {
-        w1[i] = w2[i] = i;
-    }
-
-    // np_to_ptr_test(w1, w2, N);
-
-    return 0;
-}
\ No newline at end of file
+#else
+float update_w_avx_impl(
+    float* w_in,
+    float* w_out,
+    unsigned vocab_count,
+    unsigned hidden_dim,
+    vector<int> indices_in,
+    vector<int> indices_out,
+    vector<int> labels,
+    float lr
+) {
+    throw runtime_error("update_w_avx requires an x86 CPU.");
+}
+#endif
@@ -6,17 +6,26 @@
 # cython: cdivision=True
 # cython: embedsignature=True
 
-from libc.stdlib cimport rand
-from libc.math cimport exp
+from libcpp cimport bool as cbool
+from libcpp.string cimport string
 from libcpp.vector cimport vector
+from libc.stdint cimport uint8_t
 cimport numpy as cnp
+import os
+import warnings
 import numpy as np
 import cython
 
 ctypedef cnp.float32_t DTYPE_t
 
-cdef extern from "word2vec_impl.cpp":
-    void update_w_eigen_impl(
+cdef extern from "<random>" namespace "std":
+    cdef cppclass mt19937:
+        mt19937()
+        mt19937(unsigned int seed)
+
+# Every native function is safe to call without the GIL.
+cdef extern from "word2vec_impl.cpp" nogil:
+    float update_w_eigen_impl(
         float* w_in,
         float* w_out,
         int vocab_count,
@@ -25,7 +34,7 @@ cdef extern from "word2vec_impl.cpp":
         vector[int] indices_out,
         vector[int] labels,
         DTYPE_t lr)
-    void update_w_naive_impl(
+    float update_w_naive_impl(
         float* w_in,
         float* w_out,
         int vocab_count,
@@ -34,7 +43,16 @@ cdef extern from "word2vec_impl.cpp":
         vector[int] indices_out,
         vector[int] labels,
         DTYPE_t lr)
-    void update_w_avx_impl(
+    float update_w_avx_impl(
+        float* w_in,
+        float* w_out,
+        int vocab_count,
+        int hiddend_dim,
+        vector[int] indices_in,
+        vector[int] indices_out,
+        vector[int] labels,
+        DTYPE_t lr) except +
+    float update_w_simd_impl(
         float* w_in,
         float* w_out,
         int vocab_count,
@@ -44,211 +62,650 @@ cdef extern from "word2vec_impl.cpp":
         vector[int] labels,
         DTYPE_t lr)
 
-cdef extern from "<random>" namespace "std":
-    cdef cppclass mt19937:
-        mt19937()
-        mt19937(unsigned int seed)
+    cbool kernel_supported(const string& name)
+    cbool set_kernel_impl "set_kernel"(const string& name)
+    string active_kernel_name()
 
-    cdef cppclass discrete_distribution[T]:
-        discrete_distribution()
-        discrete_distribution(vector.iterator first, vector.iterator last)
-        T operator()(mt19937 gen)    
+    cdef cppclass SigmoidTable:
+        float max_exp()
+        size_t size()
+        float sigmoid(float x)
+        float loss(float x, int label)
 
-cdef (vector[int], vector[int], vector[int]) get_sg_ns_pairs(
-        vector[vector[int]] texts,
-        int window_size,
-        int ns_count,
-        vector[DTYPE_t] vocab_ns_prob):
-    cdef:
-        int vocab_count = vocab_ns_prob.size()
-        vector[int] indices_in
-        vector[int] indices_out
-        vector[int] labels
-        int i
-        int j
-        int k
-        int text_size
-        int curr_window_size
-        int index_in
-        int index_out
+    SigmoidTable& sigmoid_table()
+    void set_sigmoid_table_impl "set_sigmoid_table"(float max_exp, unsigned table_size)
 
-        mt19937 gen = mt19937(rand())
-        discrete_distribution[int] negative_sampler = discrete_distribution[int](vocab_ns_prob.begin(), vocab_ns_prob.end())
-        
-    for i in xrange(texts.size()):
-        text_size = texts[i].size()
-        for j in xrange(text_size):
-            index_in = texts[i][j]
-            if index_in == -1:
-                continue
-            curr_window_size = rand() % window_size + 1
-            for k in xrange(-curr_window_size, curr_window_size):
-                if k == 0 or j + k < 0 or j + k >= text_size:
-                    continue
-                index_out = texts[i][j + k]
-                if index_out == -1:
-                    continue
-                indices_in.push_back(index_in)
-                indices_out.push_back(index_out)
-                labels.push_back(1)
-            
-            for k in xrange(ns_count):
-                index_out = negative_sampler(gen)
-                indices_in.push_back(index_in)
-                indices_out.push_back(index_out)
-                labels.push_back(0)
-
-    return (indices_in, indices_out, labels)
-
-cdef void update_w_cython_impl(
-        cnp.ndarray[DTYPE_t, ndim=2] w_in,
-        cnp.ndarray[DTYPE_t, ndim=2] w_out,
-        vector[int] indices_in,
-        vector[int] indices_out,
-        vector[int] labels,
-        DTYPE_t lr):
+    cdef cppclass AliasSampler:
+        AliasSampler()
+        AliasSampler(const vector[DTYPE_t]& probs)
+        size_t size()
+        vector[int] sample(size_t count, unsigned seed)
+
+    cdef cppclass HuffmanTreeImpl "HuffmanTree":
+        HuffmanTreeImpl()
+        HuffmanTreeImpl(const vector[long long]& counts)
+        size_t size()
+        unsigned length(int word)
+        const int* points(int word)
+        const uint8_t* codes(int word)
+
+    cdef cppclass TrainingProgressImpl "TrainingProgress":
+        TrainingProgressImpl(float alpha, float min_alpha, long long total_words)
+        float alpha()
+        long long words()
+        long long total_words()
+        double seconds()
+
+    cdef struct ThreadStat:
+        long long words
+        long long pairs
+        double loss
+        double seconds
+
+    cdef cppclass Texts:
+        const int* tokens
+        const long long* offsets
+        size_t count
+
+    enum:
+        STORAGE_FLOAT32
+        STORAGE_FLOAT16
+        STORAGE_BFLOAT16
+
+    void decode_half(const cnp.uint16_t* src, float* dst, size_t count, int storage)
+
+    vector[vector[int]] get_sg_ns_pairs_impl "get_sg_ns_pairs"(
+        const Texts& texts,
+        size_t text_begin,
+        size_t text_end,
+        unsigned window_size,
+        unsigned ns_count,
+        const AliasSampler& negative_sampler,
+        const float* keep_prob,
+        mt19937& gen,
+        long long& word_count)
+
+    vector[ThreadStat] train_hogwild(
+        const Texts& texts,
+        unsigned window_size,
+        unsigned ns_count,
+        const AliasSampler* negative_sampler,
+        const HuffmanTreeImpl* huffman_tree,
+        const float* keep_prob,
+        void* w_in,
+        void* w_out,
+        int storage,
+        unsigned hidden_dim,
+        DTYPE_t lr,
+        TrainingProgressImpl* progress,
+        unsigned workers,
+        unsigned seed,
+        cbool sg,
+        unsigned shared_negatives)
+
+KERNELS = ('scalar', 'avx2', 'avx512')
+
+def supported_kernels():
+    """
+    Return the names of the kernels which the CPU can run, from the slowest to the fastest.
+    """
+    return [name for name in KERNELS if kernel_supported(name.encode())]
+
+def set_kernel(name=None):
+    """
+    Select the kernel used by get_sg_ns_grad and update_w_simd. None selects the fastest one.
+    Must not be called while training is running.
+    """
+    if name is None:
+        kernels = supported_kernels()
+        name = kernels[len(kernels) - 1]
+    if not set_kernel_impl(name.encode()):
+        raise ValueError('Kernel {} is not supported by this CPU or build.'.format(name))
+
+def active_kernel():
+    """
+    Return the name of the kernel in use.
+    """
+    return active_kernel_name().decode()
+
+def set_sigmoid_table(float max_exp=6.0, unsigned table_size=1000):
+    """
+    Replace the sigmoid table shared by every kernel. Inputs beyond +-max_exp are clamped.
+    Must not be called while training is running.
+    """
+    if max_exp <= 0 or table_size == 0:
+        raise ValueError('max_exp and table_size must be positive.')
+    set_sigmoid_table_impl(max_exp, table_size)
+
+def get_sigmoid_table():
+    """
+    Return the max_exp and table_size of the sigmoid table in use.
+    """
+    return sigmoid_table().max_exp(), sigmoid_table().size()
+
+cdef float update_w_cython_impl(
+        DTYPE_t[:, ::1] w_in,
+        DTYPE_t[:, ::1] w_out,
+        const vector[int]& indices_in,
+        const vector[int]& indices_out,
+        const vector[int]& labels,
+        DTYPE_t lr) noexcept nogil:
     cdef:
         int i
         int j
         int label_count = labels.size()
-        int hidden_dim = w_in.shape[0]
+        int hidden_dim = w_in.shape[1]
         int index_in
         int index_out
         int label
         DTYPE_t output
         DTYPE_t tmp_w_out
+        double loss = 0.0
 
-    for i in xrange(label_count):
+    for i in range(label_count):
         index_in = indices_in[i]
         index_out = indices_out[i]
 
         output = 0.0
         for j in range(hidden_dim):
-            output += w_in[j, index_in] * w_out[index_out, j]
-        output = 1.0 / (1.0 + exp(-output))
-
+            output += w_in[index_in, j] * w_out[index_out, j]
         label = labels[i]
+        loss += sigmoid_table().loss(output, label)
+        output = sigmoid_table().sigmoid(output)
+
         for j in range(hidden_dim):
             tmp_w_out = w_out[index_out, j]
-            w_out[index_out, j] += (label - output) * w_in[j, index_in] * lr
-            w_in[j, index_in] += (label - output) * tmp_w_out * lr
+            w_out[index_out, j] += (label - output) * w_in[index_in, j] * lr
+            w_in[index_in, j] += (label - output) * tmp_w_out * lr
+
+    return loss / label_count if label_count else 0.0
 
 def update_w_naive(
-        cnp.ndarray[DTYPE_t, ndim=2] w_in,
-        cnp.ndarray[DTYPE_t, ndim=2] w_out,
+        DTYPE_t[:, ::1] w_in,
+        DTYPE_t[:, ::1] w_out,
         vector[int] indices_in,
         vector[int] indices_out,
         vector[int] labels,
         DTYPE_t lr,
     ):
-    cdef:
-        int vocab_count = w_in.shape[0]
-        int hidden_dim = w_in.shape[1]
-        vector[vector[int]] pairs
-        vector[DTYPE_t] losses
-        cnp.float32_t[:, ::1] w_in_cnp
-        cnp.float32_t[:, ::1] w_out_cnp
-
-    w_in_cnp = np.ascontiguousarray(w_in, dtype=np.float32)
-    w_out_cnp = np.ascontiguousarray(w_out, dtype=np.float32)
-
-    update_w_naive_impl(
-        &w_in_cnp[0, 0],
-        &w_out_cnp[0, 0],
-        vocab_count,
-        hidden_dim,
-        indices_in,
-        indices_out,
-        labels,
-        lr,
-    )
+    cdef float loss
+
+    with nogil:
+        loss = update_w_naive_impl(
+            &w_in[0, 0],
+            &w_out[0, 0],
+            w_in.shape[0],
+            w_in.shape[1],
+            indices_in,
+            indices_out,
+            labels,
+            lr,
+        )
+
+    return loss
 
 def update_w_eigen(
-        cnp.ndarray[DTYPE_t, ndim=2] w_in,
-        cnp.ndarray[DTYPE_t, ndim=2] w_out,
+        DTYPE_t[:, ::1] w_in,
+        DTYPE_t[:, ::1] w_out,
         vector[int] indices_in,
         vector[int] indices_out,
         vector[int] labels,
         DTYPE_t lr,
     ):
-    cdef:
-        int vocab_count = w_in.shape[0]
-        int hidden_dim = w_in.shape[1]
-        vector[vector[int]] pairs
-        vector[DTYPE_t] losses
-        cnp.float32_t[:, ::1] w_in_cnp = np.ascontiguousarray(w_in, dtype=np.float32)
-        cnp.float32_t[:, ::1] w_out_cnp = np.ascontiguousarray(w_out, dtype=np.float32)
-
-    update_w_eigen_impl(
-        &w_in_cnp[0, 0],
-        &w_out_cnp[0, 0],
-        vocab_count,
-        hidden_dim,
-        indices_in,
-        indices_out,
-        labels,
-        lr,
-    )
+    cdef float loss
+
+    with nogil:
+        loss = update_w_eigen_impl(
+            &w_in[0, 0],
+            &w_out[0, 0],
+            w_in.shape[0],
+            w_in.shape[1],
+            indices_in,
+            indices_out,
+            labels,
+            lr,
+        )
+
+    return loss
+
+def update_w_simd(
+        DTYPE_t[:, ::1] w_in,
+        DTYPE_t[:, ::1] w_out,
+        vector[int] indices_in,
+        vector[int] indices_out,
+        vector[int] labels,
+        DTYPE_t lr,
+    ):
+    cdef float loss
+
+    with nogil:
+        loss = update_w_simd_impl(
+            &w_in[0, 0],
+            &w_out[0, 0],
+            w_in.shape[0],
+            w_in.shape[1],
+            indices_in,
+            indices_out,
+            labels,
+            lr,
+        )
+
+    return loss
 
 def update_w_avx(
-        cnp.ndarray[DTYPE_t, ndim=2] w_in,
-        cnp.ndarray[DTYPE_t, ndim=2] w_out,
+        DTYPE_t[:, ::1] w_in,
+        DTYPE_t[:, ::1] w_out,
         vector[int] indices_in,
         vector[int] indices_out,
         vector[int] labels,
         DTYPE_t lr,
     ):
-    cdef:
-        int vocab_count = w_in.shape[0]
-        int hidden_dim = w_in.shape[1]
-        vector[vector[int]] pairs
-        vector[DTYPE_t] losses
-        cnp.float32_t[:, ::1] w_in_cnp = np.ascontiguousarray(w_in, dtype=np.float32)
-        cnp.float32_t[:, ::1] w_out_cnp = np.ascontiguousarray(w_out, dtype=np.float32)
-
-    update_w_avx_impl(
-        &w_in_cnp[0, 0],
-        &w_out_cnp[0, 0],
-        vocab_count,
-        hidden_dim,
-        indices_in,
-        indices_out,
-        labels,
-        lr,
-    )
+    cdef float loss
+
+    if not kernel_supported(b'avx2'):
+        raise RuntimeError('update_w_avx requires a CPU with AVX2.')
+
+    with nogil:
+        loss = update_w_avx_impl(
+            &w_in[0, 0],
+            &w_out[0, 0],
+            w_in.shape[0],
+            w_in.shape[1],
+            indices_in,
+            indices_out,
+            labels,
+            lr,
+        )
+
+    return loss
 
 def update_w_cython(
-        cnp.ndarray[DTYPE_t, ndim=2] w_in,
-        cnp.ndarray[DTYPE_t, ndim=2] w_out,
+        DTYPE_t[:, ::1] w_in,
+        DTYPE_t[:, ::1] w_out,
         vector[int] indices_in,
         vector[int] indices_out,
         vector[int] labels,
         DTYPE_t lr):
-    update_w_cython_impl(
+    cdef float loss
+
+    with nogil:
+        loss = update_w_cython_impl(w_in, w_out, indices_in, indices_out, labels, lr)
+
+    return loss
+
+cdef class NegativeSampler:
+    """
+    Hold an alias table of the negative sampling distribution so that it is built only once
+    per vocabulary and shared by every training call and thread.
+    """
+    cdef AliasSampler sampler
+
+    def __init__(self, vector[DTYPE_t] vocab_ns_prob):
+        with nogil:
+            self.sampler = AliasSampler(vocab_ns_prob)
+
+    def __len__(self):
+        return self.sampler.size()
+
+    def sample(self, size_t count, unsigned seed=0):
+        cdef vector[int] samples
+        with nogil:
+            samples = self.sampler.sample(count, seed)
+        return np.array(samples, dtype=np.int32)
+
+cdef class HuffmanTree:
+    """
+    Hold the Huffman coding of a vocabulary for hierarchical softmax. Inner node n of the tree is
+    trained through row n of w_out, so w_out needs at least len(tree) - 1 rows.
+    """
+    cdef HuffmanTreeImpl tree
+
+    def __init__(self, vector[long long] counts):
+        with nogil:
+            self.tree = HuffmanTreeImpl(counts)
+
+    def __len__(self):
+        return self.tree.size()
+
+    def path(self, int word):
+        """
+        Return the inner nodes from the root to the leaf of word and the branch taken at each one.
+        """
+        if word < 0 or <size_t>word >= self.tree.size():
+            raise IndexError('word {} is out of the vocabulary.'.format(word))
+        cdef:
+            unsigned length = self.tree.length(word)
+            const int* points_ptr = self.tree.points(word)
+            const uint8_t* codes_ptr = self.tree.codes(word)
+            unsigned n
+        points = np.empty(length, dtype=np.int32)
+        codes = np.empty(length, dtype=np.uint8)
+        for n in range(length):
+            points[n] = points_ptr[n]
+            codes[n] = codes_ptr[n]
+        return points, codes
+
+cdef class TrainingProgress:
+    """
+    Decay the learning rate linearly from alpha to min_alpha over total_words processed words,
+    counted by every thread of every training call it is passed to. Its properties can be read from
+    another thread while training runs.
+    """
+    cdef TrainingProgressImpl* progress
+
+    def __cinit__(self, float alpha, float min_alpha=0.0001, long long total_words=0):
+        self.progress = new TrainingProgressImpl(alpha, min_alpha, total_words)
+
+    def __dealloc__(self):
+        del self.progress
+
+    @property
+    def alpha(self):
+        return self.progress.alpha()
+
+    @property
+    def words(self):
+        return self.progress.words()
+
+    @property
+    def total_words(self):
+        return self.progress.total_words()
+
+    @property
+    def seconds(self):
+        return self.progress.seconds()
+
+    @property
+    def words_per_sec(self):
+        return self.progress.words() / max(self.progress.seconds(), 1e-9)
+
+cdef const float* keep_prob_pointer(const cnp.float32_t[::1] keep_prob, size_t vocab_count) except? NULL:
+    if keep_prob is None:
+        return NULL
+    if <size_t>keep_prob.shape[0] != vocab_count:
+        raise ValueError('keep_prob must have one probability per word.')
+    return &keep_prob[0]
+
+cdef tuple csr_arrays(texts):
+    """
+    Return texts as an int32 token array and an int64 offset array in CSR layout. A (tokens,
+    offsets) pair of contiguous arrays of these types is returned without copying.
+    """
+    cdef:
+        Py_ssize_t i = 0
+        Py_ssize_t text_index
+        cnp.int64_t[::1] offsets_view
+        cnp.int32_t[::1] tokens_view
+
+    if isinstance(texts, tuple):
+        tokens, offsets = texts
+        return np.ascontiguousarray(tokens, dtype=np.int32), np.ascontiguousarray(offsets, dtype=np.int64)
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    offsets_view = offsets
+    for text_index, text in enumerate(texts):
+        offsets_view[text_index + 1] = offsets_view[text_index] + len(text)
+    tokens = np.empty(offsets_view[len(texts)], dtype=np.int32)
+    tokens_view = tokens
+    for text in texts:
+        for token in text:
+            tokens_view[i] = token
+            i += 1
+    return tokens, offsets
+
+cdef Texts texts_view(
+        const cnp.int32_t[::1] tokens, const cnp.int64_t[::1] offsets, size_t vocab_count) except *:
+    """
+    Point a Texts at the arrays of csr_arrays, which must outlive it, after checking the offsets
+    and that the tokens are -1 or word indices below vocab_count, since the native loops index the
+    matrices with them unchecked.
+    """
+    cdef:
+        Texts texts
+        Py_ssize_t i
+        cbool valid = offsets.shape[0] > 0 and offsets[0] >= 0
+
+    if valid:
+        with nogil:
+            for i in range(1, offsets.shape[0]):
+                if offsets[i] < offsets[i - 1]:
+                    valid = False
+                    break
+        valid = valid and offsets[offsets.shape[0] - 1] <= tokens.shape[0]
+    if not valid:
+        raise ValueError('offsets must not decrease from 0 or more up to at most len(tokens).')
+    with nogil:
+        for i in range(tokens.shape[0]):
+            if tokens[i] < -1 or <cnp.int64_t>tokens[i] >= <cnp.int64_t>vocab_count:
+                valid = False
+                break
+    if not valid:
+        raise ValueError('tokens must be -1 or word indices below {}.'.format(vocab_count))
+
+    texts.tokens = <const int*>&tokens[0] if tokens.shape[0] else NULL
+    texts.offsets = <const long long*>&offsets[0]
+    texts.count = offsets.shape[0] - 1
+    return texts
+
+def get_sg_ns_pairs(
+        texts,
+        int window_size,
+        int ns_count,
+        NegativeSampler negative_sampler,
+        unsigned seed=0,
+        const cnp.float32_t[::1] keep_prob=None):
+    """
+    Return the (index_in, index_out, label) pairs which get_sg_ns_grad trains on with one thread
+    and the same seed.
+    """
+    cdef:
+        const float* keep_prob_ptr = keep_prob_pointer(keep_prob, negative_sampler.sampler.size())
+        tuple arrays = csr_arrays(texts)
+        Texts batch = texts_view(arrays[0], arrays[1], negative_sampler.sampler.size())
+        mt19937 gen = mt19937(seed)
+        long long word_count = 0
+        vector[vector[int]] pairs
+
+    with nogil:
+        pairs = get_sg_ns_pairs_impl(
+            batch, 0, batch.count, window_size, ns_count, negative_sampler.sampler, keep_prob_ptr,
+            gen, word_count)
+
+    return tuple(np.array(values, dtype=np.int32) for values in pairs)
+
+cdef int storage_of(matrix) except -1:
+    if matrix.dtype == np.float32:
+        return STORAGE_FLOAT32
+    if matrix.dtype == np.float16:
+        return STORAGE_FLOAT16
+    if matrix.dtype == np.uint16:
+        return STORAGE_BFLOAT16
+    raise ValueError(
+        'Unsupported dtype {}: use float32, float16 or uint16 holding bfloat16.'.format(matrix.dtype))
+
+cdef void* matrix_pointer(matrix, int storage) except NULL:
+    cdef:
+        cnp.float32_t[:, ::1] float_view
+        cnp.uint16_t[:, ::1] half_view
+    if storage == STORAGE_FLOAT32:
+        float_view = matrix
+        return &float_view[0, 0]
+    # Memoryviews have no float16 format, so float16 rows are passed as their raw bits.
+    half_view = matrix.view(np.uint16)
+    return &half_view[0, 0]
+
+def to_float32(values):
+    """
+    Decode float16 or uint16 (bfloat16) values to a new float32 array with the active kernel.
+    float32 values are returned as they are.
+    """
+    cdef:
+        int storage = storage_of(values)
+        const cnp.uint16_t[::1] src
+        cnp.float32_t[::1] dst
+    if storage == STORAGE_FLOAT32:
+        return values
+    result = np.empty(values.shape, dtype=np.float32)
+    if result.size:
+        src = np.ascontiguousarray(values).view(np.uint16).reshape(-1)
+        dst = result.reshape(-1)
+        with nogil:
+            decode_half(&src[0], &dst[0], src.shape[0], storage)
+    return result
+
+cdef list train(
+        texts,
+        int window_size,
+        int ns_count,
+        NegativeSampler negative_sampler,
+        HuffmanTree huffman_tree,
         w_in,
         w_out,
-        indices_in,
-        indices_out,
-        labels,
-        lr,
-    )
+        DTYPE_t lr,
+        int workers,
+        const cnp.float32_t[::1] keep_prob,
+        unsigned seed,
+        TrainingProgress progress,
+        cbool sg,
+        unsigned shared_negatives=0):
+    cdef:
+        int storage = storage_of(w_in)
+        tuple arrays = csr_arrays(texts)
+        Texts batch
+        unsigned vocab_count
+        unsigned hidden_dim
+        const float* keep_prob_ptr
+        void* w_in_ptr
+        void* w_out_ptr
+        const AliasSampler* sampler_ptr = NULL
+        const HuffmanTreeImpl* tree_ptr = NULL
+        TrainingProgressImpl* progress_ptr = progress.progress if progress is not None else NULL
+        vector[ThreadStat] stats
+
+    if w_in.ndim != 2 or w_in.shape != w_out.shape:
+        raise ValueError('w_in and w_out must both have the shape (vocab_count, hidden_dim).')
+    if w_out.dtype != w_in.dtype:
+        raise ValueError('w_in and w_out must have the same dtype.')
+    vocab_count, hidden_dim = w_out.shape
+    batch = texts_view(arrays[0], arrays[1], vocab_count)
+    keep_prob_ptr = keep_prob_pointer(keep_prob, vocab_count)
+    w_in_ptr = matrix_pointer(w_in, storage)
+    w_out_ptr = matrix_pointer(w_out, storage)
+    if huffman_tree is not None:
+        if huffman_tree.tree.size() != vocab_count:
+            raise ValueError('huffman_tree must code every word of w_out.')
+        tree_ptr = &huffman_tree.tree
+    else:
+        if negative_sampler.sampler.size() != vocab_count:
+            raise ValueError('negative_sampler must draw from every word of w_out.')
+        sampler_ptr = &negative_sampler.sampler
+
+    with nogil:
+        stats = train_hogwild(
+            batch, window_size, ns_count, sampler_ptr, tree_ptr, keep_prob_ptr,
+            w_in_ptr, w_out_ptr, storage, hidden_dim, lr, progress_ptr, max(workers, 1), seed, sg,
+            shared_negatives)
+
+    return stats
 
 def get_sg_ns_grad(
-        vector[vector[int]] texts,
+        texts,
         int window_size,
         int ns_count,
-        vector[DTYPE_t] vocab_ns_prob,
-        cnp.ndarray[DTYPE_t, ndim=2] w_in,
-        cnp.ndarray[DTYPE_t, ndim=2] w_out,
-        DTYPE_t lr):
-    cdef:
-        vector[int] indices_in
-        vector[int] indices_out
-        vector[int] labels
-        cnp.ndarray[int, ndim=2] pairs
-        vector[DTYPE_t] losses
-    
-    indices_in, indices_out, labels = get_sg_ns_pairs(texts, window_size, ns_count, vocab_ns_prob)
-    update_w_cython(w_in, w_out, indices_in, indices_out, labels, lr)
-
-    return 0
+        NegativeSampler negative_sampler not None,
+        cnp.ndarray w_in,
+        cnp.ndarray w_out,
+        DTYPE_t lr,
+        int workers=1,
+        const cnp.float32_t[::1] keep_prob=None,
+        unsigned seed=0,
+        TrainingProgress progress=None,
+        unsigned shared_negatives=0):
+    """
+    Train skip-gram with negative sampling on texts with Hogwild threads.
+
+    texts is a list of indexed texts, or a (tokens, offsets) pair in CSR layout where text i is
+    tokens[offsets[i]: offsets[i + 1]]; int32 tokens and int64 offsets are read in place without
+    copying, e.g. from memory-mapped files. Tokens of -1 are skipped as out of the vocabulary.
+    The pairs are generated and applied in one pass without being materialized.
+    w_in and w_out are C-contiguous with the shape (vocab_count, hidden_dim) and are updated in
+    place without the GIL. They are float32, float16, or uint16 holding the upper half of float32
+    (bfloat16); half-precision rows are computed on in float32 and rounded back to nearest even.
+    Each token is kept with probability keep_prob[token] if keep_prob is given. If progress is
+    given, the learning rate follows its decay instead of lr and the processed words are counted
+    in it. If shared_negatives is positive, every block of that many consecutive center words of a
+    text shares one draw of ns_count negatives, trained with matrix products through Eigen instead
+    of pair by pair. Returns the word count, pair count, summed negative-sampling loss and
+    elapsed seconds of each thread.
+    """
+    return train(
+        texts, window_size, ns_count, negative_sampler, None, w_in, w_out, lr, workers, keep_prob,
+        seed, progress, True, shared_negatives)
+
+def get_cbow_ns_grad(
+        texts,
+        int window_size,
+        int ns_count,
+        NegativeSampler negative_sampler not None,
+        cnp.ndarray w_in,
+        cnp.ndarray w_out,
+        DTYPE_t lr,
+        int workers=1,
+        const cnp.float32_t[::1] keep_prob=None,
+        unsigned seed=0,
+        TrainingProgress progress=None):
+    """
+    Train CBOW with negative sampling on texts with Hogwild threads: one update per center word
+    from the mean of its context. The arguments and the return value are those of get_sg_ns_grad.
+    """
+    return train(
+        texts, window_size, ns_count, negative_sampler, None, w_in, w_out, lr, workers, keep_prob,
+        seed, progress, False)
+
+def get_sg_hs_grad(
+        texts,
+        int window_size,
+        HuffmanTree huffman_tree not None,
+        cnp.ndarray w_in,
+        cnp.ndarray w_out,
+        DTYPE_t lr,
+        int workers=1,
+        const cnp.float32_t[::1] keep_prob=None,
+        unsigned seed=0,
+        TrainingProgress progress=None):
+    """
+    Train skip-gram with hierarchical softmax: each context word is predicted along its Huffman
+    path, whose inner nodes are the rows of w_out. Otherwise the same as get_sg_ns_grad.
+    """
+    return train(
+        texts, window_size, 0, None, huffman_tree, w_in, w_out, lr, workers, keep_prob, seed,
+        progress, True)
+
+def get_cbow_hs_grad(
+        texts,
+        int window_size,
+        HuffmanTree huffman_tree not None,
+        cnp.ndarray w_in,
+        cnp.ndarray w_out,
+        DTYPE_t lr,
+        int workers=1,
+        const cnp.float32_t[::1] keep_prob=None,
+        unsigned seed=0,
+        TrainingProgress progress=None):
+    """
+    Train CBOW with hierarchical softmax. The arguments and the return value are those of
+    get_sg_hs_grad.
+    """
+    return train(
+        texts, window_size, 0, None, huffman_tree, w_in, w_out, lr, workers, keep_prob, seed,
+        progress, False)
+
+def _select_kernel_on_import():
+    name = os.environ.get('MLTOOLS_W2V_KERNEL')
+    if name and name not in supported_kernels():
+        warnings.warn(
+            'MLTOOLS_W2V_KERNEL={} is not supported by this CPU or build; '
+            'the fastest supported kernel is used instead.'.format(name))
+        name = None
+    set_kernel(name)
+
+_select_kernel_on_import()
@@ -0,0 +1,363 @@
+"""
+Define a pure NumPy word2vec engine with the interface of word2vec_impl_cython, used when the
+native extension is not built. Pairs are generated for a whole minibatch of texts at once with
+stride tricks and applied in blocks with scatter-adds, so every block is one dense SGD step instead
+of one step per pair. It is an order of magnitude slower than the native engine and meant to keep
+the model usable, not to train large corpora.
+
+Both engines store the matrices as float32, float16 or bfloat16. NumPy has no bfloat16, so it is
+held as uint16 bits; to_float32 and from_float32 convert between the storage and float32.
+"""
+from typing import Dict, List, Optional, Tuple, Union
+import heapq
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+BLOCK_WORDS = 64
+MAX_ROW_UPDATES = 16
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16}
+
+def to_float32(values: np.ndarray) -> np.ndarray:
+    """
+    Decode values of a storage dtype to float32. uint16 values are read as bfloat16.
+    """
+    if values.dtype == np.uint16:
+        return (values.astype(np.uint32) << 16).view(np.float32)
+    return values.astype(np.float32, copy=False)
+
+def from_float32(values: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    Round float32 values to nearest even in a storage dtype, like the native engine.
+    """
+    if dtype == np.uint16:
+        bits = np.asarray(values, dtype=np.float32).view(np.uint32)
+        return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+    return values.astype(dtype, copy=False)
+
+class NegativeSampler:
+    """
+    Draw negative samples from vocab_ns_prob by inverse transform sampling on its cumulative sum.
+    """
+    def __init__(self, vocab_ns_prob: List[float]):
+        cdf = np.cumsum(np.asarray(vocab_ns_prob, dtype=np.float64))
+        self._cdf = cdf / cdf[-1] if len(cdf) and cdf[-1] > 0 else \
+            np.arange(1, len(cdf) + 1, dtype=np.float64) / max(len(cdf), 1)
+
+    def __len__(self):
+        return len(self._cdf)
+
+    def draw(self, count: int, random_state: np.random.RandomState) -> np.ndarray:
+        indices = np.searchsorted(self._cdf, random_state.random_sample(count), side='right')
+        return np.minimum(indices, len(self._cdf) - 1).astype(np.int32)
+
+    def sample(self, count: int, seed: int = 0) -> np.ndarray:
+        return self.draw(count, np.random.RandomState(seed))
+
+class HuffmanTree:
+    """
+    Huffman coding of a vocabulary for hierarchical softmax, numbered like the native one: inner
+    node n of the tree is trained through row n of w_out and the root is node len(counts) - 2.
+    """
+    def __init__(self, counts: List[int]):
+        count = len(counts)
+        parent = np.full(max(2 * count - 1, 0), -1, dtype=np.int64)
+        branch = np.zeros(max(2 * count - 1, 0), dtype=np.uint8)
+        heap = [(max(int(freq), 1), index) for index, freq in enumerate(counts)]
+        heapq.heapify(heap)
+        for node in range(count, 2 * count - 1):
+            first, second = heapq.heappop(heap), heapq.heappop(heap)
+            parent[first[1]] = parent[second[1]] = node
+            branch[second[1]] = 1
+            heapq.heappush(heap, (first[0] + second[0], node))
+
+        points, codes, self.offsets = [], [], np.zeros(count + 1, dtype=np.int64)
+        for word in range(count):
+            path_points, path_codes, node = [], [], word
+            while count > 1 and parent[node] != -1:
+                path_points.append(parent[node] - count)
+                path_codes.append(branch[node])
+                node = parent[node]
+            points.extend(reversed(path_points))
+            codes.extend(reversed(path_codes))
+            self.offsets[word + 1] = len(points)
+        self.points = np.array(points, dtype=np.int32)
+        self.codes = np.array(codes, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def path(self, word: int) -> Tuple[np.ndarray, np.ndarray]:
+        if not 0 <= word < len(self):
+            raise IndexError('word {} is out of the vocabulary.'.format(word))
+        begin, end = self.offsets[word], self.offsets[word + 1]
+        return self.points[begin: end].copy(), self.codes[begin: end].copy()
+
+    def expand(self, words: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Concatenate the paths of words. Returns the index in words of every inner node visited,
+        the inner nodes and their labels 1 - code.
+        """
+        lengths = self.offsets[words + 1] - self.offsets[words]
+        owners = np.repeat(np.arange(len(words)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(np.sum(lengths)) - starts[owners] + self.offsets[words][owners]
+        return owners, self.points[positions], 1 - self.codes[positions].astype(np.int32)
+
+class TrainingProgress:
+    """
+    Linear decay of the learning rate from alpha to min_alpha over total_words processed words,
+    like word2vec_impl_cython.TrainingProgress.
+    """
+    def __init__(self, alpha: float, min_alpha: float = 0.0001, total_words: int = 0):
+        self._alpha = alpha
+        self._min_alpha = min_alpha
+        self.total_words = total_words
+        self.words = 0
+        self._start = time.perf_counter()
+
+    def add_words(self, count: int) -> float:
+        self.words += count
+        return self.alpha
+
+    @property
+    def alpha(self) -> float:
+        if self.total_words <= 0:
+            return self._alpha
+        progress = min(self.words / self.total_words, 1.0)
+        return max(self._alpha - (self._alpha - self._min_alpha) * progress, self._min_alpha)
+
+    @property
+    def seconds(self) -> float:
+        return time.perf_counter() - self._start
+
+    @property
+    def words_per_sec(self) -> float:
+        return self.words / max(self.seconds, 1e-9)
+
+def _windows(
+        texts: Union[List[List[int]], Tuple[np.ndarray, np.ndarray]],
+        window_size: int,
+        keep_prob: Optional[np.ndarray],
+        random_state: np.random.RandomState) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Subsample texts and return their tokens as centers, the (center, 2 * window_size) matrix of
+    their contexts within a reduced window (-1 outside of it) and the number of in-vocabulary
+    tokens before subsampling. texts may also be a (tokens, offsets) pair in CSR layout.
+    """
+    if isinstance(texts, tuple):
+        tokens, offsets = texts
+        texts = [tokens[offsets[i]: offsets[i + 1]] for i in range(len(offsets) - 1)]
+    pad = np.full(window_size, -1, dtype=np.int64)
+    sentences, word_count = [pad], 0
+    for text in texts:
+        sentence = np.asarray(text, dtype=np.int64)
+        sentence = sentence[sentence != -1]
+        word_count += len(sentence)
+        if keep_prob is not None:
+            sentence = sentence[random_state.random_sample(len(sentence)) < keep_prob[sentence]]
+        sentences.extend([sentence, pad])
+    flat = np.concatenate(sentences)
+    if len(flat) < 2 * window_size + 1:
+        # No text has any token left.
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 2 * window_size), dtype=np.int64), word_count
+
+    windows = sliding_window_view(flat, 2 * window_size + 1)
+    windows = windows[windows[:, window_size] != -1]
+    centers = windows[:, window_size]
+    contexts = np.delete(windows, window_size, axis=1)
+
+    # Every text is surrounded by window_size paddings, so no window crosses two texts.
+    offsets = np.abs(np.delete(np.arange(-window_size, window_size + 1), window_size))
+    reduced_windows = random_state.randint(1, window_size + 1, len(centers))
+    contexts = np.where(offsets[None, :] <= reduced_windows[:, None], contexts, -1)
+
+    return centers, contexts, word_count
+
+def _update_groups(
+        w_in: np.ndarray,
+        w_out: np.ndarray,
+        input_groups: np.ndarray,
+        input_words: np.ndarray,
+        target_groups: np.ndarray,
+        targets: np.ndarray,
+        labels: np.ndarray,
+        lr: float) -> float:
+    """
+    One minibatch SGD step. Group g predicts targets[target_groups == g] from the mean of the
+    rows input_words[input_groups == g] of w_in. The step is computed in float32 whatever the
+    storage dtype. Returns the summed loss.
+    """
+    group_count = int(input_groups.max()) + 1 if len(input_groups) else 0
+    hidden = np.zeros((group_count, w_in.shape[1]), dtype=np.float32)
+    _scatter_add(hidden, input_groups, to_float32(w_in[input_words]))
+    hidden /= np.maximum(np.bincount(input_groups, minlength=group_count), 1)[:, None]
+
+    outputs = to_float32(w_out[targets])
+    scores = np.einsum('ij,ij->i', hidden[target_groups], outputs)
+    loss = np.sum(np.logaddexp(0.0, np.where(labels == 1, -scores, scores)))
+    grads = ((labels - 0.5 * (1.0 + np.tanh(0.5 * scores))) * lr).astype(np.float32)
+
+    hidden_grads = np.zeros_like(hidden)
+    _scatter_add(hidden_grads, target_groups, grads[:, None] * outputs)
+    _scatter_add(w_out, targets, grads[:, None] * hidden[target_groups], MAX_ROW_UPDATES)
+    _scatter_add(w_in, input_words, hidden_grads[input_groups], MAX_ROW_UPDATES)
+
+    return float(loss)
+
+def _scatter_add(
+        matrix: np.ndarray,
+        indices: np.ndarray,
+        deltas: np.ndarray,
+        max_updates: Optional[int] = None):
+    """
+    matrix[indices] += deltas summing the deltas of repeated indices like np.add.at, but with one
+    sort and np.add.reduceat, which is several times faster for rows. With max_updates, a row
+    receives at most max_updates summed deltas: the root of a Huffman tree or a frequent word can
+    occur hundreds of times in a block, and their summed update would diverge.
+    """
+    if not len(indices):
+        return
+    order = np.argsort(indices, kind='stable')
+    rows, starts, counts = np.unique(indices[order], return_index=True, return_counts=True)
+    sums = np.add.reduceat(deltas[order], starts, axis=0)
+    if max_updates is not None:
+        sums /= np.maximum(counts / max_updates, 1.0).astype(np.float32)[:, None]
+    matrix[rows] = from_float32(to_float32(matrix[rows]) + sums, matrix.dtype)
+
+def _train(
+        texts: Union[List[List[int]], Tuple[np.ndarray, np.ndarray]],
+        window_size: int,
+        ns_count: int,
+        negative_sampler: Optional[NegativeSampler],
+        huffman_tree: Optional[HuffmanTree],
+        w_in: np.ndarray,
+        w_out: np.ndarray,
+        lr: float,
+        keep_prob: Optional[np.ndarray],
+        seed: int,
+        progress: Optional[TrainingProgress],
+        sg: bool,
+        shared_negatives: int = 0) -> List[Dict[str, float]]:
+    start = time.perf_counter()
+    random_state = np.random.RandomState(seed)
+    if w_in.shape != w_out.shape:
+        raise ValueError('w_in and w_out must both have the shape (vocab_count, hidden_dim).')
+    if w_in.dtype not in [np.dtype(dtype) for dtype in STORAGE_DTYPES.values()]:
+        raise ValueError(
+            'Unsupported dtype {}: use float32, float16 or uint16 holding bfloat16.'.format(w_in.dtype))
+    if w_out.dtype != w_in.dtype:
+        raise ValueError('w_in and w_out must have the same dtype.')
+    if keep_prob is not None and len(keep_prob) != w_out.shape[0]:
+        raise ValueError('keep_prob must have one probability per word.')
+    if huffman_tree is not None and len(huffman_tree) != w_out.shape[0]:
+        raise ValueError('huffman_tree must code every word of w_out.')
+
+    centers, contexts, word_count = _windows(texts, window_size, keep_prob, random_state)
+    pair_count, loss, reported_words = 0, 0.0, 0
+    for begin in range(0, len(centers), BLOCK_WORDS):
+        if progress is not None:
+            # The words before subsampling are spread over the blocks in proportion.
+            words = word_count * min(begin + BLOCK_WORDS, len(centers)) // len(centers)
+            lr = progress.add_words(words - reported_words)
+            reported_words = words
+        block_centers = centers[begin: begin + BLOCK_WORDS]
+        block_contexts = contexts[begin: begin + BLOCK_WORDS]
+        context_groups, context_positions = np.nonzero(block_contexts != -1)
+        context_words = block_contexts[context_groups, context_positions]
+
+        if sg:
+            # Every center is a group of its own word predicting its context words.
+            input_groups, input_words = np.arange(len(block_centers)), block_centers
+            target_groups, targets = context_groups, context_words
+        else:
+            # Centers without any context are skipped like in the native engine.
+            input_groups, input_words = context_groups, context_words
+            target_groups = np.unique(context_groups)
+            targets = block_centers[target_groups]
+
+        if huffman_tree is not None:
+            owners, targets, labels = huffman_tree.expand(targets)
+            target_groups = target_groups[owners]
+        else:
+            negative_groups = np.repeat(np.unique(input_groups), ns_count)
+            if shared_negatives:
+                # Every run of shared_negatives consecutive centers draws one set of negatives.
+                runs, run_indices = np.unique(
+                    (begin + np.unique(input_groups)) // shared_negatives, return_inverse=True)
+                negatives = negative_sampler.draw(len(runs) * ns_count, random_state)
+                negatives = negatives.reshape(len(runs), ns_count)[run_indices].reshape(-1)
+            else:
+                negatives = negative_sampler.draw(len(negative_groups), random_state)
+            labels = np.concatenate([
+                np.ones(len(targets), dtype=np.int32), np.zeros(len(negative_groups), dtype=np.int32)])
+            target_groups = np.concatenate([target_groups, negative_groups])
+            targets = np.concatenate([targets, negatives])
+        if not len(targets):
+            continue
+
+        loss += _update_groups(
+            w_in, w_out, input_groups, input_words, target_groups, targets, labels, lr)
+        pair_count += len(targets)
+
+    if progress is not None:
+        progress.add_words(word_count - reported_words)
+
+    return [{
+        'words': word_count, 'pairs': pair_count, 'loss': loss,
+        'seconds': time.perf_counter() - start,
+    }]
+
+def get_sg_ns_grad(
+        texts, window_size, ns_count, negative_sampler, w_in, w_out, lr, workers=1,
+        keep_prob=None, seed=0, progress=None, shared_negatives=0):
+    """
+    NumPy counterpart of word2vec_impl_cython.get_sg_ns_grad. workers is ignored and a single
+    stat is returned. With shared_negatives, the runs of centers sharing negatives may span two
+    texts, and each block is trained in one step whatever its value.
+    """
+    return _train(
+        texts, window_size, ns_count, negative_sampler, None, w_in, w_out, lr, keep_prob, seed,
+        progress, True, shared_negatives)
+
+def get_cbow_ns_grad(
+        texts, window_size, ns_count, negative_sampler, w_in, w_out, lr, workers=1,
+        keep_prob=None, seed=0, progress=None):
+    return _train(
+        texts, window_size, ns_count, negative_sampler, None, w_in, w_out, lr, keep_prob, seed,
+        progress, False)
+
+def get_sg_hs_grad(
+        texts, window_size, huffman_tree, w_in, w_out, lr, workers=1, keep_prob=None, seed=0,
+        progress=None):
+    return _train(
+        texts, window_size, 0, None, huffman_tree, w_in, w_out, lr, keep_prob, seed, progress, True)
+
+def get_cbow_hs_grad(
+        texts, window_size, huffman_tree, w_in, w_out, lr, workers=1, keep_prob=None, seed=0,
+        progress=None):
+    return _train(
+        texts, window_size, 0, None, huffman_tree, w_in, w_out, lr, keep_prob, seed, progress,
+        False)
+
+def update_w_numpy(
+        w_in: np.ndarray,
+        w_out: np.ndarray,
+        indices_in: List[int],
+        indices_out: List[int],
+        labels: List[int],
+        lr: float) -> float:
+    """
+    Apply (index_in, index_out, label) pairs like update_w_cython, but as one minibatch step per
+    BLOCK_WORDS pairs. Returns the mean loss.
+    """
+    indices_in = np.asarray(indices_in, dtype=np.int64)
+    indices_out = np.asarray(indices_out, dtype=np.int64)
+    labels = np.asarray(labels, dtype=np.int32)
+    loss = 0.0
+    for begin in range(0, len(labels), BLOCK_WORDS):
+        block = slice(begin, begin + BLOCK_WORDS)
+        groups = np.arange(len(labels[block]))
+        loss += _update_groups(
+            w_in, w_out, groups, indices_in[block], groups, indices_out[block], labels[block], lr)
+    return loss / max(len(labels), 1)
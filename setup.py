@@ -1,3 +1,4 @@
+import os
 import itertools
 import platform
 from setuptools import setup, Extension, find_packages
@@ -17,14 +18,26 @@ def make_c_ext(use_cython=False):
             sources = [source.replace('.c', '.pyx') for source in sources]
         yield Extension(module, sources=sources, language='c')
 
+def get_eigen_include_dirs():
+    # The SIMD kernels are selected at run time, so the extension is compiled for the baseline
+    # instruction set and only needs to find the Eigen headers.
+    candidates = [
+        os.environ.get('EIGEN_INCLUDE_DIR'),
+        'lib/eigen-3.3.7',
+        '/usr/include/eigen3',
+        '/usr/local/include/eigen3',
+        '/opt/homebrew/include/eigen3',
+    ]
+    return [path for path in candidates if path and os.path.isdir(os.path.join(path, 'Eigen'))][:1]
+
 def make_cpp_ext(use_cython=False):
     extra_args = []
     system = platform.system()
 
     if system == 'Linux':
-        extra_args.extend(['-std=c++11', '-I/mnt/i/Yuki/workspace/mltools/lib/eigen-3.3.7', '-mavx512f'])
+        extra_args.extend(['-std=c++11', '-pthread'])
     elif system == 'Darwin':
-        extra_args.extend(['-stdlib=libc++', '-std=c++11', '-I/mnt/i/Yuki/workspace/mltools/lib/eigen-3.3.7', '-mavx512f'])
+        extra_args.extend(['-stdlib=libc++', '-std=c++11', '-pthread'])
 
     for module, sources in cpp_extensions.items():
         if use_cython:
@@ -33,6 +46,8 @@ def make_cpp_ext(use_cython=False):
             module,
             sources=sources,
             language='c++',
+            include_dirs=get_eigen_include_dirs(),
+            depends=['mltools/model/word2vec_impl/word2vec_impl.cpp'],
             extra_compile_args=extra_args,
             extra_link_args=extra_args,
             library_dirs=['model/word2vec_impl']
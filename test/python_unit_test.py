@@ -1,12 +1,46 @@
 """
 Unit Test
 """
+import os
+import bz2
+import collections
+import json
+import pickle
+import tempfile
+import threading
 import unittest
+from unittest import mock
+import dill
 import numpy as np
 import torch
+from gensim.corpora import Dictionary
+
+from mltools.model.word2vec import MyWord2Vec
+from mltools.model.lsh_index import LSHIndex
+from mltools.model.word2vec_impl import word2vec_impl_numpy
 
 from mltools.model.word2vec_impl.word2vec_impl_cython \
-    import update_w_cython, update_w_naive, update_w_eigen, update_w_avx # pylint: disable=import-error,no-name-in-module
+    import update_w_cython, update_w_naive, update_w_eigen, update_w_avx, update_w_simd, \
+        NegativeSampler, get_sg_ns_pairs, get_sg_ns_grad, get_cbow_ns_grad, set_sigmoid_table, get_sigmoid_table, \
+        HuffmanTree, get_sg_hs_grad, get_cbow_hs_grad, TrainingProgress, \
+        supported_kernels, set_kernel, active_kernel, to_float32 # pylint: disable=import-error,no-name-in-module
+
+try:
+    from mltools.dataset import wikipedia_ja
+except ImportError:
+    # The Wikipedia data set needs MeCab.
+    wikipedia_ja = None
+
+class WhitespaceTagger:
+    """
+    Stand-in for MeCab.Tagger('-Ochasen') which makes every space-separated word a noun, so the
+    tests do not depend on the MeCab dictionary.
+    """
+    def __init__(self, *args):
+        pass
+
+    def parse(self, text):
+        return ''.join('{0}\t{0}\t{0}\t名詞\n'.format(word) for word in text.split()) + 'EOS\n'
 
 class TestStringMethods(unittest.TestCase):
     def test_word2vec_impl(self):
@@ -16,7 +50,7 @@ class TestStringMethods(unittest.TestCase):
         hidden_dim = 500
         batch_size = 1000
 
-        w_in_original = np.random.randn(hidden_dim, vocab_count).astype(np.float32)
+        w_in_original = np.random.randn(vocab_count, hidden_dim).astype(np.float32)
         w_out_original = np.random.randn(vocab_count, hidden_dim).astype(np.float32)
 
         indices_in = np.random.randint(0, vocab_count, batch_size)
@@ -24,26 +58,39 @@ class TestStringMethods(unittest.TestCase):
         labels = np.random.randint(0, 2, batch_size)
         lr = 1e-1
 
+        # Compare with the exact sigmoid of torch through a fine table.
+        max_exp, table_size = get_sigmoid_table()
+        set_sigmoid_table(32.0, 1000000)
+        self.addCleanup(set_sigmoid_table, max_exp, table_size)
+
         w_in_cython = w_in_original.copy()
         w_out_cython = w_out_original.copy()
         update_w_cython(w_in_cython, w_out_cython, indices_in, indices_out, labels, lr)
 
-        w_in_naive = w_in_original.transpose(1, 0).copy()
+        w_in_naive = w_in_original.copy()
         w_out_naive = w_out_original.copy()
         update_w_naive(w_in_naive, w_out_naive, indices_in, indices_out, labels, lr)
-        w_in_naive = w_in_naive.transpose(1, 0)
 
-        w_in_eigen = w_in_original.transpose(1, 0).copy()
+        w_in_eigen = w_in_original.copy()
         w_out_eigen = w_out_original.copy()
         update_w_eigen(w_in_eigen, w_out_eigen, indices_in, indices_out, labels, lr)
-        w_in_eigen = w_in_eigen.transpose(1, 0)
 
-        w_in_avx = w_in_original.transpose(1, 0).copy()
+        w_in_avx = w_in_original.copy()
         w_out_avx = w_out_original.copy()
         update_w_avx(w_in_avx, w_out_avx, indices_in, indices_out, labels, lr)
-        w_in_avx = w_in_avx.transpose(1, 0)
 
-        w_in_torch = torch.tensor(w_in_original.transpose(1, 0), requires_grad=True)
+        w_ins_simd, w_outs_simd = [], []
+        kernel = active_kernel()
+        self.addCleanup(set_kernel, kernel)
+        for kernel in supported_kernels():
+            set_kernel(kernel)
+            w_in_simd = w_in_original.copy()
+            w_out_simd = w_out_original.copy()
+            update_w_simd(w_in_simd, w_out_simd, indices_in, indices_out, labels, lr)
+            w_ins_simd.append(w_in_simd)
+            w_outs_simd.append(w_out_simd)
+
+        w_in_torch = torch.tensor(w_in_original, requires_grad=True)
         w_out_torch = torch.tensor(w_out_original, requires_grad=True)
         sgd = torch.optim.SGD([w_in_torch, w_out_torch], lr=lr)
         for i, (index_in, index_out, label) in enumerate(zip(indices_in, indices_out, labels)):
@@ -55,7 +102,6 @@ class TestStringMethods(unittest.TestCase):
 
         w_in_torch = w_in_torch.data.numpy()
         w_out_torch = w_out_torch.data.numpy()
-        w_in_torch = w_in_torch.transpose(1, 0)
 
         self.assertLess(np.mean(np.abs(w_in_cython - w_in_naive)), 1e-6)
         self.assertLess(np.mean(np.abs(w_out_cython - w_out_naive)), 1e-6)
@@ -63,8 +109,821 @@ class TestStringMethods(unittest.TestCase):
         self.assertLess(np.mean(np.abs(w_out_cython - w_out_eigen)), 1e-6)
         self.assertLess(np.mean(np.abs(w_in_cython - w_in_avx)), 1e-6)
         self.assertLess(np.mean(np.abs(w_out_cython - w_out_avx)), 1e-6)
+        for w_in_simd, w_out_simd in zip(w_ins_simd, w_outs_simd):
+            self.assertLess(np.mean(np.abs(w_in_cython - w_in_simd)), 1e-6)
+            self.assertLess(np.mean(np.abs(w_out_cython - w_out_simd)), 1e-6)
         self.assertLess(np.mean(np.abs(w_in_cython - w_in_torch)), 1e-6)
         self.assertLess(np.mean(np.abs(w_out_cython - w_out_torch)), 1e-6)
 
+    def test_word2vec_impl_loss(self):
+        np.random.seed()
+
+        vocab_count = 10000
+        hidden_dim = 100
+        batch_size = 1000
+
+        w_in = np.random.randn(vocab_count, hidden_dim).astype(np.float32) * 0.2
+        w_out = np.random.randn(vocab_count, hidden_dim).astype(np.float32) * 0.2
+
+        # Distinct indices make each loss independent of the preceding updates.
+        indices_in = np.random.permutation(vocab_count)[:batch_size]
+        indices_out = np.random.permutation(vocab_count)[:batch_size]
+        labels = np.random.randint(0, 2, batch_size)
+
+        outputs = np.sum(w_in[indices_in] * w_out[indices_out], axis=1)
+        expected_loss = np.mean(np.logaddexp(0, np.where(labels == 1, -outputs, outputs)))
+
+        for update_w in [update_w_naive, update_w_eigen, update_w_avx, update_w_simd, update_w_cython]:
+            loss = update_w(w_in.copy(), w_out.copy(), indices_in, indices_out, labels, 1e-1)
+            self.assertAlmostEqual(loss, expected_loss, delta=1e-2)
+
+    def test_get_sg_ns_grad_workers(self):
+        np.random.seed()
+
+        vocab_count = 1000
+        hidden_dim = 50
+        workers = 4
+
+        texts = np.random.randint(-1, vocab_count, (100, 20)).tolist()
+        negative_sampler = NegativeSampler(np.full((vocab_count,), 1.0 / vocab_count))
+        w_in = np.random.randn(vocab_count, hidden_dim).astype(np.float32)
+        w_out = np.random.randn(vocab_count, hidden_dim).astype(np.float32)
+        w_in_original = w_in.copy()
+
+        stats = get_sg_ns_grad(texts, 5, 5, negative_sampler, w_in, w_out, 1e-2, workers)
+
+        self.assertEqual(len(stats), workers)
+        self.assertEqual(
+            sum(stat['words'] for stat in stats), sum(index != -1 for text in texts for index in text))
+        self.assertGreater(np.mean(np.abs(w_in - w_in_original)), 0.0)
+
+        keep_prob = np.zeros((vocab_count,), dtype=np.float32)
+        w_in_original = w_in.copy()
+        get_sg_ns_grad(texts, 5, 5, negative_sampler, w_in, w_out, 1e-2, workers, keep_prob)
+        self.assertEqual(np.mean(np.abs(w_in - w_in_original)), 0.0)
+
+    def test_release_gil(self):
+        np.random.seed()
+
+        vocab_count = 1000
+        hidden_dim = 100
+
+        texts = np.random.randint(0, vocab_count, (2000, 50)).tolist()
+        negative_sampler = NegativeSampler(np.full((vocab_count,), 1.0 / vocab_count))
+        indices_in, indices_out, labels = (
+            values.tolist() for values in get_sg_ns_pairs(texts, 5, 5, negative_sampler))
+        w_in = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+        w_out = np.zeros((vocab_count, hidden_dim), dtype=np.float32)
+
+        # This thread watches the weights while another one updates them in a native call. A call
+        # holding the GIL lets it run only before or after the call, so it could only see the
+        # initial or the final weights; seeing any other state shows that the GIL was released.
+        calls = [
+            lambda w_in, w_out: update_w_cython(w_in, w_out, indices_in, indices_out, labels, 1e-3),
+            lambda w_in, w_out: update_w_simd(w_in, w_out, indices_in, indices_out, labels, 1e-3),
+            lambda w_in, w_out: get_sg_ns_grad(
+                texts, 5, 5, negative_sampler, w_in, w_out, 1e-3, workers=1),
+        ]
+        for call in calls:
+            final_w_in, final_w_out = w_in.copy(), w_out.copy()
+            call(final_w_in, final_w_out)
+            trained_w_in, trained_w_out = w_in.copy(), w_out.copy()
+            thread = threading.Thread(target=call, args=(trained_w_in, trained_w_out))
+            thread.start()
+            seen_during_call = False
+            while thread.is_alive() and not seen_during_call:
+                snapshot_w_in, snapshot_w_out = trained_w_in.copy(), trained_w_out.copy()
+                seen_during_call = \
+                    not (np.array_equal(snapshot_w_in, w_in) and np.array_equal(snapshot_w_out, w_out)) and \
+                    not (np.array_equal(snapshot_w_in, final_w_in) and np.array_equal(snapshot_w_out, final_w_out))
+            thread.join()
+            self.assertTrue(seen_during_call)
+            self.assertTrue(np.array_equal(trained_w_in, final_w_in))
+
+        with self.assertRaises(ValueError):
+            update_w_simd(np.asfortranarray(w_in), w_out, indices_in, indices_out, labels, 1e-3)
+
+    def test_get_sg_ns_grad_fused(self):
+        np.random.seed()
+
+        vocab_count = 1000
+        hidden_dim = 50
+        seed = np.random.randint(1 << 31)
+
+        texts = np.random.randint(-1, vocab_count, (20, 20)).tolist()
+        negative_sampler = NegativeSampler(np.full((vocab_count,), 1.0 / vocab_count))
+        keep_prob = np.random.rand(vocab_count).astype(np.float32)
+        w_in_original = np.random.randn(vocab_count, hidden_dim).astype(np.float32)
+        w_out_original = np.random.randn(vocab_count, hidden_dim).astype(np.float32)
+
+        w_in_fused = w_in_original.copy()
+        w_out_fused = w_out_original.copy()
+        get_sg_ns_grad(
+            texts, 5, 5, negative_sampler, w_in_fused, w_out_fused, 1e-2, 1, keep_prob, seed)
+
+        w_in_pairs = w_in_original.copy()
+        w_out_pairs = w_out_original.copy()
+        indices_in, indices_out, labels = get_sg_ns_pairs(
+            texts, 5, 5, negative_sampler, seed, keep_prob)
+        update_w_cython(w_in_pairs, w_out_pairs, indices_in, indices_out, labels, 1e-2)
+
+        self.assertGreater(len(labels), 0)
+        self.assertLess(np.mean(np.abs(w_in_fused - w_in_pairs)), 1e-6)
+        self.assertLess(np.mean(np.abs(w_out_fused - w_out_pairs)), 1e-6)
+
+    def test_csr_texts(self):
+        np.random.seed()
+
+        vocab_count = 1000
+        hidden_dim = 50
+        seed = np.random.randint(1 << 31)
+
+        texts = [
+            np.random.randint(-1, vocab_count, np.random.randint(0, 30)).tolist() for _ in range(40)]
+        # The texts are a slice of a larger CSR batch, read in place from read-only arrays.
+        tokens = np.array([7, 8] + [token for text in texts for token in text], dtype=np.int32)
+        offsets = np.cumsum([0, 2] + [len(text) for text in texts]).astype(np.int64)[1:]
+        tokens.flags.writeable = False
+        negative_sampler = NegativeSampler(np.full((vocab_count,), 1.0 / vocab_count))
+        numpy_negative_sampler = word2vec_impl_numpy.NegativeSampler(
+            np.full((vocab_count,), 1.0 / vocab_count))
+        w_in_original = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+        w_out_original = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+
+        for pairs, csr_pairs in zip(
+                get_sg_ns_pairs(texts, 5, 5, negative_sampler, seed),
+                get_sg_ns_pairs((tokens, offsets), 5, 5, negative_sampler, seed)):
+            self.assertTrue(np.array_equal(pairs, csr_pairs))
+
+        for get_grad, sampler, workers in [
+                (get_sg_ns_grad, negative_sampler, 1), (get_sg_ns_grad, negative_sampler, 3),
+                (get_cbow_ns_grad, negative_sampler, 3),
+                (word2vec_impl_numpy.get_sg_ns_grad, numpy_negative_sampler, 1)]:
+            results = []
+            for batch in [texts, (tokens, offsets)]:
+                w_in, w_out = w_in_original.copy(), w_out_original.copy()
+                stats = get_grad(batch, 5, 5, sampler, w_in, w_out, 1e-2, workers, None, seed)
+                results.append((w_in, w_out, [stat['pairs'] for stat in stats]))
+            # Both batches are split among the threads alike, but Hogwild threads race on the rows.
+            self.assertEqual(results[0][2], results[1][2])
+            tolerance = 0.0 if workers == 1 else 1e-3
+            self.assertLessEqual(np.max(np.abs(results[0][0] - results[1][0])), tolerance)
+            self.assertLessEqual(np.max(np.abs(results[0][1] - results[1][1])), tolerance)
+
+        for bad_offsets in [[], [-1, 2], [0, 5, 3], [0, len(tokens) + 1]]:
+            with self.assertRaises(ValueError):
+                get_sg_ns_grad(
+                    (tokens, np.array(bad_offsets, dtype=np.int64)), 5, 5, negative_sampler,
+                    w_in_original.copy(), w_out_original.copy(), 1e-2)
+
+        # Token ids index the matrices without bound checks in the native loops.
+        for bad_token in [len(w_out_original), 10 ** 8, -2]:
+            for batch in [[[0, 1, bad_token, 2]], (np.array([0, 1, bad_token, 2]), np.array([0, 4]))]:
+                with self.assertRaises(ValueError):
+                    get_sg_ns_grad(
+                        batch, 5, 5, negative_sampler, w_in_original.copy(), w_out_original.copy(), 1e-2)
+            with self.assertRaises(ValueError):
+                get_sg_ns_pairs([[0, 1, bad_token, 2]], 5, 5, negative_sampler)
+        with self.assertRaises(ValueError):
+            get_sg_ns_grad(
+                texts, 5, 5, NegativeSampler(np.ones(len(w_out_original) - 1)),
+                w_in_original.copy(), w_out_original.copy(), 1e-2)
+
+    def test_shared_negatives(self):
+        np.random.seed()
+
+        vocab_count = 1000
+        hidden_dim = 50
+        seed = np.random.randint(1 << 31)
+
+        texts = np.random.randint(-1, vocab_count, (40, 30)).tolist()
+        negative_sampler = NegativeSampler(np.full((vocab_count,), 1.0 / vocab_count))
+        w_in_original = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+        w_out_original = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+
+        # Blocks of one center draw the same pairs as per-pair sampling.
+        stats = [
+            get_sg_ns_grad(
+                texts, 5, 5, negative_sampler, w_in_original.copy(), w_out_original.copy(), 1e-2, 1,
+                None, seed, None, shared_negatives)[0]
+            for shared_negatives in [0, 1]]
+        self.assertEqual(stats[0]['pairs'], stats[1]['pairs'])
+        self.assertAlmostEqual(
+            stats[0]['loss'] / stats[0]['pairs'], stats[1]['loss'] / stats[1]['pairs'], places=3)
+
+        for get_grad, sampler in [
+                (get_sg_ns_grad, negative_sampler),
+                (word2vec_impl_numpy.get_sg_ns_grad,
+                 word2vec_impl_numpy.NegativeSampler(np.full((vocab_count,), 1.0 / vocab_count)))]:
+            for dtype in [np.float32, np.uint16]:
+                w_in = word2vec_impl_numpy.from_float32(w_in_original, dtype)
+                w_out = word2vec_impl_numpy.from_float32(w_out_original, dtype)
+                losses = []
+                for epoch in range(5):
+                    stats = get_grad(
+                        texts, 5, 5, sampler, w_in, w_out, 0.1, 2, None, seed + epoch, None, 16)
+                    losses.append(
+                        sum(stat['loss'] for stat in stats) / sum(stat['pairs'] for stat in stats))
+                self.assertEqual(w_in.dtype, dtype)
+                self.assertLess(losses[-1], losses[0])
+
+        with self.assertRaises(ValueError):
+            MyWord2Vec(Dictionary([['a', 'b']]), sg=0, shared_negatives=8)
+        with self.assertRaises(ValueError):
+            MyWord2Vec(Dictionary([['a', 'b']]), hs=1, shared_negatives=8)
+
+    def test_get_cbow_ns_grad(self):
+        np.random.seed()
+
+        vocab_count = 100
+        hidden_dim = 20
+
+        texts = np.random.randint(0, vocab_count, (50, 20)).tolist()
+        negative_sampler = NegativeSampler(np.full((vocab_count,), 1.0 / vocab_count))
+        w_in = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+        w_out = np.zeros((vocab_count, hidden_dim), dtype=np.float32)
+
+        losses = []
+        for _ in range(20):
+            stats = get_cbow_ns_grad(texts, 5, 5, negative_sampler, w_in, w_out, 5e-2, 2)
+            losses.append(sum(stat['loss'] for stat in stats) / sum(stat['pairs'] for stat in stats))
+
+        # One positive and five negative updates per center word.
+        self.assertEqual(sum(stat['pairs'] for stat in stats), 6 * 50 * 20)
+        self.assertLess(losses[-1], losses[0])
+
+    def test_huffman_tree(self):
+        np.random.seed()
+
+        counts = np.random.randint(1, 1000, 100)
+        huffman_tree = HuffmanTree(counts)
+        paths = [huffman_tree.path(word) for word in range(len(counts))]
+
+        self.assertEqual(len(huffman_tree), len(counts))
+        # Every path starts at the root, visits inner nodes only, and the codes form a prefix code.
+        self.assertTrue(all(points[0] == len(counts) - 2 for points, _ in paths))
+        self.assertTrue(all(np.all(points < len(counts) - 1) for points, _ in paths))
+        codes = sorted(''.join(map(str, codes)) for _, codes in paths)
+        self.assertTrue(all(not right.startswith(left) for left, right in zip(codes, codes[1:])))
+        # Kraft equality of a full binary tree, and frequent words are never deeper than rare ones.
+        lengths = np.array([len(points) for points, _ in paths])
+        self.assertAlmostEqual(np.sum(0.5 ** lengths), 1.0)
+        self.assertLessEqual(lengths[np.argmax(counts)], lengths[np.argmin(counts)])
+
+    def test_get_hs_grad(self):
+        np.random.seed()
+
+        vocab_count = 100
+        hidden_dim = 20
+
+        texts = np.random.randint(0, vocab_count, (50, 20)).tolist()
+        huffman_tree = HuffmanTree(np.bincount(np.ravel(texts), minlength=vocab_count) + 1)
+        path_lengths = np.array([len(huffman_tree.path(word)[0]) for word in range(vocab_count)])
+
+        for get_hs_grad in [get_sg_hs_grad, get_cbow_hs_grad]:
+            w_in = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+            w_out = np.zeros((vocab_count, hidden_dim), dtype=np.float32)
+
+            losses = []
+            for _ in range(20):
+                stats = get_hs_grad(texts, 1, huffman_tree, w_in, w_out, 5e-2, 2)
+                losses.append(sum(stat['loss'] for stat in stats) / sum(stat['pairs'] for stat in stats))
+
+            self.assertLess(losses[-1], losses[0])
+            # The last row of w_out is not an inner node and is never trained.
+            self.assertFalse(np.any(w_out[-1]))
+        # With a window of 1, CBOW predicts each center word once along its path.
+        self.assertEqual(sum(stat['pairs'] for stat in stats), np.sum(path_lengths[texts]))
+
+        with self.assertRaises(ValueError):
+            get_sg_hs_grad(texts, 1, HuffmanTree([1] * (vocab_count - 1)), w_in, w_out, 5e-2)
+
+    def test_word2vec_impl_numpy(self):
+        np.random.seed()
+
+        vocab_count = 100
+        hidden_dim = 20
+
+        texts = np.random.randint(0, vocab_count, (50, 20)).tolist()
+        counts = np.bincount(np.ravel(texts), minlength=vocab_count) + 1
+        negative_sampler = word2vec_impl_numpy.NegativeSampler(counts ** 0.75)
+        huffman_tree = word2vec_impl_numpy.HuffmanTree(counts)
+        native_huffman_tree = HuffmanTree(counts)
+        for word in range(vocab_count):
+            for values, native_values in zip(huffman_tree.path(word), native_huffman_tree.path(word)):
+                np.testing.assert_array_equal(values, native_values)
+
+        engines = [
+            (word2vec_impl_numpy.get_sg_ns_grad, (5, negative_sampler)),
+            (word2vec_impl_numpy.get_cbow_ns_grad, (5, negative_sampler)),
+            (word2vec_impl_numpy.get_sg_hs_grad, (huffman_tree,)),
+            (word2vec_impl_numpy.get_cbow_hs_grad, (huffman_tree,)),
+        ]
+        for get_grad, sampling_args in engines:
+            w_in = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+            w_out = np.zeros((vocab_count, hidden_dim), dtype=np.float32)
+
+            losses = []
+            for _ in range(20):
+                stats = get_grad(texts, 5, *sampling_args, w_in, w_out, 5e-2)
+                losses.append(sum(stat['loss'] for stat in stats) / sum(stat['pairs'] for stat in stats))
+
+            self.assertEqual(sum(stat['words'] for stat in stats), 50 * 20)
+            self.assertLess(losses[-1], losses[0])
+
+            # An empty batch, a batch of unknown words and a fully subsampled batch train nothing.
+            w_in_before, w_out_before = w_in.copy(), w_out.copy()
+            for empty_texts, keep_prob, words in [
+                    ([], None, 0), ([[-1, -1]], None, 0), (texts[:2], np.zeros(vocab_count), 40)]:
+                stats = get_grad(
+                    empty_texts, 5, *sampling_args, w_in, w_out, 5e-2, keep_prob=keep_prob)
+                self.assertEqual(sum(stat['words'] for stat in stats), words)
+                self.assertEqual(sum(stat['pairs'] for stat in stats), 0)
+                self.assertEqual(sum(stat['loss'] for stat in stats), 0.0)
+            np.testing.assert_array_equal(w_in, w_in_before)
+            np.testing.assert_array_equal(w_out, w_out_before)
+        # The CBOW engine trains one positive and five negative pairs per center word like the native one.
+        self.assertEqual(
+            sum(stat['pairs'] for stat in word2vec_impl_numpy.get_cbow_ns_grad(
+                texts, 5, 5, negative_sampler, w_in, np.zeros_like(w_out), 5e-2)),
+            6 * 50 * 20)
+
+    def test_half_precision_storage(self):
+        np.random.seed()
+
+        vocab_count = 100
+        hidden_dim = 37
+        texts = np.random.randint(0, vocab_count, (50, 20)).tolist()
+        counts = np.bincount(np.ravel(texts), minlength=vocab_count) + 1
+        negative_sampler = NegativeSampler(counts ** 0.75)
+        previous_kernel = active_kernel()
+        self.addCleanup(set_kernel, previous_kernel)
+
+        # With lr = 0, loading a row into float32 and rounding it back must not change any bit, and
+        # every kernel must agree on it, tails included.
+        bits = np.arange(1 << 16, dtype=np.uint16)
+        for kernel in supported_kernels():
+            set_kernel(kernel)
+            for values in [bits.view(np.float16), bits]:
+                expected = word2vec_impl_numpy.to_float32(values)
+                not_nan = ~np.isnan(expected)
+                np.testing.assert_array_equal(
+                    to_float32(values)[not_nan].view(np.uint32), expected[not_nan].view(np.uint32))
+        half_values = bits[np.isfinite(bits.view(np.float16)) & (bits != 0x8000)]
+        bfloat16_values = bits[np.abs(word2vec_impl_numpy.to_float32(bits)) < 1e4]
+        bfloat16_values = bfloat16_values[bfloat16_values != 0x8000]
+        for kernel in supported_kernels():
+            set_kernel(kernel)
+            for values in [half_values.view(np.float16), bfloat16_values]:
+                w_in = np.random.permutation(values)[:vocab_count * hidden_dim].reshape(vocab_count, hidden_dim)
+                w_out = np.random.permutation(values)[:vocab_count * hidden_dim].reshape(vocab_count, hidden_dim)
+                for get_grad in [get_sg_ns_grad, get_cbow_ns_grad]:
+                    trained_w_in, trained_w_out = w_in.copy(), w_out.copy()
+                    get_grad(texts, 5, 5, negative_sampler, trained_w_in, trained_w_out, 0.0)
+                    self.assertTrue(np.array_equal(trained_w_in.view(np.uint16), w_in.view(np.uint16)))
+                    self.assertTrue(np.array_equal(trained_w_out.view(np.uint16), w_out.view(np.uint16)))
+        set_kernel(previous_kernel)
+
+        # Half-precision training follows float32 training closely on both engines.
+        for get_grad, sampler in [
+                (get_sg_ns_grad, negative_sampler),
+                (word2vec_impl_numpy.get_sg_ns_grad, word2vec_impl_numpy.NegativeSampler(counts ** 0.75))]:
+            final_losses = {}
+            for dtype in [np.float32, np.float16, np.uint16]:
+                w_in = word2vec_impl_numpy.from_float32(
+                    (np.random.RandomState(0).randn(vocab_count, hidden_dim) * 0.1).astype(np.float32), dtype)
+                w_out = np.zeros((vocab_count, hidden_dim), dtype=dtype)
+                for _ in range(20):
+                    stats = get_grad(texts, 5, 5, sampler, w_in, w_out, 5e-2)
+                self.assertEqual(w_in.dtype, dtype)
+                self.assertEqual(w_out.dtype, dtype)
+                final_losses[dtype] = sum(stat['loss'] for stat in stats) / sum(stat['pairs'] for stat in stats)
+            self.assertLess(final_losses[np.float32], 0.6)
+            self.assertAlmostEqual(final_losses[np.float16], final_losses[np.float32], delta=0.02)
+            self.assertAlmostEqual(final_losses[np.uint16], final_losses[np.float32], delta=0.02)
+
+            with self.assertRaises(ValueError):
+                get_grad(texts, 5, 5, sampler, w_in, w_out.astype(np.float32), 5e-2)
+
+        with self.assertRaises(ValueError):
+            MyWord2Vec(Dictionary([['w']]), storage='float64')
+        word_texts = [['w{}'.format(i) for i in text] for text in texts]
+        dictionary = Dictionary(word_texts)
+        w2v_model = MyWord2Vec(dictionary, size=hidden_dim, workers=2, storage='bfloat16')
+        w2v_model.train([dictionary.doc2idx(text) for text in word_texts])
+        self.assertEqual(w2v_model._w_in.dtype, np.uint16) # pylint: disable=protected-access
+        self.assertEqual(w2v_model.normalized_w_in.dtype, np.uint16)
+
+        w_in = word2vec_impl_numpy.to_float32(w2v_model._w_in) # pylint: disable=protected-access
+        vector = w_in[dictionary.token2id['w0']]
+        cos_sim = np.matmul(w_in, vector) / np.linalg.norm(w_in, axis=1)
+        self.assertEqual(
+            w2v_model.most_similar('w0', topn=5)[0], dictionary[int(np.argmax(cos_sim))])
+        w2v_model.build_ann_index(n_tables=4)
+        with tempfile.TemporaryDirectory() as dir_path:
+            w2v_model.save(dir_path)
+            loaded_model = MyWord2Vec.load(dir_path)
+            self.assertEqual(loaded_model.storage, 'bfloat16')
+            self.assertTrue(np.array_equal(loaded_model._w_in, w2v_model._w_in)) # pylint: disable=protected-access
+            self.assertEqual(
+                loaded_model.most_similar('w0', topn=5, approximate=True),
+                w2v_model.most_similar('w0', topn=5, approximate=True))
+            del loaded_model
+
+    def test_training_progress(self):
+        np.random.seed()
+
+        vocab_count = 100
+        hidden_dim = 20
+
+        texts = np.random.randint(0, vocab_count, (50, 20)).tolist()
+        for engine_progress, get_grad, negative_sampler in [
+                (TrainingProgress, get_sg_ns_grad, NegativeSampler(np.full((vocab_count,), 0.01))),
+                (word2vec_impl_numpy.TrainingProgress, word2vec_impl_numpy.get_sg_ns_grad,
+                 word2vec_impl_numpy.NegativeSampler(np.full((vocab_count,), 0.01)))]:
+            w_in = (np.random.randn(vocab_count, hidden_dim) * 0.1).astype(np.float32)
+            w_out = np.zeros((vocab_count, hidden_dim), dtype=np.float32)
+            progress = engine_progress(0.025, 0.0001, 4 * 50 * 20)
+            self.assertAlmostEqual(progress.alpha, 0.025)
+
+            # The rate decays linearly with the words counted by every thread, then stays at min_alpha.
+            for step, alpha in enumerate([0.75 * 0.025 + 0.25 * 0.0001, 0.5 * 0.025 + 0.5 * 0.0001]):
+                get_grad(texts, 5, 5, negative_sampler, w_in, w_out, 1.0, 2, None, step, progress)
+                self.assertEqual(progress.words, (step + 1) * 50 * 20)
+                self.assertAlmostEqual(progress.alpha, alpha, places=6)
+            for step in range(3):
+                get_grad(texts, 5, 5, negative_sampler, w_in, w_out, 1.0, 2, None, step, progress)
+            self.assertAlmostEqual(progress.alpha, 0.0001, places=6)
+            self.assertGreater(progress.words_per_sec, 0.0)
+            # The learning rate passed as lr is ignored: an update with lr=1.0 would blow w_in up.
+            self.assertLess(np.max(np.abs(w_in)), 10.0)
+
+    def test_negative_sampler(self):
+        np.random.seed()
+
+        vocab_ns_prob = np.random.rand(100) ** 4
+        vocab_ns_prob /= np.sum(vocab_ns_prob)
+        negative_sampler = NegativeSampler(vocab_ns_prob)
+
+        samples = negative_sampler.sample(1000000, np.random.randint(1 << 31))
+        freq = np.bincount(samples, minlength=len(vocab_ns_prob)) / len(samples)
+
+        self.assertEqual(len(negative_sampler), len(vocab_ns_prob))
+        self.assertLess(np.max(np.abs(freq - vocab_ns_prob)), 5e-3)
+
+    def test_my_word2vec_save_load(self):
+        np.random.seed()
+
+        texts = [['w{}'.format(i) for i in np.random.randint(0, 100, 20)] for _ in range(50)]
+        dictionary = Dictionary(texts)
+        w2v_model = MyWord2Vec(dictionary, size=20, workers=2, shared_negatives=4)
+        w2v_model.train([dictionary.doc2idx(text) for text in texts])
+        w2v_model.build_ann_index(n_tables=4)
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            w2v_model.save(os.path.join(dir_path, 'model'))
+            for mmap in [True, False]:
+                loaded_model = MyWord2Vec.load(os.path.join(dir_path, 'model'), mmap=mmap)
+                self.assertTrue(np.array_equal(loaded_model._w_in, w2v_model._w_in)) # pylint: disable=protected-access
+                self.assertTrue(np.array_equal(loaded_model._w_out, w2v_model._w_out)) # pylint: disable=protected-access
+                self.assertEqual(loaded_model.vocab_ns_prob, w2v_model.vocab_ns_prob)
+                self.assertEqual(loaded_model.shared_negatives, 4)
+                self.assertEqual(
+                    loaded_model.most_similar('w0', topn=5), w2v_model.most_similar('w0', topn=5))
+                self.assertEqual(
+                    loaded_model.most_similar('w0', topn=5, approximate=True),
+                    w2v_model.most_similar('w0', topn=5, approximate=True))
+                del loaded_model
+
+            # Saving after training drops the index, which was built on the old embeddings.
+            w2v_model.train([dictionary.doc2idx(text) for text in texts])
+            w2v_model.save(os.path.join(dir_path, 'model'))
+            loaded_model = MyWord2Vec.load(os.path.join(dir_path, 'model'))
+            self.assertIsNone(loaded_model.ann_index)
+            self.assertFalse(os.path.exists(os.path.join(dir_path, 'model', 'ann_index')))
+            del loaded_model
+
+            # Tokens with line breaks other than a line feed keep their ids.
+            texts_with_breaks = [['a\rb', 'c\r', 'd\u2028e', 'f']] * 5
+            break_dictionary = Dictionary(texts_with_breaks)
+            break_model = MyWord2Vec(break_dictionary, size=20, workers=2)
+            break_model.save(os.path.join(dir_path, 'break_model'))
+            loaded_model = MyWord2Vec.load(os.path.join(dir_path, 'break_model'))
+            self.assertEqual(loaded_model.dictionary.token2id, break_dictionary.token2id)
+            del loaded_model
+            with self.assertRaises(ValueError):
+                MyWord2Vec(Dictionary([['a\nb']]), size=20).save(os.path.join(dir_path, 'bad_model'))
+
+            # Version 1 stored w_in as (size, vocab_count).
+            config_path = os.path.join(dir_path, 'model', 'config.json')
+            with open(config_path) as _:
+                config = json.load(_)
+            config['format_version'] = 1
+            with open(config_path, 'w') as _:
+                json.dump(config, _)
+            np.save(os.path.join(dir_path, 'model', 'w_in.npy'), w2v_model._w_in.T) # pylint: disable=protected-access
+            for mmap in [True, False]:
+                loaded_model = MyWord2Vec.load(os.path.join(dir_path, 'model'), mmap=mmap)
+                self.assertTrue(np.array_equal(loaded_model._w_in, w2v_model._w_in)) # pylint: disable=protected-access
+                del loaded_model
+
+    def test_my_word2vec_subsampling(self):
+        np.random.seed()
+
+        # 'the' occurs ten times in every text, so its document frequency understates it tenfold.
+        texts = [['the'] * 10 + ['w{}'.format(i) for i in np.random.randint(0, 100, 10)]
+                 for _ in range(50)]
+        dictionary = Dictionary(texts)
+        w2v_model = MyWord2Vec(dictionary, size=20, workers=2, sample=1e-2)
+        threshold = 1e-2 * 50 * 20
+        the_count = 500
+        self.assertAlmostEqual(
+            w2v_model.vocab_keep_prob[dictionary.token2id['the']],
+            (np.sqrt(the_count / threshold) + 1) * threshold / the_count, places=6)
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            w2v_model.save(os.path.join(dir_path, 'model'))
+            loaded_model = MyWord2Vec.load(os.path.join(dir_path, 'model'))
+            np.testing.assert_array_equal(loaded_model.vocab_keep_prob, w2v_model.vocab_keep_prob)
+
+        # Dictionaries without collection frequencies fall back to the document frequencies.
+        dictionary.cfs = {}
+        w2v_model = MyWord2Vec(dictionary, size=20, workers=2, sample=1e-2)
+        threshold = 1e-2 * sum(dictionary.dfs.values())
+        self.assertAlmostEqual(
+            w2v_model.vocab_keep_prob[dictionary.token2id['the']],
+            min((np.sqrt(50 / threshold) + 1) * threshold / 50, 1.0), places=6)
+
+    def test_my_word2vec_pickle(self):
+        np.random.seed()
+
+        texts = [['w{}'.format(i) for i in np.random.randint(0, 100, 20)] for _ in range(50)]
+        dictionary = Dictionary(texts)
+        corpus = [dictionary.doc2idx(text) for text in texts]
+        w2v_model = MyWord2Vec(dictionary, size=20, workers=2)
+        w2v_model.train(corpus)
+
+        loaded_model = pickle.loads(pickle.dumps(w2v_model))
+        self.assertTrue(np.array_equal(loaded_model._w_in, w2v_model._w_in)) # pylint: disable=protected-access
+        loaded_model.train(corpus)
+
+        # The first version pickled only these attributes, with w_in as (size, vocab_count).
+        state = {
+            'window': 5, 'negative': 5, 'ns_exponent': 0.75, 'lr': np.float32(0.025), 'workers': 2,
+            '_dictionary': dictionary, '_size': 20,
+            '_w_in': np.ascontiguousarray(w2v_model._w_in.T), '_w_out': w2v_model._w_out.copy(), # pylint: disable=protected-access
+        }
+        old_model = MyWord2Vec.__new__(MyWord2Vec)
+        old_model.__setstate__(state)
+        self.assertTrue(np.array_equal(old_model._w_in, w2v_model._w_in)) # pylint: disable=protected-access
+        self.assertEqual(old_model.most_similar('w0', topn=5), w2v_model.most_similar('w0', topn=5))
+        old_model.train(corpus)
+        self.assertAlmostEqual(old_model.alpha, 0.025)
+
+        # Raising workers after construction grows the throughput counters.
+        old_model.workers = 4
+        old_model.train(corpus)
+        self.assertEqual(len(old_model.throughput()), 4)
+
+    def test_my_word2vec_most_similar_batch(self):
+        np.random.seed()
+
+        texts = [['w{}'.format(i) for i in range(200)]]
+        dictionary = Dictionary(texts)
+        w2v_model = MyWord2Vec(dictionary, size=20)
+        w_in = w2v_model._w_in # pylint: disable=protected-access
+
+        positives = [list(np.random.choice(texts[0], 2)) for _ in range(30)]
+        negatives = [str(np.random.choice(texts[0])) for _ in range(30)]
+        results = w2v_model.most_similar_batch(positives, negatives, topn=5, block_size=8)
+
+        for positive, negative, result in zip(positives, negatives, results):
+            vector = sum(w_in[dictionary.token2id[token]] for token in positive) - \
+                w_in[dictionary.token2id[negative]]
+            cos_sim = np.matmul(w_in, vector) / np.linalg.norm(w_in, axis=1)
+            expected = [dictionary[index] for index in np.argsort(cos_sim)[::-1][:5]]
+            self.assertEqual(result, expected)
+            self.assertEqual(w2v_model.most_similar(positive, negative, topn=5), expected)
+
+    def test_my_word2vec_update_vocab(self):
+        np.random.seed()
+
+        texts = [['w{}'.format(i) for i in np.random.randint(0, 100, 20)] for _ in range(50)]
+        new_texts = [['w{}'.format(i) for i in np.random.randint(50, 150, 20)] for _ in range(50)]
+        for storage, hs in [('float32', 0), ('bfloat16', 0), ('float32', 1)]:
+            dictionary = Dictionary(texts)
+            w2v_model = MyWord2Vec(dictionary, size=20, workers=2, hs=hs, storage=storage)
+            w2v_model.train([dictionary.doc2idx(text) for text in texts])
+            w_in = w2v_model._w_in.copy() # pylint: disable=protected-access
+            w2v_model.build_ann_index(n_tables=4)
+            self.assertEqual(len(w2v_model.normalized_w_in), 100)
+
+            new_dictionary = Dictionary(new_texts)
+            w2v_model.update_vocab(new_dictionary)
+            self.assertEqual(w2v_model.vocab_count, 150)
+            self.assertIsNot(w2v_model.dictionary, dictionary)
+            self.assertEqual(len(dictionary), 100)
+            for token in ['w0', 'w50', 'w99']:
+                self.assertEqual(w2v_model.dictionary.token2id[token], dictionary.token2id[token])
+            self.assertEqual(
+                w2v_model.dictionary.dfs[w2v_model.dictionary.token2id['w60']],
+                dictionary.dfs[dictionary.token2id['w60']] +
+                new_dictionary.dfs[new_dictionary.token2id['w60']])
+            self.assertEqual(
+                w2v_model.dictionary.cfs[w2v_model.dictionary.token2id['w60']],
+                dictionary.cfs[dictionary.token2id['w60']] +
+                new_dictionary.cfs[new_dictionary.token2id['w60']])
+            self.assertTrue(np.array_equal(w2v_model._w_in[:100], w_in)) # pylint: disable=protected-access
+            self.assertEqual(w2v_model._w_in.dtype, w_in.dtype) # pylint: disable=protected-access
+            self.assertEqual(w2v_model._w_out.shape, (150, 20)) # pylint: disable=protected-access
+            self.assertEqual(len(w2v_model.vocab_ns_prob), 150)
+            self.assertEqual(len(w2v_model.vocab_keep_prob), 150)
+            self.assertIsNone(w2v_model.ann_index)
+            self.assertEqual(len(w2v_model.normalized_w_in), 150)
+
+            # The rows are over-allocated, so a small growth reuses the buffer in place.
+            buffer = w2v_model._w_in.base # pylint: disable=protected-access
+            self.assertGreater(len(buffer), 150)
+            w2v_model.update_vocab(Dictionary([['x0', 'x1']]))
+            self.assertIs(w2v_model._w_in.base, buffer) # pylint: disable=protected-access
+            self.assertTrue(np.array_equal(w2v_model._w_in[:100], w_in)) # pylint: disable=protected-access
+
+            w2v_model.schedule_alpha(len(new_texts) * 20)
+            loss = w2v_model.train([w2v_model.dictionary.doc2idx(text) for text in new_texts])
+            self.assertTrue(np.isfinite(loss))
+            self.assertEqual(len(w2v_model.most_similar('w120', topn=5)), 5)
+            self.assertEqual(len(w2v_model.most_similar('x0', topn=200)), 152)
+
+            # Only the rows in use are saved.
+            with tempfile.TemporaryDirectory() as dir_path:
+                w2v_model.save(os.path.join(dir_path, 'model'))
+                loaded_model = MyWord2Vec.load(os.path.join(dir_path, 'model'), mmap=False)
+                self.assertTrue(np.array_equal(loaded_model._w_in, w2v_model._w_in)) # pylint: disable=protected-access
+                loaded_model.update_vocab(Dictionary([['y0']]))
+                self.assertEqual(loaded_model._w_in.shape, (153, 20)) # pylint: disable=protected-access
+                del loaded_model
+
+    def test_lsh_index(self):
+        np.random.seed()
+
+        centers = np.random.randn(50, 32).astype(np.float32)
+        vectors = centers[np.random.randint(0, 50, 5000)] + \
+            0.3 * np.random.randn(5000, 32).astype(np.float32)
+        index = LSHIndex.build(vectors, n_tables=16)
+
+        recalls = []
+        for query in vectors[:50]:
+            cos_sim = np.matmul(vectors, query) / np.linalg.norm(vectors, axis=1)
+            expected = np.argsort(cos_sim)[::-1][:10]
+            result = index.search(query, vectors, topn=10, probes=4)
+            recalls.append(len(set(result) & set(expected)) / 10)
+
+        self.assertGreater(np.mean(recalls), 0.9)
+
+    def use_whitespace_tagger(self):
+        for patcher in [
+                mock.patch.object(wikipedia_ja.MeCab, 'Tagger', WhitespaceTagger),
+                mock.patch.object(wikipedia_ja, '_tokenizer', None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def write_wikipedia_shard(src_dir_path: str, subdir_name: str, texts):
+        os.makedirs(os.path.join(src_dir_path, subdir_name), exist_ok=True)
+        file_path = os.path.join(src_dir_path, subdir_name, 'wiki_00.bz2')
+        with bz2.open(file_path, 'wt', encoding='utf-8') as _:
+            for doc_id, text in enumerate(texts):
+                _.write('<doc id="{0}" title="t{0}">\n{1}\n\n</doc>\n'.format(doc_id, ' '.join(text)))
+        return file_path
+
+    @staticmethod
+    def cache_file_stats(cache_dir_path: str):
+        return {
+            file_name: (os.stat(os.path.join(cache_dir_path, file_name)).st_ino,
+                        os.stat(os.path.join(cache_dir_path, file_name)).st_mtime_ns)
+            for file_name in os.listdir(cache_dir_path)
+        }
+
+    @unittest.skipIf(wikipedia_ja is None, 'MeCab is not installed')
+    def test_wikipedia_data_set_cache(self):
+        np.random.seed()
+        self.use_whitespace_tagger()
+
+        shards = {
+            subdir_name: [['w{}'.format(i) for i in np.random.randint(0, 200, 10)] for _ in range(30)]
+            for subdir_name in ['AA', 'AB', 'AC']
+        }
+        with tempfile.TemporaryDirectory() as dir_path:
+            src_dir_path = os.path.join(dir_path, 'src')
+            cache_dir_path = os.path.join(dir_path, 'cache')
+            for subdir_name, texts in shards.items():
+                self.write_wikipedia_shard(src_dir_path, subdir_name, texts)
+
+            # The shard dictionaries of the workers merge into the dictionary of a serial pass.
+            reference = Dictionary(text for subdir_name in sorted(shards) for text in shards[subdir_name])
+            for workers, path in [(2, os.path.join(dir_path, 'cache2')), (1, cache_dir_path)]:
+                data_set = wikipedia_ja.WikipediaDataSet(
+                    src_dir_path, path, workers=workers, id_cache=True)
+                self.assertEqual(data_set.dictionary.token2id, reference.token2id)
+                self.assertEqual(data_set.dictionary.dfs, reference.dfs)
+                self.assertEqual(data_set.dictionary.cfs, reference.cfs)
+                self.assertEqual(len(data_set), 90)
+                self.assertEqual(data_set.dictionary.num_pos, 900)
+                self.assertEqual(
+                    [(shard['texts'], shard['tokens']) for shard in data_set.manifest['shards']],
+                    [(30, 300)] * 3)
+
+            # An unchanged rerun only loads the dictionary.
+            stats = self.cache_file_stats(cache_dir_path)
+            data_set = wikipedia_ja.WikipediaDataSet(src_dir_path, cache_dir_path, id_cache=True)
+            self.assertEqual(self.cache_file_stats(cache_dir_path), stats)
+            self.assertEqual(data_set.dictionary.token2id, reference.token2id)
+            self.assertEqual(data_set.dictionary.cfs, reference.cfs)
+
+            # A rewritten shard with the same words rebuilds only its own files.
+            file_path = self.write_wikipedia_shard(src_dir_path, 'AB', shards['AB'])
+            mtime = os.stat(file_path).st_mtime_ns + 10 ** 9
+            os.utime(file_path, ns=(mtime, mtime))
+            data_set = wikipedia_ja.WikipediaDataSet(src_dir_path, cache_dir_path, id_cache=True)
+            new_stats = self.cache_file_stats(cache_dir_path)
+            self.assertEqual(
+                {file_name for file_name in stats if new_stats[file_name] != stats[file_name]},
+                {'AB', 'AB.tokens.npy', 'AB.offsets.npy', 'dictionary.pkl', 'manifest.json'})
+            self.assertEqual(data_set.dictionary.token2id, reference.token2id)
+
+            # A shard with a new word changes the dictionary, so every id array is rebuilt.
+            shards['AC'][0].append('new')
+            stats = new_stats
+            self.write_wikipedia_shard(src_dir_path, 'AC', shards['AC'])
+            data_set = wikipedia_ja.WikipediaDataSet(src_dir_path, cache_dir_path, id_cache=True)
+            new_stats = self.cache_file_stats(cache_dir_path)
+            self.assertEqual(
+                {file_name for file_name in stats if new_stats[file_name] != stats[file_name]},
+                {'AC', 'dictionary.pkl', 'manifest.json'} |
+                {'{}.{}.npy'.format(subdir_name, name)
+                 for subdir_name in shards for name in ['tokens', 'offsets']})
+            self.assertIn('new', data_set.dictionary.token2id)
+            for cache_file_path, (tokens_path, offsets_path) in zip(
+                    data_set.cache_file_paths, data_set.id_cache_file_paths):
+                with open(cache_file_path, 'rb') as _:
+                    tokens, offsets = wikipedia_ja.texts_to_csr(
+                        dill.load(_), data_set.dictionary.token2id)
+                np.testing.assert_array_equal(np.load(tokens_path), tokens)
+                np.testing.assert_array_equal(np.load(offsets_path), offsets)
+
+    @unittest.skipIf(wikipedia_ja is None, 'MeCab is not installed')
+    def test_wikipedia_data_loader(self):
+        np.random.seed()
+        self.use_whitespace_tagger()
+
+        shards = {
+            subdir_name: [['w{}'.format(i) for i in np.random.randint(0, 200, np.random.randint(1, 20))]
+                          for _ in range(40)]
+            for subdir_name in ['AA', 'AB', 'AC']
+        }
+        texts = collections.Counter(tuple(text) for shard in shards.values() for text in shard)
+        with tempfile.TemporaryDirectory() as dir_path:
+            src_dir_path = os.path.join(dir_path, 'src')
+            cache_dir_path = os.path.join(dir_path, 'cache')
+            for subdir_name, shard in shards.items():
+                self.write_wikipedia_shard(src_dir_path, subdir_name, shard)
+            id_data_set = wikipedia_ja.WikipediaDataSet(src_dir_path, cache_dir_path, id_cache=True)
+            data_set = wikipedia_ja.WikipediaDataSet(
+                src_dir_path, cache_dir_path, shuffle_buffer_size=7)
+            self.assertIsNone(data_set.id_tokens)
+
+            # The shuffle buffer yields every text once.
+            self.assertEqual(collections.Counter(tuple(text) for text in data_set.get_text()), texts)
+
+            # The id cache yields the same texts, also indexed by a filtered dictionary.
+            dictionary = data_set.dictionary
+            for filtered in [False, True]:
+                if filtered:
+                    dictionary.filter_extremes(no_below=3, no_above=1.0)
+                csr_texts = []
+                for loaded_set in [data_set, id_data_set]:
+                    batches = list(wikipedia_ja.WikipediaDataLoader(loaded_set, 16).get_csr_iter(dictionary))
+                    for tokens, offsets in batches:
+                        self.assertEqual(tokens.dtype, np.int32)
+                        self.assertEqual(offsets.dtype, np.int64)
+                        self.assertLessEqual(len(offsets) - 1, 16)
+                    csr_texts.append(collections.Counter(
+                        tuple(tokens[offsets[i]: offsets[i + 1]].tolist())
+                        for tokens, offsets in batches for i in range(len(offsets) - 1)))
+                self.assertEqual(csr_texts[0], csr_texts[1])
+                self.assertEqual(sum(csr_texts[1].values()), 120)
+            self.assertIn(-1, [token for text in csr_texts[1] for token in text])
+
+            # Closing get_text early or failing on a shard stops its loading thread.
+            thread_count = threading.active_count()
+            text_iter = data_set.get_text()
+            next(text_iter)
+            text_iter.close()
+            self.assertEqual(threading.active_count(), thread_count)
+            os.remove(data_set.cache_file_paths[1])
+            with self.assertRaises(FileNotFoundError):
+                list(data_set.get_text())
+            self.assertEqual(threading.active_count(), thread_count)
+
 if __name__ == '__main__':
     unittest.main()